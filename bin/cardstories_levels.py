@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Recompute the levels, levelups and earned cards of every player
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+############################################################################
+# Invoke with PYTHONPATH pointing to the root of the cardstories install
+# directory. By default, only reports the players whose stored levelups
+# don't match their score; use --write to store the corrections.
+############################################################################
+
+# Imports #####################################################################
+
+import sys, random, sqlite3
+import argparse
+import numpy
+
+from cardstories import levels
+from cardstories.game import CardstoriesGame
+
+# Functions ###################################################################
+
+def earnable_cards():
+    """Returns the list of cards (as stored in the database) that players
+    can earn by leveling up."""
+
+    return [chr(x) for x in range(CardstoriesGame.NCARDS + 1, CardstoriesGame.NCARDS_EARNED + 1)
+            if x not in CardstoriesGame.CARDS_FOR_SELL]
+
+def compute_levels(scores):
+    """Levels of the scores, as computed by levels.calculate_levels(),
+    as a numpy array."""
+
+    return numpy.array([level for (level, _, _) in levels.calculate_levels(list(scores))],
+                       dtype=numpy.int64)
+
+def read_players(cursor, chunk_size):
+    """Streams the players table, yielding (player_ids, scores, levelups,
+    earned_cards) chunks of at most chunk_size players. Ids, scores and
+    levelups are numpy arrays, earned_cards is a list of strings."""
+
+    last_id = None
+    while True:
+        if last_id is None:
+            cursor.execute("SELECT player_id, score, levelups, earned_cards FROM players "
+                           "ORDER BY player_id LIMIT ?", [chunk_size])
+        else:
+            cursor.execute("SELECT player_id, score, levelups, earned_cards FROM players "
+                           "WHERE player_id > ? ORDER BY player_id LIMIT ?", [last_id, chunk_size])
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        player_ids = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+        scores = numpy.array([row[1] or 0 for row in rows], dtype=numpy.int64)
+        levelups = numpy.array([row[2] or 0 for row in rows], dtype=numpy.int64)
+        earned_cards = [row[3] or '' for row in rows]
+        yield player_ids, scores, levelups, earned_cards
+
+def audit(cursor, chunk_size=10000):
+    """Recomputes levels for the whole players table and yields, chunk by chunk,
+    the list of players whose levelups or earned cards need a correction.
+
+    Each correction is a dict with the player_id, the score and computed level,
+    the stored levelups, the levelups the player should have, and the cards
+    the player is owed (earned by leveling up, but never granted)."""
+
+    earnable = set(earnable_cards())
+    for player_ids, scores, levelups, earned_cards in read_players(cursor, chunk_size):
+        player_levels = compute_levels(scores)
+        earned_count = numpy.array([len([c for c in cards if c in earnable]) for cards in earned_cards],
+                                   dtype=numpy.int64)
+        # One card per level since level 1, as long as there are cards left to earn.
+        entitled = numpy.minimum(player_levels - 1, len(earnable))
+        # levelups counts the cards granted so far: it can't be less than the
+        # cards the player already owns, even if the level formula got harder.
+        expected = numpy.maximum(entitled, earned_count)
+        owed = entitled - earned_count
+        wrong = numpy.nonzero((levelups != expected) | (owed > 0))[0]
+        corrections = []
+        for i in wrong:
+            corrections.append({'player_id': int(player_ids[i]),
+                                'score': int(scores[i]),
+                                'level': int(player_levels[i]),
+                                'levelups': int(levelups[i]),
+                                'expected_levelups': int(expected[i]),
+                                'earned_cards': earned_cards[i],
+                                'owed': max(int(owed[i]), 0)})
+        yield corrections
+
+def grant_owed_cards(correction):
+    """Returns the earned_cards string of the player after granting him the
+    cards he is owed, picked randomly like CardstoriesGame.completeInteraction does."""
+
+    earned_cards = list(correction['earned_cards'])
+    deck = [c for c in earnable_cards() if c not in earned_cards]
+    for i in range(correction['owed']):
+        card = random.choice(deck)
+        deck.remove(card)
+        earned_cards.append(card)
+    return ''.join(earned_cards)
+
+def write_corrections(cursor, corrections):
+    cursor.executemany("UPDATE players SET levelups = ?, earned_cards = ? WHERE player_id = ?",
+                       [(c['expected_levelups'], grant_owed_cards(c), c['player_id']) for c in corrections])
+
+def run(db, chunk_size=10000, write=False, out=sys.stdout):
+    """Audits (and optionally corrects) the players table of the db sqlite file.
+    Returns the number of players needing a correction."""
+
+    conn = sqlite3.connect(db)
+    cursor = conn.cursor()
+    count = 0
+    for corrections in audit(cursor, chunk_size):
+        for c in corrections:
+            out.write("player_id=%(player_id)d score=%(score)d level=%(level)d "
+                      "levelups=%(levelups)d expected_levelups=%(expected_levelups)d owed=%(owed)d\n" % c)
+        if write and corrections:
+            write_corrections(cursor, corrections)
+            conn.commit()
+        count += len(corrections)
+    cursor.close()
+    conn.close()
+    out.write("%d player(s) %s\n" % (count, write and 'corrected' or 'to correct'))
+    return count
+
+# Main ########################################################################
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Recompute levels, levelups and earned cards of all players.')
+    parser.add_argument('db', help='sqlite3 game database path')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='number of players read at once')
+    parser.add_argument('--write', action='store_true', help='store the corrections in the database')
+    parser.add_argument('--level-a', type=float, default=levels.LEVEL_A, help='LEVEL_A constant to use')
+    parser.add_argument('--level-b', type=float, default=levels.LEVEL_B, help='LEVEL_B constant to use')
+    parser.add_argument('--level-c', type=float, default=levels.LEVEL_C, help='LEVEL_C constant to use')
+    options = parser.parse_args(argv)
+
+    levels.LEVEL_A = options.level_a
+    levels.LEVEL_B = options.level_b
+    levels.LEVEL_C = options.level_c
+
+    run(options.db, chunk_size=options.chunk_size, write=options.write)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -25,6 +25,8 @@
 
 from twisted.internet import defer
 
+from cardstories.helpers import gather
+
 
 # Constants ###################################################################
 
@@ -79,46 +81,59 @@ class Auth:
 
         raise NotImplementedError(NOT_IMPLEMENTED_ERROR_MSG)
 
-    @defer.inlineCallbacks
     def get_players_ids(self, emails, create=False):
         '''Returns a list of player_id corresponding to the provided list of emails
-        If create=True, create the players if any doesn't exist'''
-        
-        ids = []
+        If create=True, create the players if any doesn't exist
+
+        Auth plugins able to retreive the ids of several players at once
+        should redefine this method. By default, the ids of all players are
+        requested concurrently, once for each distinct email: two concurrent
+        requests for the same email could both create the player.'''
+
+        emails = [isinstance(email, unicode) and email or email.decode('utf-8') for email in emails]
+        distinct = []
         for email in emails:
-            if not isinstance(email, unicode):
-                email = email.decode('utf-8')
-                
-            id = yield self.get_player_id(email, create=create)
-            ids.append(id)
-        defer.returnValue(ids)
+            if email not in distinct:
+                distinct.append(email)
+        d = gather([defer.maybeDeferred(self.get_player_id, email, create=create) for email in distinct])
+        def collect(ids):
+            ids = dict(zip(distinct, ids))
+            return [ids[email] for email in emails]
+        d.addCallback(collect)
+        return d
 
-    @defer.inlineCallbacks
     def get_players_emails(self, ids):
         '''Returns a list of emails, corresponding to the provided player_ids'''
-        emails = []
-        for id in ids:
-            email = yield self.get_player_email(id)
-            emails.append(email)
-        defer.returnValue(emails)
 
-    @defer.inlineCallbacks
+        return gather([defer.maybeDeferred(self.get_player_email, id) for id in ids])
+
     def get_players_names(self, ids):
         '''Returns a list of names, corresponding to the provided player_ids'''
-        names = []
-        for id in ids:
-            name = yield self.get_player_name(id)
-            names.append(name)
-        defer.returnValue(names)
-        
-    @defer.inlineCallbacks
+
+        return gather([defer.maybeDeferred(self.get_player_name, id) for id in ids])
+
     def get_players_avatars_urls(self, ids):
         '''Returns a list of avatar URLs, corresponding to the provided player_ids'''
-        avatars_urls = []
-        for id in ids:
-            avatar_url = yield self.get_player_avatar_url(id)
-            avatars_urls.append(avatar_url)
-        defer.returnValue(avatars_urls)
+
+        return gather([defer.maybeDeferred(self.get_player_avatar_url, id) for id in ids])
+
+    def get_players_info(self, ids):
+        '''Returns a list of {'name': ..., 'avatar_url': ...} dicts, corresponding
+        to the provided player_ids
+
+        Auth plugins able to retreive the information of several players at once
+        should redefine this method. By default, the name and avatar URL of all
+        players are requested concurrently.'''
+
+        names = self.get_players_names(ids)
+        avatars_urls = self.get_players_avatars_urls(ids)
+        d = gather([names, avatars_urls])
+        def success(results):
+            names, avatars_urls = results
+            return [{'name': name, 'avatar_url': avatar_url}
+                    for (name, avatar_url) in zip(names, avatars_urls)]
+        d.addCallback(success)
+        return d
 
     @defer.inlineCallbacks
     def preprocess(self, result, request):
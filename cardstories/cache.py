@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Imports ####################################################################
+
+from collections import OrderedDict
+
+from twisted.python import runtime
+
+
+# Classes ####################################################################
+
+class LRUCache(object):
+    """
+    Size-bounded cache, evicting the least recently used entries first.
+    Entries can optionally expire after a number of seconds (ttl), either
+    set for the whole cache or for each entry.
+    Keeps track of hits and misses, to be able to measure its efficiency.
+    """
+
+    def __init__(self, size, ttl=None, seconds=runtime.seconds):
+        self.size = size
+        self.ttl = ttl
+        self.seconds = seconds
+        self.entries = OrderedDict() # key => (expires, value)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        """
+        Checks if the key is in the cache, without counting a hit or miss,
+        nor changing its position in the LRU order.
+        """
+
+        if key not in self.entries:
+            return False
+        expires, value = self.entries[key]
+        if expires is not None and expires <= self.seconds():
+            del self.entries[key]
+            return False
+        return True
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for key, or default if there is no
+        such key in the cache (or if it expired).
+        """
+
+        if key in self:
+            expires, value = self.entries.pop(key)
+            self.entries[key] = (expires, value)
+            self.hits += 1
+            return value
+        else:
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value for key, expiring after ttl seconds (defaults to the ttl
+        of the cache). Evicts the least recently used entry if the cache is full.
+        """
+
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            expires = None
+        else:
+            expires = self.seconds() + ttl
+        if key in self.entries:
+            del self.entries[key]
+        self.entries[key] = (expires, value)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        if key in self.entries:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            return float(self.hits) / lookups
+        else:
+            return 0.0
+
+    def stats(self):
+        return {'size': len(self),
+                'max_size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hit_ratio()}
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Imports ####################################################################
+
+import random
+import sqlite3
+
+from twisted.enterprise import adbapi
+from twisted.internet import defer, task
+from twisted.python import failure, log
+
+
+# Classes ####################################################################
+
+class ConnectionPool(adbapi.ConnectionPool):
+    """
+    sqlite3 connection pool retrying the interactions that fail because
+    the database is busy or locked by another writer. The transaction is
+    rolled back and the interaction runs again after a delay that doubles
+    with each attempt (with a random part, so that the writers waiting for
+    the same lock don't all retry at once), until the deadline is reached:
+    only the errors that persist reach the caller.
+    runQuery and runOperation are interactions too, and are retried as well.
+    """
+
+    RETRY_DELAY = 0.01 # seconds before the first retry
+    RETRY_MAX_DELAY = 1.0
+    RETRY_DEADLINE = 10.0 # seconds after which the error is given up to the caller
+
+    def __init__(self, *args, **kwargs):
+        self.retry_delay = kwargs.pop('retry_delay', self.RETRY_DELAY)
+        self.retry_max_delay = kwargs.pop('retry_max_delay', self.RETRY_MAX_DELAY)
+        self.retry_deadline = kwargs.pop('retry_deadline', self.RETRY_DEADLINE)
+        self.retries = 0
+        adbapi.ConnectionPool.__init__(self, "sqlite3", *args, **kwargs)
+
+    @staticmethod
+    def is_busy(reason):
+        '''True if the failure is caused by the lock of another connection
+        (SQLITE_BUSY or SQLITE_LOCKED), i.e. if trying again may succeed'''
+
+        return bool(reason.check(sqlite3.OperationalError)) and 'is locked' in str(reason.value)
+
+    @defer.inlineCallbacks
+    def runInteraction(self, interaction, *args, **kw):
+        deadline = self._reactor.seconds() + self.retry_deadline
+        delay = self.retry_delay
+        while True:
+            try:
+                result = yield adbapi.ConnectionPool.runInteraction(self, interaction, *args, **kw)
+                defer.returnValue(result)
+            except sqlite3.OperationalError:
+                reason = failure.Failure()
+                wait = delay * random.uniform(0.5, 1.5)
+                if not self.is_busy(reason) or self._reactor.seconds() + wait > deadline:
+                    raise
+            self.retries += 1
+            log.msg('database busy, retrying %s in %.3f seconds' % (getattr(interaction, '__name__', interaction), wait))
+            yield task.deferLater(self._reactor, wait, lambda: None)
+            delay = min(delay * 2, self.retry_max_delay)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Imports ####################################################################
+
+import random
+
+
+# Constants ##################################################################
+
+BITS = [1 << n for n in xrange(256)] # masks of the cards, by character code
+
+
+# Classes ####################################################################
+
+class Deck(object):
+    """
+    Set of cards, stored as an integer bitmask: card n is in the deck when
+    bit n is set. The cards are stored in the database as strings, one
+    character per card (chr(n)), which fromstring() and tostring() convert.
+    """
+
+    __slots__ = ('mask',)
+
+    def __init__(self, mask=0):
+        self.mask = mask
+
+    @classmethod
+    def range(cls, first, last):
+        '''Deck of the cards first to last, included'''
+
+        return cls(((1 << (last + 1)) - 1) & ~((1 << first) - 1))
+
+    @classmethod
+    def fromstring(cls, cards):
+        # The sum of the distinct bits is their union, computed without
+        # a python loop.
+        return cls(sum(map(BITS.__getitem__, set(map(ord, cards or '')))))
+
+    def tostring(self):
+        return ''.join([chr(card) for card in self])
+
+    def __contains__(self, card):
+        return (self.mask >> card) & 1 == 1
+
+    def __len__(self):
+        return bin(self.mask).count('1')
+
+    def __iter__(self):
+        mask = self.mask
+        return iter([card for card in xrange(mask.bit_length()) if mask >> card & 1])
+
+    def __eq__(self, other):
+        return isinstance(other, Deck) and self.mask == other.mask
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __or__(self, other):
+        return Deck(self.mask | other.mask)
+
+    def __sub__(self, other):
+        return Deck(self.mask & ~other.mask)
+
+    def __repr__(self):
+        return 'Deck(%r)' % list(self)
+
+    def add(self, card):
+        self.mask |= 1 << card
+
+    def remove(self, card):
+        self.mask &= ~(1 << card)
+
+    def sample(self, count, random=random):
+        '''Removes count cards chosen at random from the deck (or all of them
+        if there are not that many left) and returns them, in the order they
+        were drawn.
+
+        Cards are drawn by picking random numbers between the lowest and the
+        highest card until count of them are in the deck: while the deck is
+        mostly full, it takes O(count) draws. When too few cards are left for
+        that to be efficient, they are enumerated and sampled instead.'''
+
+        size = len(self)
+        highest = self.mask.bit_length() - 1
+        lowest = (self.mask & -self.mask).bit_length() - 1
+        # The draws must hit a card of the deck often enough: there must be
+        # enough cards left, and they must not be too sparse.
+        if size <= 2 * count or highest - lowest + 1 > 4 * size:
+            cards = random.sample(list(self), min(count, size))
+            for card in cards:
+                self.remove(card)
+        else:
+            cards = []
+            mask = self.mask
+            span = highest - lowest + 1
+            draw = random.random
+            while len(cards) < count:
+                card = lowest + int(draw() * span)
+                if mask >> card & 1:
+                    mask &= ~BITS[card]
+                    cards.append(card)
+            self.mask = mask
+        return cards
@@ -56,8 +56,11 @@ def owner_chose_card(db, game_id, author_id, card):
 def owner_wrote_story(db, game_id, author_id, sentence):
     log_event(db, OWNER_WROTE_STORY, game_id, author_id, sentence)
 
-def player_invited(db, game_id, author_id, player_id):
-    log_event(db, PLAYER_INVITED, game_id, author_id, player_id)
+def players_invited(transaction, game_id, author_id, player_ids):
+    '''Logs the invitation of several players at once, within the
+    transaction storing them (see CardstoriesGame.inviteInteraction)'''
+    sql = "INSERT INTO event_logs (timestamp, player_id, game_id, event_type, data) VALUES (datetime('now'), ?, ?, ?, ?)"
+    transaction.executemany(sql, [ (author_id, game_id, PLAYER_INVITED, player_id) for player_id in player_ids ])
 
 def player_joined(db, game_id, player_id):
     log_event(db, PLAYER_JOINED, game_id, player_id)
@@ -31,6 +31,7 @@ import cardstories.event_log as event_log
 from cardstories.poll import Pollable
 from cardstories.exceptions import CardstoriesWarning
 from cardstories.levels import calculate_level
+from cardstories.deck import Deck
 
 class CardstoriesGame(Pollable):
 
@@ -50,28 +51,74 @@ class CardstoriesGame(Pollable):
     POINTS_P_LOST = 1
     POINTS_P_FAILED = 2
 
+    # Tens of thousands of games may be loaded at once: they have no
+    # instance __dict__.
+    __slots__ = ('service', 'settings', 'id', 'owner_id', 'game_state',
+                 'players', 'invited', 'spectators', 'actions', 'cards', 'dealt',
+                 'timer', 'countdown_timer', 'countdown_duration')
+
     def __init__(self, service, id=None):
         self.service = service
         self.settings = service.settings
         self.id = id
         self.owner_id = None
+        self.game_state = None
         self.players = []
         self.invited = []
+        self.spectators = []
+        self.actions = defer.DeferredLock()
+        # The cards dealt so far, as stored in games.cards, and as a Deck.
+        self.cards = ''
+        self.dealt = Deck()
+        self.timer = None
+        self.countdown_timer = None
+        self.countdown_duration = None
         Pollable.__init__(self, self.settings.get('poll-timeout', 30))
 
     def touch(self, *args, **kwargs):
         self.update_timer()
         kwargs['game_id'] = [self.id]
-        return Pollable.touch(self, kwargs)
+        d = Pollable.touch(self, kwargs)
+        self.wake_spectators()
+        return d
 
     def destroy(self):
         self.clear_countdown()
-        if hasattr(self, 'timer') and self.timer.active():
+        if self.timer and self.timer.active():
             self.timer.cancel()
-        if hasattr(self, 'service'):
-            del self.service
+        self.wake_spectators()
+        self.service = None
         return Pollable.destroy(self)
 
+    def spectate(self):
+        '''Waits until the game is modified or the poll times out. Spectators
+        are not told what changed: they all ask for the same view of the game
+        (see CardstoriesService.spectator_view).'''
+
+        d = defer.Deferred()
+        self.spectators.append(d)
+        self.service.spectators_count += 1
+        def timeout():
+            if d in self.spectators:
+                self.spectators.remove(d)
+                self.service.spectators_count -= 1
+                d.callback(None)
+        timer = reactor.callLater(self.timeout, timeout)
+        def done(result):
+            if timer.active():
+                timer.cancel()
+            return result
+        d.addBoth(done)
+        return d
+
+    def wake_spectators(self):
+        spectators = self.spectators
+        if spectators:
+            self.service.spectators_count -= len(spectators)
+        self.spectators = []
+        for spectator in spectators:
+            spectator.callback(None)
+
     def get_id(self):
         return self.id
 
@@ -81,17 +128,31 @@ class CardstoriesGame(Pollable):
     def get_players(self):
         return self.players + self.invited
 
+    def queue(self, action, *args, **kwargs):
+        '''Runs the action when the actions queued before it are done: the
+        actions modifying the game run one at a time, and each of them can
+        rely on the in core representation of the game (state, players) to
+        reject an invalid request before writing to the database.'''
+
+        def run():
+            if self.game_state in ('complete', 'canceled') or self.service is None:
+                raise CardstoriesWarning('GAME_NOT_LOADED', {'game_id': self.get_id()})
+            return action(*args, **kwargs)
+        return self.actions.run(run)
+
     def load(self, cursor):
         cursor.execute("SELECT player_id FROM player2game WHERE game_id = %d" % self.id)
         self.players += [ x[0] for x in cursor.fetchall() ]
         cursor.execute("SELECT player_id FROM invitations WHERE game_id = %d" % self.id)
         self.invited += [ x[0] for x in cursor.fetchall() ]
-        cursor.execute("SELECT owner_id FROM games WHERE id = %d" % self.id)
-        self.owner_id = cursor.fetchone()[0]
+        cursor.execute("SELECT owner_id, state, cards FROM games WHERE id = %d" % self.id)
+        self.owner_id, self.game_state, cards = cursor.fetchone()
+        self.cards = cards or ''
+        self.dealt = Deck.fromstring(self.cards)
         self.update_timer()
 
     def update_timer(self):
-        if hasattr(self, 'timer') and self.timer.active():
+        if self.timer and self.timer.active():
             self.timer.cancel()
         self.timer = reactor.callLater(self.settings.get('game-timeout', 24 * 60 * 60), self.state_change)
 
@@ -99,37 +160,45 @@ class CardstoriesGame(Pollable):
     STATE_CHANGE_TO_COMPLETE = 2
     STATE_CHANGE_CANCEL = 3
 
-    @defer.inlineCallbacks
     def state_change(self):
+        return self.queue(self.stateChangeAction)
+
+    @defer.inlineCallbacks
+    def stateChangeAction(self):
         game, players_id_list = yield self.game(self.get_owner_id())
         if game['state'] == 'create':
-            yield self.cancel()
+            yield self.cancelAction()
             result = self.STATE_CHANGE_CANCEL
         elif game['state'] == 'invitation':
             if game['ready']:
-                yield self.voting({ 'owner_id': [self.get_owner_id()],
-                                    'game_id': [self.get_id()] })
+                yield self.votingAction(self.get_owner_id())
                 result = self.STATE_CHANGE_TO_VOTE
             else:
-                yield self.cancel()
+                yield self.cancelAction()
                 result = self.STATE_CHANGE_CANCEL
         elif game['state'] == 'vote':
             if game['ready']:
-                yield self.complete(self.get_owner_id())
+                yield self.completeAction(self.get_owner_id())
                 result = self.STATE_CHANGE_TO_COMPLETE
             else:
-                yield self.cancel()
+                yield self.cancelAction()
                 result = self.STATE_CHANGE_CANCEL
         else:
             raise Exception, "Unexpected state: '%s'" % game['state']
         defer.returnValue(result)
 
-    @defer.inlineCallbacks
     def cancel(self):
+        return self.queue(self.cancelAction)
+
+    @defer.inlineCallbacks
+    def cancelAction(self):
         yield self.service.db.runOperation("UPDATE games SET state = 'canceled' WHERE id = ?", [ self.get_id() ])
+        self.game_state = 'canceled'
         yield self.cancelInvitations()
         event_log.game_canceled(self.service.db, self.get_id(), self.get_owner_id())
+        render = yield self.game(None)
         yield self.touch(type='cancel')
+        self.cache_render(render)
         self.destroy() # notify before altering the in core representation
         self.invited = []
         defer.returnValue({})
@@ -141,10 +210,12 @@ class CardstoriesGame(Pollable):
             transaction.execute("UPDATE games SET players = players - 1 WHERE id = ?", [ game_id ])
         return deleted
 
-    @defer.inlineCallbacks
     def leave_api(self, args):
         self.service.required(args, 'leave', 'player_id')
-        player_ids = args['player_id']
+        return self.queue(self.leaveAction, args['player_id'])
+
+    @defer.inlineCallbacks
+    def leaveAction(self, player_ids):
         deleted = yield self.leave(player_ids)
         yield self.touch()
         defer.returnValue({'deleted': deleted})
@@ -161,49 +232,30 @@ class CardstoriesGame(Pollable):
         defer.returnValue(count)
 
     def playerInteraction(self, transaction, player_id):
-        transaction.execute("SELECT player_id from players WHERE player_id = ?", [player_id])
+        '''Creates the player if needed, and returns the cards the player earned'''
+
+        transaction.execute("SELECT earned_cards from players WHERE player_id = ?", [player_id])
         rows = transaction.fetchall()
         if not rows:
             transaction.execute("INSERT INTO players (player_id, score, score_prev, levelups) VALUES (?, ?, ?, ?)", [player_id, 0, 0, 0])
+            return None
+        return rows[0][0]
 
-    def deal(self, earned_cards, dealt_cards):
-        # Create the base deck, composed of the base cards and the cards the
-        # player earned.
-        deck = [chr(x) for x in range(1, self.NCARDS + 1)]
-        if earned_cards:
-            deck.extend(list(earned_cards))
-
-        # Remove previously dealt cards from the deck.
-        if dealt_cards:
-            dealt_cards = list(dealt_cards)
-        else:
-            dealt_cards = []
-
-        for dealt_card in dealt_cards:
-            try:
-                deck.remove(dealt_card)
-            except ValueError:
-                pass
-
-        # Shuffle it
-        random.shuffle(deck)
+    def deal(self, earned_cards, dealt_cards, dealt=None):
+        # The base deck and the cards the player earned, without the cards
+        # already dealt (dealt is their Deck, if the caller has it).
+        if dealt is None:
+            dealt = Deck.fromstring(dealt_cards)
+        deck = Deck.range(1, self.NCARDS) | Deck.fromstring(earned_cards)
+        deck -= dealt
 
-        # Deal the player's cards from the beginning of the deck.
-        player_cards = deck[:self.CARDS_PER_PLAYER]
-        dealt_cards.extend(player_cards)
+        # Deal the player's cards at random.
+        player_cards = ''.join([chr(card) for card in deck.sample(self.CARDS_PER_PLAYER)])
 
-        # Return, converting lists back to strings.
-        return (''.join(player_cards), ''.join(dealt_cards))
-
-    def createInteraction(self, transaction, owner_id):
-        # Fetch the owner's earned cards.
-        transaction.execute("SELECT earned_cards FROM players WHERE player_id = %d" % owner_id)
-        row = transaction.fetchone()
-        if row:
-            earned_cards = row[0]
-        else:
-            earned_cards = None
+        # Return them, and the cards dealt in this game so far.
+        return (player_cards, (dealt_cards or '') + player_cards)
 
+    def createInteraction(self, transaction, owner_id, earned_cards):
         # Deal the initial hand.
         owner_cards, dealt_cards = self.deal(earned_cards, None)
 
@@ -214,52 +266,57 @@ class CardstoriesGame(Pollable):
         # Insert the owner as a player, including his cards.
         transaction.execute("INSERT INTO player2game (game_id, player_id, cards) VALUES (?, ?, ?)", [game_id, owner_id, owner_cards])
 
-        return game_id
+        return (game_id, dealt_cards)
 
     @defer.inlineCallbacks
     def create(self, owner_id):
         self.owner_id = owner_id
-        yield self.service.db.runInteraction(self.playerInteraction, self.owner_id)
-        game_id = yield self.service.db.runInteraction(self.createInteraction, self.owner_id)
+        earned_cards = yield self.service.db.runInteraction(self.playerInteraction, self.owner_id)
+        game_id, self.cards = yield self.service.db.runInteraction(self.createInteraction, self.owner_id, earned_cards)
+        self.dealt = Deck.fromstring(self.cards)
         self.id = game_id
+        self.game_state = 'create'
         self.players.append(self.owner_id)
         self.update_timer()
         event_log.game_created(self.service.db, game_id, self.owner_id);
         defer.returnValue(game_id)
 
     def setCardInteraction(self, transaction, game_id, player_id, card):
-        transaction.execute("SELECT state, owner_id FROM games WHERE id = ?", [ game_id ])
-        state, owner_id = transaction.fetchone()
-        if player_id != owner_id:
-            raise Exception, 'Only game owner can set the card.'
-        if state != 'create':
-            raise CardstoriesWarning('WRONG_STATE_FOR_SETTING_CARD', {'game_id': game_id, 'state': state})
         transaction.execute("UPDATE player2game SET picked = ? WHERE game_id = ? AND player_id = ?", [ card, game_id, player_id ])
         transaction.execute("UPDATE games SET board = ? WHERE id = ?", [card, game_id])
 
-    @defer.inlineCallbacks
     def set_card(self, player_id, card):
+        return self.queue(self.setCardAction, player_id, card)
+
+    @defer.inlineCallbacks
+    def setCardAction(self, player_id, card):
+        if player_id != self.get_owner_id():
+            raise Exception, 'Only game owner can set the card.'
+        if self.game_state != 'create':
+            raise CardstoriesWarning('WRONG_STATE_FOR_SETTING_CARD', {'game_id': self.get_id(), 'state': self.game_state})
         yield self.service.db.runInteraction(self.setCardInteraction, self.get_id(), player_id, chr(card))
         result = yield self.touch(type='set_card', player_id=player_id, card=card)
         event_log.owner_chose_card(self.service.db, self.get_id(), player_id, card)
         defer.returnValue(result)
 
     def setSentenceInteraction(self, transaction, player_id, game_id, sentence):
-        transaction.execute("SELECT state, owner_id FROM games WHERE id = ?", [ game_id ])
-        state, owner_id = transaction.fetchone()
-        if owner_id != player_id:
-            raise Exception, "Only game owner can set the sentence."
-        if state != 'create':
-            raise CardstoriesWarning('WRONG_STATE_FOR_SETTING_SENTENCE', {'game_id': game_id, 'state': state})
         transaction.execute("SELECT picked FROM player2game WHERE game_id = %d AND player_id = %d" % (game_id, player_id))
         card = transaction.fetchone()[0]
         if not card:
             raise CardstoriesWarning('CARD_NOT_SET', {'game_id': game_id })
         transaction.execute("UPDATE games SET sentence = ?, state = 'invitation' WHERE id = ?", [ sentence, game_id ])
 
-    @defer.inlineCallbacks
     def set_sentence(self, player_id, sentence):
+        return self.queue(self.setSentenceAction, player_id, sentence)
+
+    @defer.inlineCallbacks
+    def setSentenceAction(self, player_id, sentence):
+        if player_id != self.get_owner_id():
+            raise Exception, "Only game owner can set the sentence."
+        if self.game_state != 'create':
+            raise CardstoriesWarning('WRONG_STATE_FOR_SETTING_SENTENCE', {'game_id': self.get_id(), 'state': self.game_state})
         yield self.service.db.runInteraction(self.setSentenceInteraction, player_id, self.id, sentence)
+        self.game_state = 'invitation'
         result = yield self.touch(type='set_sentence', sentence=sentence)
         event_log.owner_wrote_story(self.service.db, self.get_id(), player_id, sentence)
         defer.returnValue(result)
@@ -345,44 +402,18 @@ class CardstoriesGame(Pollable):
             # win
             win = player[4]
 
+            # players
+            player_info = {'id': player[0],
+                           'cards': player_cards,
+                           'picked': picked,
+                           'vote': vote,
+                           'win': win}
             # Set score, level, and earned cards, but only for the requesting player.
             if player[0] == player_id:
-                score = player[5]
-                score_prev = player[6]
-                level, score_next, score_left = calculate_level(score)
-                level_prev, _, _ = calculate_level(score_prev)
-                if player[7]:
-                    earned_cards = [ord(c) for c in player[7]]
-                else:
-                    earned_cards = None
-                if player[8]:
-                    earned_cards_cur = [ord(c) for c in player[8]]
-                else:
-                    earned_cards_cur = None
+                player_info.update(self.player_scores(*player[5:9]))
             else:
-                score = None
-                level = None
-                score_next = None
-                score_left = None
-                score_prev = None
-                level_prev = None
-                earned_cards = None
-                earned_cards_cur = None
-
-            # players
-            players.append({'id': player[0],
-                            'cards': player_cards,
-                            'picked': picked,
-                            'vote': vote,
-                            'win': win,
-                            'score': score,
-                            'level': level,
-                            'score_next': score_next,
-                            'score_left': score_left,
-                            'score_prev': score_prev,
-                            'level_prev': level_prev,
-                            'earned_cards': earned_cards,
-                            'earned_cards_cur': earned_cards_cur})
+                player_info.update(self.player_scores(None, None, None, None))
+            players.append(player_info)
 
         ready = None
         if state == 'invitation':
@@ -405,36 +436,29 @@ class CardstoriesGame(Pollable):
                             'invited': invited },
                             players_id_list])
 
-    def participateInteraction(self, transaction, game_id, player_id):
-        transaction.execute("SELECT players, cards FROM games WHERE id = %d" % game_id)
-        players, dealt_cards = transaction.fetchone()
-
-        # Bail out if game is full.
-        no_room = CardstoriesWarning('GAME_FULL', {'game_id': game_id, 'player_id': player_id, 'max_players': self.NPLAYERS})
-        if players >= self.NPLAYERS:
-            raise no_room
-
-        # Fetch the player's earned cards and include them in the deck.
-        transaction.execute("SELECT earned_cards FROM players WHERE player_id = %d" % player_id)
-        row = transaction.fetchone()
-        if row:
-            earned_cards = row[0]
-        else:
-            earned_cards = None
-
-        # Deal the cards
-        player_cards, dealt_cards = self.deal(earned_cards, dealt_cards)
+    def participateInteraction(self, transaction, game_id, player_id, earned_cards):
+        # Deal the cards, from the deck of the game and the cards the
+        # player earned. The actions are queued: the dealt cards are up to
+        # date, and they are only updated once the transaction succeeded.
+        player_cards, dealt_cards = self.deal(earned_cards, self.cards, self.dealt)
 
-        transaction.execute("UPDATE games SET cards = ?, players = players + 1 WHERE id = ? AND players = ?", (dealt_cards, game_id, players))
-        if transaction.rowcount == 0:
-            raise no_room
+        transaction.execute("UPDATE games SET cards = ?, players = players + 1 WHERE id = ?", (dealt_cards, game_id))
         transaction.execute("INSERT INTO player2game (game_id, player_id, cards) VALUES (?, ?, ?)", [game_id, player_id, player_cards])
         transaction.execute("DELETE FROM invitations WHERE game_id = ? AND player_id = ?", [game_id, player_id])
+        return (player_cards, dealt_cards)
 
-    @defer.inlineCallbacks
     def participate(self, player_id):
-        yield self.service.db.runInteraction(self.playerInteraction, player_id)
-        yield self.service.db.runInteraction(self.participateInteraction, self.get_id(), player_id)
+        return self.queue(self.participateAction, player_id)
+
+    @defer.inlineCallbacks
+    def participateAction(self, player_id):
+        # The actions are queued: no other player can take the last seat
+        # between this check and the update of the database.
+        if len(self.players) >= self.NPLAYERS:
+            raise CardstoriesWarning('GAME_FULL', {'game_id': self.get_id(), 'player_id': player_id, 'max_players': self.NPLAYERS})
+        earned_cards = yield self.service.db.runInteraction(self.playerInteraction, player_id)
+        player_cards, self.cards = yield self.service.db.runInteraction(self.participateInteraction, self.get_id(), player_id, earned_cards)
+        self.dealt = self.dealt | Deck.fromstring(player_cards)
         if player_id in self.invited:
             self.invited.remove(player_id)
         self.players.append(player_id)
@@ -442,8 +466,13 @@ class CardstoriesGame(Pollable):
         event_log.player_joined(self.service.db, self.get_id(), player_id)
         defer.returnValue(result)
 
-    @defer.inlineCallbacks
     def voting(self, owner_id):
+        return self.queue(self.votingAction, owner_id)
+
+    @defer.inlineCallbacks
+    def votingAction(self, owner_id):
+        if self.game_state != 'invitation':
+            raise CardstoriesWarning('WRONG_STATE_FOR_VOTING_PHASE', {'game_id': self.get_id(), 'state': self.game_state})
         self.clear_countdown()
         game, players_id_list = yield self.game(self.get_owner_id())
         discarded = []
@@ -457,6 +486,7 @@ class CardstoriesGame(Pollable):
         yield self.leave(discarded)
         board = ''.join([chr(card) for card in board])
         yield self.service.db.runOperation("UPDATE games SET board = ?, state = 'vote' WHERE id = ?", [ board, self.get_id() ])
+        self.game_state = 'vote'
         yield self.cancelInvitations()
         self.invited = []
         result = yield self.touch(type='voting')
@@ -472,10 +502,10 @@ class CardstoriesGame(Pollable):
                             'win': rows[0][3] })
 
     def is_countdown_active(self):
-        return hasattr(self, 'countdown_timer') and self.countdown_timer.active()
+        return self.countdown_timer is not None and self.countdown_timer.active()
 
     def get_countdown_duration(self):
-        custom_duration = hasattr(self, 'countdown_duration') and self.countdown_duration
+        custom_duration = self.countdown_duration
         return custom_duration or self.DEFAULT_COUNTDOWN_DURATION
 
     def set_countdown_duration(self, duration):
@@ -494,13 +524,15 @@ class CardstoriesGame(Pollable):
         self.start_countdown()
 
     def clear_countdown(self):
-        if hasattr(self, 'countdown_duration'):
-            del self.countdown_duration
+        self.countdown_duration = None
         if self.is_countdown_active():
             self.countdown_timer.cancel()
 
-    @defer.inlineCallbacks
     def set_countdown(self, duration):
+        return self.queue(self.setCountdownAction, duration)
+
+    @defer.inlineCallbacks
+    def setCountdownAction(self, duration):
         self.set_countdown_duration(duration)
         if self.is_countdown_active():
             self.reset_countdown()
@@ -508,15 +540,15 @@ class CardstoriesGame(Pollable):
         defer.returnValue(result)
 
     def pickInteraction(self, transaction, game_id, player_id, card):
-        transaction.execute("SELECT state, owner_id FROM games WHERE id = ?", [ game_id ])
-        state, owner_id = transaction.fetchone()
-        if state == 'invitation':
-            transaction.execute("UPDATE player2game SET picked = ? WHERE game_id = ? AND player_id = ?", [ chr(card), game_id, player_id ])
-        else:
-            raise CardstoriesWarning('WRONG_STATE_FOR_PICKING', {'game_id': game_id, 'player_id': player_id, 'state': state})
+        transaction.execute("UPDATE player2game SET picked = ? WHERE game_id = ? AND player_id = ?", [ chr(card), game_id, player_id ])
 
-    @defer.inlineCallbacks
     def pick(self, player_id, card):
+        return self.queue(self.pickAction, player_id, card)
+
+    @defer.inlineCallbacks
+    def pickAction(self, player_id, card):
+        if self.game_state != 'invitation':
+            raise CardstoriesWarning('WRONG_STATE_FOR_PICKING', {'game_id': self.get_id(), 'player_id': player_id, 'state': self.game_state})
         yield self.service.db.runInteraction(self.pickInteraction, self.get_id(), player_id, card)
         count = yield self.service.db.runQuery("SELECT COUNT(*) FROM player2game WHERE game_id = ? AND picked IS NOT NULL", [ self.get_id() ])
         if count[0][0] >= self.MIN_PICKED and not self.is_countdown_active():
@@ -526,15 +558,15 @@ class CardstoriesGame(Pollable):
         defer.returnValue(result)
 
     def voteInteraction(self, transaction, game_id, player_id, vote):
-        transaction.execute("SELECT state FROM games WHERE id = ?", [ game_id ])
-        state = transaction.fetchone()[0]
-        if state == 'vote':
-            transaction.execute("UPDATE player2game SET vote = ? WHERE game_id = ? AND player_id = ?", [ chr(vote), game_id, player_id ])
-        else:
-            raise CardstoriesWarning('WRONG_STATE_FOR_VOTING', {'game_id': game_id, 'player_id': player_id, 'state': state})
+        transaction.execute("UPDATE player2game SET vote = ? WHERE game_id = ? AND player_id = ?", [ chr(vote), game_id, player_id ])
 
-    @defer.inlineCallbacks
     def vote(self, player_id, vote):
+        return self.queue(self.voteAction, player_id, vote)
+
+    @defer.inlineCallbacks
+    def voteAction(self, player_id, vote):
+        if self.game_state != 'vote':
+            raise CardstoriesWarning('WRONG_STATE_FOR_VOTING', {'game_id': self.get_id(), 'player_id': player_id, 'state': self.game_state})
         yield self.service.db.runInteraction(self.voteInteraction, self.get_id(), player_id, vote)
         count = yield self.service.db.runQuery("SELECT COUNT(*) FROM player2game WHERE game_id = ? AND vote IS NOT NULL", [ self.get_id() ])
         if count[0][0] >= self.MIN_VOTED and not self.is_countdown_active():
@@ -544,16 +576,21 @@ class CardstoriesGame(Pollable):
         defer.returnValue(result)
 
     def completeInteraction(self, transaction, game_id, owner_id):
-        transaction.execute("SELECT picked FROM player2game WHERE game_id = ? AND player_id = ?", (game_id, owner_id))
-        winner_card = transaction.fetchone()[0]
-        transaction.execute("SELECT vote, picked, player_id FROM player2game WHERE game_id = ? AND player_id != ? AND vote IS NOT NULL", (game_id, owner_id))
+        transaction.execute("SELECT player_id, picked, vote FROM player2game WHERE game_id = ?", [ game_id ])
+        winner_card = None
+        voters = []
+        for (player_id, picked, vote) in transaction.fetchall():
+            if player_id == owner_id:
+                winner_card = picked
+            elif vote is not None:
+                voters.append((player_id, picked, vote))
         players_count = 0
         guessed = []
         failed = []
         score = {}
         player2vote = {}
         pick2player = {}
-        for (vote, picked, player_id) in transaction.fetchall():
+        for (player_id, picked, vote) in voters:
             players_count += 1
             player2vote[player_id] = vote
             pick2player[picked] = player_id
@@ -588,19 +625,18 @@ class CardstoriesGame(Pollable):
             except KeyError:
                 pass
 
-        transaction.execute("UPDATE player2game SET win = 'y' WHERE "
-                            "  game_id = %d AND " % game_id +
-                            "  player_id IN ( %s ) " % ','.join([ str(id) for id in winners ]))
-        transaction.execute("UPDATE games SET completed = datetime('now'), state = 'complete' WHERE id = %d" % game_id)
-
-        for player_id in score.keys():
+        transaction.executemany("UPDATE player2game SET win = 'y' WHERE game_id = ? AND player_id = ?",
+                                [ (game_id, player_id) for player_id in winners ])
+        transaction.execute("UPDATE games SET completed = datetime('now'), state = 'complete' WHERE id = ?", [ game_id ])
+
+        # Read the scores of all the players at once, compute their new
+        # scores and levels in memory, and store them at once.
+        players_ids = score.keys()
+        transaction.execute("SELECT player_id, score, levelups, earned_cards FROM players "
+                            "WHERE player_id IN (%s)" % ','.join('?' * len(players_ids)), players_ids)
+        updates = []
+        for (player_id, score_prev, levelups, earned_cards) in transaction.fetchall():
             # Calculate if level needs to be bumped
-            transaction.execute("SELECT score, levelups, earned_cards FROM players WHERE player_id = %s" % player_id)
-            row = transaction.fetchone()
-            if not row:
-                continue
-            score_prev, levelups, earned_cards = row
-
             level_prev, _, _ = calculate_level(score_prev)
             score_cur = score_prev + score[player_id]
             level_cur, _, _ = calculate_level(score_cur)
@@ -631,45 +667,106 @@ class CardstoriesGame(Pollable):
                         earned_cards_cur.append(card)
                         levelups += 1
 
-            # Store it
-            transaction.execute("UPDATE players SET "
+            updates.append((score_cur,
+                            levelups,
+                            ''.join(earned_cards),
+                            ''.join(earned_cards_cur),
+                            player_id))
+
+        # Store them
+        transaction.executemany("UPDATE players SET "
                                 "score_prev = score, "
                                 "score = ?, "
                                 "levelups = ?, "
                                 "earned_cards = ?, "
                                 "earned_cards_cur = ? "
                                 "WHERE player_id = ?",
-                                (score_cur,
-                                 levelups,
-                                 ''.join(earned_cards),
-                                 ''.join(earned_cards_cur),
-                                 player_id))
+                                updates)
 
-    @defer.inlineCallbacks
     def complete(self, owner_id):
+        return self.queue(self.completeAction, owner_id)
+
+    @defer.inlineCallbacks
+    def completeAction(self, owner_id):
+        if self.game_state != 'vote':
+            raise CardstoriesWarning('WRONG_STATE_FOR_COMPLETING', {'game_id': self.get_id(), 'state': self.game_state})
         self.clear_countdown()
-        game, players_id_list = yield self.game(self.get_owner_id())
         yield self.service.db.runInteraction(self.completeInteraction, self.get_id(), owner_id)
+        self.game_state = 'complete'
+        render = yield self.game(None)
         result = yield self.touch(type='complete')
         event_log.game_completed(self.service.db, self.get_id(), owner_id)
+        self.cache_render(render)
         self.destroy()
         defer.returnValue(result)
 
+    def cache_render(self, render):
+        '''Keeps the render of the game for the players not participating in it,
+        now that it won't change anymore (see CardstoriesService.finished_game)'''
+
+        game_info, players_id_list = render
+        game_info['modified'] = self.get_modified()
+        if self.service is not None:
+            self.service.cache_finished_game(game_info, players_id_list, None)
+
     def cancelInvitations(self):
         return self.service.db.runQuery("DELETE FROM invitations WHERE game_id = ?", [ self.get_id() ])
 
-    @defer.inlineCallbacks
     def invite(self, player_ids):
+        return self.queue(self.inviteAction, player_ids)
+
+    def inviteInteraction(self, transaction, game_id, owner_id, player_ids):
+        transaction.executemany("INSERT INTO invitations (player_id, game_id) VALUES (?, ?)",
+                                [ (player_id, game_id) for player_id in player_ids ])
+        event_log.players_invited(transaction, game_id, owner_id, player_ids)
+
+    @defer.inlineCallbacks
+    def inviteAction(self, player_ids):
         invited = []
         for player_id in player_ids:
-            if player_id not in self.invited:
+            if player_id not in self.invited and player_id not in invited:
                 invited.append(player_id)
-                yield self.service.db.runQuery("INSERT INTO invitations (player_id, game_id) VALUES (?, ?)", [ player_id, self.get_id() ])
-                event_log.player_invited(self.service.db, self.get_id(), self.get_owner_id(), player_id)
+        # All the invitations are stored at once and the game is touched
+        # once, whatever the number of players invited.
+        if invited:
+            yield self.service.db.runInteraction(self.inviteInteraction, self.get_id(), self.get_owner_id(), invited)
         self.invited += invited
         result = yield self.touch(type='invite', invited=invited)
         defer.returnValue(result)
 
+    @staticmethod
+    def player_scores(score, score_prev, earned_cards, earned_cards_cur):
+        '''Score, level, and earned cards of a player, as shown to himself,
+        from the corresponding columns of the players table'''
+
+        if score is None:
+            return {'score': None,
+                    'level': None,
+                    'score_next': None,
+                    'score_left': None,
+                    'score_prev': None,
+                    'level_prev': None,
+                    'earned_cards': None,
+                    'earned_cards_cur': None}
+        level, score_next, score_left = calculate_level(score)
+        level_prev, _, _ = calculate_level(score_prev)
+        if earned_cards:
+            earned_cards = [ord(c) for c in earned_cards]
+        else:
+            earned_cards = None
+        if earned_cards_cur:
+            earned_cards_cur = [ord(c) for c in earned_cards_cur]
+        else:
+            earned_cards_cur = None
+        return {'score': score,
+                'level': level,
+                'score_next': score_next,
+                'score_left': score_left,
+                'score_prev': score_prev,
+                'level_prev': level_prev,
+                'earned_cards': earned_cards,
+                'earned_cards_cur': earned_cards_cur}
+
     @staticmethod
     def ord(c):
         if c:
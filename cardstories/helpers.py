@@ -23,12 +23,185 @@
 
 # Imports ####################################################################
 
+import copy, json, os, re
+
 from twisted.internet import defer
 from cardstories.exceptions import CardstoriesException
 
 
+# Constants ##################################################################
+
+# Depth of the lists and dictionaries in which dumps() looks for the values
+# already encoded: the states of a response (1), the players of players_info
+# or the list of the messages of the chat (2), and their items (3).
+SPLICE_DEPTH = 3
+
+
+# Functions ##################################################################
+
+def gather(deferreds):
+    """
+    Waits for all the deferreds to fire, and returns a deferred which
+    results in the list of their results, in the same order.
+    If any of them fails, the returned deferred fails with the first error
+    (instead of a FirstError wrapper), and the other errors are consumed.
+    """
+
+    d = defer.DeferredList(deferreds, fireOnOneErrback=True, consumeErrors=True)
+    def success(results):
+        return [result for (succeeded, result) in results]
+    def error(reason):
+        reason.trap(defer.FirstError)
+        return reason.value.subFailure
+    d.addCallbacks(success, error)
+    return d
+
+def normalize_args(args):
+    """
+    Converts JSON decoded arguments into request.args, as twisted.web
+    would have parsed them from the query string.
+    """
+
+    normalized = {}
+    for key, values in args.iteritems():
+        if not isinstance(values, list):
+            values = [values]
+        normalized[str(key)] = [unicode(value).encode('utf-8') for value in values]
+    return normalized
+
+def dumps(value):
+    """
+    Encodes value in JSON, as json.dumps does, except that the Serialized
+    values and the encodings kept by the Fragment dictionaries are spliced
+    as they are, instead of being encoded again. They are only looked for
+    in the first levels of value (see SPLICE_DEPTH).
+    """
+
+    fragments = []
+    tag = os.urandom(4).encode('hex')
+    def substitute(value, depth):
+        if isinstance(value, Serialized):
+            fragments.append(str(value))
+        elif isinstance(value, Fragment):
+            fragments.append(value.serialize())
+        elif depth < SPLICE_DEPTH and type(value) is list:
+            items = [substitute(item, depth + 1) for item in value]
+            for (item, original) in zip(items, value):
+                if item is not original:
+                    return items
+            return value
+        elif depth < SPLICE_DEPTH and type(value) is dict:
+            # Only copied if a fragment was found, to encode the other
+            # dictionaries in the same order as json.dumps.
+            substituted = value
+            for (key, original) in value.iteritems():
+                item = substitute(original, depth + 1)
+                if item is not original:
+                    if substituted is value:
+                        substituted = value.copy()
+                    substituted[key] = item
+            return substituted
+        else:
+            return value
+        # Placeholder, replaced by the fragment once value is encoded.
+        return u'\x00%s%d' % (tag, len(fragments) - 1)
+
+    value = substitute(value, 0)
+    content = json.dumps(value)
+    if fragments:
+        content = re.sub(r'"\\u0000%s(\d+)"' % tag,
+                         lambda match: fragments[int(match.group(1))],
+                         content)
+    return content
+
+
 # Classes ####################################################################
 
+class Serialized(str):
+    """
+    Result of an action which is already encoded in JSON: it is sent as it
+    is, instead of being encoded again for each request. Its MessagePack
+    encoding and its compressed versions are kept as well (see
+    CardstoriesResource.pack and CardstoriesResource.compress).
+    """
+
+    packed = None
+    compressed = None
+
+
+class Fragment(dict):
+    """
+    Dictionary which keeps its JSON encoding, to be spliced in the responses
+    by dumps(). Replacing or removing a key discards the encoding, while
+    the keys added afterwards are encoded on their own. The values must not
+    be modified in place.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.encoded = None
+        self.added = []
+
+    def invalidate(self):
+        self.encoded = None
+        self.added = []
+
+    def serialize(self):
+        if self.encoded is None:
+            self.encoded = json.dumps(self)
+            self.added = []
+        if not self.added:
+            return self.encoded
+        added = ', '.join(['%s: %s' % (json.dumps(unicode(key)), dumps(self[key])) for key in self.added])
+        if self.encoded == '{}':
+            return '{' + added + '}'
+        return self.encoded[:-1] + ', ' + added + '}'
+
+    def __setitem__(self, key, value):
+        if self.encoded is not None:
+            if key in self:
+                self.invalidate()
+            else:
+                self.added.append(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.invalidate()
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for (key, value) in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, *args):
+        self.invalidate()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.invalidate()
+        return dict.popitem(self)
+
+    def clear(self):
+        self.invalidate()
+        dict.clear(self)
+
+    def copy(self):
+        fragment = Fragment(self)
+        fragment.encoded = self.encoded
+        fragment.added = list(self.added)
+        return fragment
+
+    def __deepcopy__(self, memo):
+        fragment = Fragment(copy.deepcopy(dict(self), memo))
+        fragment.encoded = self.serialize()
+        return fragment
+
+
 class Lockable(object):
     """
     Allow the object to check that some portions of its code are not executed
@@ -20,12 +20,47 @@
 # along with this program in a file in the toplevel directory called
 # "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
 #
+from bisect import bisect_right
 from math import ceil
 
+import numpy
+
 LEVEL_A = 0.5
 LEVEL_B = 1.5
 LEVEL_C = 3.5
 
+# Cumulative score thresholds: _thresholds[i] is the total score a player
+# needs to reach level i + 2. By convention, reaching level 2 takes one point.
+# The table is computed from LEVEL_A/B/C, extended lazily as higher scores
+# are looked up, and rebuilt if the constants are retuned.
+_thresholds = [1]
+_constants = None
+
+def to_next(level):
+    """Returns the number of points needed to go from level to level + 1
+    (for levels >= 2)."""
+
+    return int(ceil(LEVEL_A * level ** 3 + \
+                    LEVEL_B * level ** 2 + \
+                    LEVEL_C * level))
+
+def thresholds(score):
+    """Returns the table of cumulative score thresholds, extended so that
+    it covers the provided score (i.e. its last element is greater than score).
+    The returned list must not be modified by the caller."""
+
+    global _thresholds, _constants
+
+    if _constants != (LEVEL_A, LEVEL_B, LEVEL_C):
+        _thresholds = [1]
+        _constants = (LEVEL_A, LEVEL_B, LEVEL_C)
+
+    while _thresholds[-1] <= score:
+        level = len(_thresholds) + 1
+        _thresholds.append(_thresholds[-1] + to_next(level))
+
+    return _thresholds
+
 def calculate_level(score):
     """Takes player's score and returns calcualted current level,
     total score needed to reach the next level, and the number of points
@@ -43,18 +78,29 @@ def calculate_level(score):
     # due to this tunable nature, levels are not stored on the
     # database, but calculated whenever a request is made.
     else:
-        to_next = lambda l: int(ceil(LEVEL_A * l ** 3 + \
-                                     LEVEL_B * l ** 2 + \
-                                     LEVEL_C * l))
-        level = 2
-        remainder = score - 1
-        score_next = to_next(level)
-        while remainder >= score_next:
-            remainder -= score_next
-            level += 1
-            score_next = to_next(level)
-
-        score_left = score_next - remainder
+        table = thresholds(score)
+        # Number of thresholds already reached by the player.
+        reached = bisect_right(table, score)
+        level = reached + 1
+        score_next = table[reached] - table[reached - 1]
+        score_left = table[reached] - score
 
     return level, score_next, score_left
 
+def calculate_levels(scores):
+    """Same as calculate_level(), for a list of scores at once.
+    Returns a list of (level, score_next, score_left) tuples, in the
+    same order as the scores. The thresholds of all the scores are
+    looked up at once, with numpy.searchsorted."""
+
+    scores = numpy.array([score or 0 for score in scores], dtype=numpy.int64)
+    if len(scores) == 0:
+        return []
+    scores = numpy.maximum(scores, 0)
+    # Preceded by 0, so that a score of 0 is one point away from level 2,
+    # as in calculate_level(): the number of thresholds reached is the level.
+    table = numpy.array([0] + thresholds(scores.max()), dtype=numpy.int64)
+    level = numpy.searchsorted(table, scores, side='right')
+    score_next = table[level] - table[level - 1]
+    score_left = table[level] - scores
+    return zip(level.tolist(), score_next.tolist(), score_left.tolist())
@@ -20,20 +20,26 @@
 # along with this program in a file in the toplevel directory called
 # "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
 #
+import gc
+
 from twisted.python import runtime
 from twisted.internet import reactor, defer
 from copy import deepcopy
 
-class Pollable:
+class Pollable(object):
+
+    # The subclasses with many instances (games, tables) define their
+    # attributes as __slots__ as well, to do without an instance __dict__.
+    # There is no __del__: the owner of a pollable calls destroy() when
+    # it drops it (a finalizer would make the cycles it is part of
+    # uncollectable, see leaks()).
+    __slots__ = ('timeout', 'pollers', 'modified')
 
     def __init__(self, timeout):
         self.timeout = timeout
         self.pollers = []
         self.modified = int(runtime.seconds() * 1000)
 
-    def __del__(self):
-        self.destroy()
-
     def get_modified(self, args=None):
         return self.modified
 
@@ -104,3 +110,21 @@ class Pollable:
             return reason
         d.addCallbacks(success, error)
         return d
+
+def leaks():
+    '''Counts the Pollable instances still alive, by class, and the objects
+    the garbage collector found in cycles but could not free (gc.garbage),
+    by type. A destroyed game or table that is still counted after its
+    owner dropped it is referenced from somewhere it should not be.'''
+
+    gc.collect()
+    pollables = {}
+    for obj in gc.get_objects():
+        if isinstance(obj, Pollable):
+            name = obj.__class__.__module__ + '.' + obj.__class__.__name__
+            pollables[name] = pollables.get(name, 0) + 1
+    garbage = {}
+    for obj in gc.garbage:
+        name = type(obj).__name__
+        garbage[name] = garbage.get(name, 0) + 1
+    return {'pollables': pollables, 'garbage': garbage}
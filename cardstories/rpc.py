@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Imports ####################################################################
+
+import json
+
+from twisted.internet import defer, protocol
+from twisted.protocols import amp
+
+from cardstories.helpers import Serialized, normalize_args
+
+
+# Arguments ##################################################################
+
+class JSON(amp.Argument):
+    """
+    JSON encoded argument. AMP values can't be longer than 64K, so the
+    encoded value is split in as many chunks as needed: the argument
+    itself holds the number of chunks, stored as name.0, name.1, etc.
+    """
+
+    def fromBox(self, name, strings, objects, proto):
+        count = int(strings[name])
+        value = ''.join([strings['%s.%d' % (name, i)] for i in xrange(count)])
+        objects[name] = json.loads(value)
+
+    def toBox(self, name, strings, objects, proto):
+        value = json.dumps(objects[name])
+        chunks = [value[i:i + amp.MAX_VALUE_LENGTH] for i in xrange(0, len(value), amp.MAX_VALUE_LENGTH)]
+        strings[name] = str(len(chunks))
+        for i, chunk in enumerate(chunks):
+            strings['%s.%d' % (name, i)] = chunk
+
+
+# Commands ###################################################################
+
+class Handle(amp.Command):
+    """
+    Handles a batch of calls, each of them the equivalent of an HTTP request
+    to /resource or /internal: {'path': 'resource', 'args': {'action': ['state'], ...}}.
+    The results are in the same order as the calls: {'result': ...} or,
+    if the call failed, {'error': traceback}.
+    """
+
+    arguments = [('calls', JSON())]
+    response = [('results', JSON())]
+
+
+# Classes ####################################################################
+
+class CardstoriesRPCRequest(object):
+    """
+    Stands for the HTTP request given to the resources and to the plugins,
+    for the calls received through the RPC channel. As for the requests
+    made by django over HTTP, there is no session cookie.
+    """
+
+    def __init__(self, site, args):
+        self.site = site
+        self.args = args
+        self._disconnected = False
+
+    def getCookie(self, key):
+        return None
+
+
+class CardstoriesRPC(amp.AMP):
+    """
+    RPC channel with the django application, to be served over a unix
+    socket. Several calls can be in flight at the same time on the same
+    connection, and each Handle command can hold a batch of calls.
+    """
+
+    def __init__(self, site):
+        amp.AMP.__init__(self)
+        self.site = site
+
+    def call(self, path, args):
+        resource = self.site.resource.children[path]
+        request = CardstoriesRPCRequest(self.site, normalize_args(args))
+        return resource.process(request)
+
+    @Handle.responder
+    def handle(self, calls):
+        deferreds = []
+        for call in calls:
+            deferreds.append(defer.maybeDeferred(self.call, str(call['path']), call.get('args', {})))
+        d = defer.DeferredList(deferreds, consumeErrors=True)
+        def collect(results):
+            collected = []
+            for (success, result) in results:
+                if success:
+                    if isinstance(result, Serialized):
+                        result = json.loads(result)
+                    collected.append({'result': result})
+                else:
+                    result.printTraceback()
+                    collected.append({'error': result.getTraceback()})
+            return {'results': collected}
+        d.addCallback(collect)
+        return d
+
+
+class CardstoriesRPCFactory(protocol.ServerFactory):
+
+    def __init__(self, site):
+        self.site = site
+
+    def buildProtocol(self, addr):
+        return CardstoriesRPC(self.site)
@@ -24,24 +24,25 @@
 # along with this program in a file in the toplevel directory called
 # "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
 #
-import os, traceback
+import os, traceback, copy, json
 
 from twisted.python import failure, runtime
 from twisted.application import service
 from twisted.internet import reactor, defer
-from twisted.enterprise import adbapi
 from twisted.python import log
 
-from cardstories.levels import calculate_level
+from cardstories.levels import calculate_levels
 from cardstories.game import CardstoriesGame
-from cardstories.helpers import Observable
+from cardstories.helpers import Observable, Serialized, Fragment, dumps, normalize_args
+from cardstories.cache import LRUCache
+from cardstories.database import ConnectionPool
 from cardstories.exceptions import CardstoriesWarning, CardstoriesException
 
 #from OpenSSL import SSL
 
 import sqlite3
 
-from cardstories.poll import Pollable
+from cardstories.poll import Pollable, leaks as pollable_leaks
 from cardstories.auth import Auth
 
 
@@ -102,13 +103,29 @@ class CardstoriesService(service.Service, Observable):
 
     ACTIONS_GAME = ('set_card', 'set_sentence', 'participate', 'voting', 'pick', 'vote',
                     'complete', 'invite', 'set_countdown')
-    ACTIONS = ACTIONS_GAME + ('create', 'poll', 'state', 'player_info', 'close_tab_action')
+    ACTIONS = ACTIONS_GAME + ('create', 'poll', 'spectate', 'state', 'player_info', 'close_tab_action')
+    # Wait for the game to change: in a batch, they would hold the actions after them.
+    ACTIONS_NOT_BATCHED = ('poll', 'spectate')
 
-    ACTIONS_INTERNAL = ('grant_cards_to_player')
+    ACTIONS_INTERNAL = ('grant_cards_to_player', 'leaks')
+
+    PLAYERS_FRAGMENTS = 10000
+    RECENT_REQUESTS = 10000
+    RECENT_REQUESTS_TTL = 600
 
     def __init__(self, settings):
         self.settings = settings
         self.games = {}
+        # Renders of the completed and canceled games, see finished_game()
+        self.finished_games = LRUCache(int(settings.get('finished-games-cache', 1000)))
+        # Views of the games sent to the spectators, see spectator_view()
+        self.spectator_views = LRUCache(int(settings.get('spectator-views-cache', 1000)))
+        # Spectators waiting on all the games, kept up to date by the games
+        self.spectators_count = 0
+        # Encoded infos of the players, see player_info_fragment()
+        self.players_fragments = LRUCache(self.PLAYERS_FRAGMENTS)
+        # Results of the game actions sent with a request_id, see run_once()
+        self.recent_requests = LRUCache(self.RECENT_REQUESTS, ttl=self.RECENT_REQUESTS_TTL)
         self.observers = []
         self.pollable_plugins = []
         self.auth = Auth() # to be overriden by an auth plugin (contains unimplemented interfaces)
@@ -125,7 +142,10 @@ class CardstoriesService(service.Service, Observable):
             db.commit()
         c.close()
         db.close()
-        self.db = adbapi.ConnectionPool("sqlite3", database=database, cp_noisy=True, check_same_thread=False)
+        # Interactions failing because another writer holds the lock are
+        # retried until the deadline, see cardstories.database.
+        self.db = ConnectionPool(database=database, cp_noisy=True, check_same_thread=False,
+                                 retry_deadline=float(self.settings.get('db-retry-deadline', ConnectionPool.RETRY_DEADLINE)))
         self.notify({'type': 'start'})
 
     @defer.inlineCallbacks
@@ -262,6 +282,66 @@ class CardstoriesService(service.Service, Observable):
 
         return d
 
+    @defer.inlineCallbacks
+    def spectate(self, args):
+        '''Long poll of the visitors who are not players of the game. Returns
+        the state of the game, as seen by an anonymous visitor, as soon as it
+        is more recent than args['modified']. The spectators of a game are
+        counted separately from the pollers, and are limited by the
+        spectators-per-game and spectators-max settings.'''
+
+        self.required(args, 'spectate', 'modified')
+        game_id = self.required_game_id(args)
+        if self.games.has_key(game_id):
+            game = self.games[game_id]
+            if int(args['modified'][0]) >= game.get_modified():
+                if len(game.spectators) >= int(self.settings.get('spectators-per-game', 1000)) or \
+                        self.count_spectators() >= int(self.settings.get('spectators-max', 10000)):
+                    raise CardstoriesWarning('TOO_MANY_SPECTATORS', {'game_id': game_id})
+                yield game.spectate()
+        view = yield self.spectator_view(game_id)
+        defer.returnValue(view)
+
+    def count_spectators(self):
+        return self.spectators_count
+
+    def spectator_view(self, game_id):
+        '''Returns the state of the game for the spectators, serialized in
+        JSON. It is rendered once for each modification of the game, and
+        the same content is returned to all spectators.'''
+
+        if self.games.has_key(game_id):
+            modified = self.games[game_id].get_modified()
+        else:
+            modified = None # completed or canceled, it won't change
+        view = self.spectator_views.get(game_id)
+        if view is None or view['modified'] != modified:
+            view = {'modified': modified, 'content': None, 'waiters': []}
+            self.spectator_views.set(game_id, view)
+            d = self.state({'action': ['state'],
+                            'type': ['game'],
+                            'game_id': [game_id],
+                            'modified': [0]})
+            def success(states):
+                view['content'] = Serialized(dumps(states))
+                waiters = view['waiters']
+                view['waiters'] = []
+                for waiter in waiters:
+                    waiter.callback(view['content'])
+            def error(reason):
+                if self.spectator_views.get(game_id) is view:
+                    self.spectator_views.delete(game_id)
+                waiters = view['waiters']
+                view['waiters'] = []
+                for waiter in waiters:
+                    waiter.errback(reason)
+            d.addCallbacks(success, error)
+        if view['content'] is not None:
+            return defer.succeed(view['content'])
+        waiter = defer.Deferred()
+        view['waiters'].append(waiter)
+        return waiter
+
     def poll_tabs(self, args):
         """
         Gets the games that should be monitored as tabs by the current user,
@@ -391,31 +471,49 @@ class CardstoriesService(service.Service, Observable):
     @defer.inlineCallbacks
     def update_players_info(self, players_info, players_id_list):
         '''Add new player ids as key to players_info dict, from players_list'''
+        # Only fetch the players not yet referenced.
+        missing_ids = []
+        for player_id in players_id_list:
+            if str(player_id) not in players_info and player_id not in missing_ids:
+                missing_ids.append(player_id)
+        if not missing_ids:
+            defer.returnValue(players_info)
+
         # Python's DB-API doesn't support interpolating lists into SQL's "WHERE x IN (...)" statements,
         # so we have to generate the correct number of '?' placeholders programatically.
-        format_strings = ','.join(['?'] * len(players_id_list))
+        format_strings = ','.join(['?'] * len(missing_ids))
         sql_statement = 'SELECT player_id, score FROM players WHERE player_id IN (%s)' % format_strings
-        rows = yield self.db.runQuery(sql_statement, players_id_list)
+        rows = yield self.db.runQuery(sql_statement, missing_ids)
         # Build up a dict of {player_id: player_level} key-value pairs.
         levels = {}
-        for row in rows:
-            level, _, _ = calculate_level(row[1])
+        for row, (level, _, _) in zip(rows, calculate_levels([row[1] for row in rows])):
             levels[row[0]] = level
 
-        for player_id in players_id_list:
-            if player_id not in players_info:
-                info = {}
-                if levels.has_key(player_id):
-                    info['level'] = levels[player_id]
-                try:
-                    info['name'] = yield self.auth.get_player_name(player_id)
-                    info['avatar_url'] = yield self.auth.get_player_avatar_url(player_id)
-                except Exception as e:
-                    raise CardstoriesException('Failed fetching player data (player_id=%s): %s' % (player_id, e))
-                players_info[str(player_id)] = info
+        # Resolve the names and avatars of all the players with a single auth call.
+        try:
+            infos = yield self.auth.get_players_info(missing_ids)
+        except Exception as e:
+            raise CardstoriesException('Failed fetching player data (player_id=%s): %s' % (','.join([str(id) for id in missing_ids]), e))
+        for player_id, info in zip(missing_ids, infos):
+            info = dict(info)
+            if levels.has_key(player_id):
+                info['level'] = levels[player_id]
+            players_info[str(player_id)] = self.player_info_fragment(player_id, info)
 
         defer.returnValue(players_info)
 
+    def player_info_fragment(self, player_id, info):
+        '''Returns a copy of info which keeps its JSON encoding. The encoding
+        is reused by the following calls for the same player, as long as
+        his info doesn't change.'''
+
+        fragment = self.players_fragments.get(player_id)
+        if fragment is None or fragment != info:
+            fragment = Fragment(info)
+            fragment.serialize()
+            self.players_fragments.set(player_id, fragment)
+        return fragment.copy()
+
     @defer.inlineCallbacks
     def player_info(self, args):
         '''Process requests to retreive player_info for a player_id'''
@@ -427,10 +525,11 @@ class CardstoriesService(service.Service, Observable):
         defer.returnValue([players_info])
 
     @defer.inlineCallbacks
-    def state(self, args):
+    def state(self, args, players_info=None):
         self.required(args, 'state', 'type', 'modified')
         states = []
-        players_info = {'type': 'players_info'} # Keep track of all players being referenced
+        if players_info is None:
+            players_info = {'type': 'players_info'} # Keep track of all players being referenced
 
         if 'game' in args['type']:
             game_args = {'action': 'game',
@@ -538,13 +637,51 @@ class CardstoriesService(service.Service, Observable):
         if self.games.has_key(game_id):
             return self.games[game_id].game(player_id)
         else:
-            game = CardstoriesGame(self, game_id)
-            d = game.game(player_id)
-            def destroy(game_info):
-                game.destroy()
-                return game_info
-            d.addCallback(destroy)
-            return d
+            return self.finished_game(game_id, player_id)
+
+    @defer.inlineCallbacks
+    def finished_game(self, game_id, player_id):
+        '''Renders a game that is not in memory, i.e. completed or canceled.
+        As these games never change, their renders are kept in the
+        finished_games cache, for each viewer role: one for each player of
+        the game, and one for everyone else. Only the scores of the player,
+        which change with his next games, are read again.'''
+
+        entry = self.finished_games.get(game_id)
+        if entry:
+            role = player_id in entry['players'] and player_id or None
+            if entry['renders'].has_key(role):
+                game_info, players_id_list = copy.deepcopy(entry['renders'][role])
+                if role is not None:
+                    rows = yield self.db.runQuery("SELECT score, score_prev, earned_cards, earned_cards_cur "
+                                                  "FROM players WHERE player_id = ?", [ player_id ])
+                    if rows:
+                        for player in game_info['players']:
+                            if player['id'] == player_id:
+                                player.update(CardstoriesGame.player_scores(*rows[0]))
+                defer.returnValue([game_info, players_id_list])
+
+        game = CardstoriesGame(self, game_id)
+        try:
+            game_info, players_id_list = yield game.game(player_id)
+        finally:
+            game.destroy()
+        self.cache_finished_game(game_info, players_id_list, player_id)
+        defer.returnValue([game_info, players_id_list])
+
+    def cache_finished_game(self, game_info, players_id_list, player_id):
+        if game_info['state'] not in ('complete', 'canceled'):
+            return
+        entry = self.finished_games.get(game_info['id'])
+        if not entry:
+            entry = {'players': set(players_id_list), 'renders': {}}
+            self.finished_games.set(game_info['id'], entry)
+        role = player_id in entry['players'] and player_id or None
+        game_info, players_id_list = copy.deepcopy([game_info, players_id_list])
+        if role is None:
+            # The anonymous render is returned as it is: keep its encoding.
+            game_info = Fragment(game_info)
+        entry['renders'][role] = [game_info, players_id_list]
 
     def game_method(self, game_id, action, *args, **kwargs):
         if not self.games.has_key(game_id):
@@ -645,25 +782,126 @@ class CardstoriesService(service.Service, Observable):
         yield self.db.runInteraction(self.grantCardsInteraction, player_id, card_ids)
         defer.returnValue({'status': 'success'})
 
+    def leaks(self, args):
+        '''Debug view of the memory: the live pollables (see poll.leaks)
+        and the number of games the service holds'''
+
+        result = pollable_leaks()
+        result['games'] = len(self.games)
+        return defer.succeed(result)
+
+    @staticmethod
+    def action_error(reason):
+        error = reason.value
+        log.err(reason)
+        if reason.type is CardstoriesWarning:
+            return {'error': {'code': error.code, 'data': error.data}}
+        else:
+            tb = error.args[0]
+            tb += '\n\n'
+            tb += ''.join(traceback.format_tb(reason.getTracebackObject()))
+            return {'error': {'code': 'PANIC', 'data': tb}}
+
+    @defer.inlineCallbacks
+    def batch(self, args, internal_request=False):
+        '''Handles several actions in a row, for a single request. They are
+        given as a JSON list in args['batch'], e.g.
+        [{"action": "pick", "card": 3}, {"action": "state", "type": "game", "modified": 0}]
+        and get the other arguments of the request (player_id, game_id...)
+        unless they override them. The player_id and owner_id of the request,
+        checked once by the auth plugin, are the only ones they can use.
+        The state actions share the same players_info. The actions that wait
+        for a change (ACTIONS_NOT_BATCHED) must be sent on their own.
+        Returns the list of their results, which ends with the first error.'''
+
+        self.required(args, 'batch', 'batch')
+        try:
+            actions = json.loads(args['batch'][0])
+        except ValueError:
+            raise CardstoriesException, 'batch is not a valid JSON list'
+        if not isinstance(actions, list):
+            raise CardstoriesException, 'batch is not a valid JSON list'
+        shared_args = dict([(key, values) for (key, values) in args.iteritems() if key not in ('action', 'batch')])
+        players_info = {'type': 'players_info'}
+        results = []
+        for action_args in actions:
+            action_args = dict(shared_args, **normalize_args(action_args))
+            self.required(action_args, 'batch', 'action')
+            for key in ('player_id', 'owner_id'):
+                for value in action_args.get(key, []):
+                    if value not in args.get(key, []):
+                        raise CardstoriesException, "Action batch can't use %s %s, it isn't one of the request" % (key, value)
+            if action_args.get('action') == ['batch']:
+                raise CardstoriesException, "Action batch can't be nested"
+            if action_args['action'][0] in self.ACTIONS_NOT_BATCHED:
+                raise CardstoriesException, "Action batch can't hold %s, it must be sent on its own" % action_args['action'][0]
+            if action_args.get('action') == ['state']:
+                d = defer.maybeDeferred(self.state, action_args, players_info)
+                d.addErrback(self.action_error)
+            else:
+                d = self.handle(None, action_args, internal_request)
+            result = yield d
+            results.append(result)
+            if isinstance(result, dict) and 'error' in result:
+                break
+        defer.returnValue(results)
+
+    def run_once(self, action, args):
+        '''Runs a game action sent with a request_id, unless the same player
+        already sent it for the same game: a client retrying a request it didn't get the answer
+        of gets the result of the first one, without modifying the game
+        again. The results are kept for RECENT_REQUESTS_TTL seconds, and
+        only when the action succeeded.'''
+
+        player_id = args.get('owner_id', args.get('player_id', [None]))[0]
+        if player_id is None:
+            return defer.maybeDeferred(getattr(self, action), args)
+        key = (str(player_id), self.required_game_id(args), action, args['request_id'][0])
+        request = self.recent_requests.get(key)
+        if request is None:
+            request = {'done': False, 'result': None, 'waiters': []}
+            self.recent_requests.set(key, request)
+            d = defer.maybeDeferred(getattr(self, action), args)
+            def success(result):
+                request['done'] = True
+                request['result'] = result
+                waiters = request['waiters']
+                request['waiters'] = []
+                for waiter in waiters:
+                    waiter.callback(copy.deepcopy(result))
+                return result
+            def error(reason):
+                if self.recent_requests.get(key) is request:
+                    self.recent_requests.delete(key)
+                waiters = request['waiters']
+                request['waiters'] = []
+                for waiter in waiters:
+                    waiter.errback(reason)
+                return reason
+            d.addCallbacks(success, error)
+            return d
+        if request['done']:
+            return defer.succeed(copy.deepcopy(request['result']))
+        waiter = defer.Deferred()
+        request['waiters'].append(waiter)
+        return waiter
 
     def handle(self, result, args, internal_request=False):
         if not args.has_key('action'):
             return defer.succeed(result)
         try:
             action = args['action'][0]
-            if action in self.ACTIONS or (internal_request and action in self.ACTIONS_INTERNAL):
+            if action == 'batch':
+                d = self.batch(args, internal_request)
+                d.addErrback(self.action_error)
+                return d
+            elif action in self.ACTIONS_GAME and args.has_key('request_id'):
+                d = self.run_once(action, args)
+                d.addErrback(self.action_error)
+                return d
+            elif action in self.ACTIONS or (internal_request and action in self.ACTIONS_INTERNAL):
                 d = getattr(self, action)(args)
-                def error(reason):
-                    error = reason.value
-                    log.err(reason)
-                    if reason.type is CardstoriesWarning:
-                        return {'error': {'code': error.code, 'data': error.data}}
-                    else:
-                        tb = error.args[0]
-                        tb += '\n\n'
-                        tb += ''.join(traceback.format_tb(reason.getTracebackObject()))
-                        return {'error': {'code': 'PANIC', 'data': tb}}
-                d.addErrback(error)
+                d.addErrback(self.action_error)
                 return d
             else:
                 raise CardstoriesException, 'Unknown action: %s' % action
@@ -22,13 +22,24 @@
 # along with this program in a file in the toplevel directory called
 # "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
 #
-import json
+import hashlib, gzip, zlib, json
+from cStringIO import StringIO
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 from twisted.web import server, resource, static, http
 from twisted.internet import defer
 from twisted.python import urlpath, log
 
+from cardstories.helpers import dumps, Serialized
+from cardstories.cache import LRUCache
+
 class CardstoriesSite(server.Site):
 
+    # Number of compressed cacheable responses kept, see CardstoriesResource.compress
+    COMPRESSED_CACHE_SIZE = 1000
+
     def __init__(self, resource, settings, plugins, **kwargs):
         self.plugins = plugins
         name2plugin = {}
@@ -40,10 +51,47 @@ class CardstoriesSite(server.Site):
         self.postprocess = []
         for plugin in settings.get('plugins-post-process', '').split():
             self.postprocess.append(name2plugin[plugin])
+        self.preprocess_dispatch = self.dispatch(self.preprocess, 'preprocess_actions')
+        self.postprocess_dispatch = self.dispatch(self.postprocess, 'postprocess_actions')
+        # Responses smaller than the threshold are not compressed, and
+        # a level of 0 disables compression.
+        self.compression_threshold = int(settings.get('compression-threshold', 1024))
+        self.compression_level = int(settings.get('compression-level', 6))
+        self.compressed = LRUCache(self.COMPRESSED_CACHE_SIZE)
         server.Site.__init__(self, resource, **kwargs)
 
+    @staticmethod
+    def dispatch(plugins, attribute):
+        '''Builds the table of the plugins to run for each action, in the
+        order of plugins. A plugin only runs for the actions listed by its
+        attribute, e.g. preprocess_actions = ('message',), or for all the
+        actions if it doesn't define it. The plugins for the actions that
+        are not in the table are stored under None.'''
+
+        actions = set()
+        for plugin in plugins:
+            actions.update(getattr(plugin, attribute, None) or ())
+        table = {}
+        for action in list(actions) + [None]:
+            table[action] = [plugin for plugin in plugins
+                             if getattr(plugin, attribute, None) is None or action in getattr(plugin, attribute)]
+        return table
+
+    def preprocess_plugins(self, action):
+        return self.preprocess_dispatch.get(action, self.preprocess_dispatch[None])
+
+    def postprocess_plugins(self, action):
+        return self.postprocess_dispatch.get(action, self.postprocess_dispatch[None])
+
 class CardstoriesResource(resource.Resource):
 
+    # Media types of the MessagePack responses, the first one being sent
+    MSGPACK_TYPES = ('application/x-msgpack', 'application/msgpack')
+
+    # max-age of the cacheable state responses (see cache_control)
+    FINISHED_MAX_AGE = 3600
+    ANONYMOUS_MAX_AGE = 5
+
     def __init__(self, service):
         resource.Resource.__init__(self)
         self.service = service
@@ -53,15 +101,23 @@ class CardstoriesResource(resource.Resource):
         self.wrap_http(request)
         return server.NOT_DONE_YET
 
-    def wrap_http(self, request):
+    def process(self, request):
         d = defer.succeed(True)
+        # The plugins are chosen according to the action requested, even
+        # if a plugin removes it from the arguments while pre-processing.
+        action = (request.args or {}).get('action', [None])[0]
 
         # pre-process the request ...
-        self.preprocess(d, request)
+        self.preprocess(d, request, action)
         # ... process the request ...
         d.addCallback(self.handle, request)
         # ... post-process the request.
-        self.postprocess(d, request)
+        self.postprocess(d, request, action)
+
+        return d
+
+    def wrap_http(self, request):
+        d = self.process(request)
 
         # catch errors and dump a trace ...
         def failed(reason):
@@ -77,10 +133,38 @@ class CardstoriesResource(resource.Resource):
         # ... or return the JSON result to the caller
         def succeed(result):
             if not request._disconnected:
-                content = json.dumps(result)
+                format = self.accepted_format(request)
+                if format == 'msgpack':
+                    content = self.pack(result)
+                    request.setHeader("content-type", self.MSGPACK_TYPES[0])
+                else:
+                    content = dumps(result)
+                    request.setHeader("content-type", 'application/json; charset="UTF-8"')
+                request.setHeader("vary", 'Accept, Accept-Encoding')
+                encoding = None
+                if request.site.compression_level > 0 and len(content) >= request.site.compression_threshold:
+                    encoding = self.accepted_encoding(request)
+                digest = None
+                if request.args and request.args.get('action') == ['state']:
+                    cache_control = self.cache_control(request, result)
+                    request.setHeader("cache-control", cache_control)
+                    # The ETag is strong: it is derived from the exact bytes sent.
+                    digest = hashlib.md5(content).hexdigest()
+                    if encoding:
+                        etag = '"%s-%s"' % (digest, encoding)
+                    else:
+                        etag = '"%s"' % digest
+                    if request.setETag(etag) == http.CACHED:
+                        request.finish()
+                        return result
+                    if cache_control == 'no-cache':
+                        digest = None
+                else:
+                    request.setHeader("cache-control", 'no-cache');
+                if encoding:
+                    content = self.compress(request, result, content, format, encoding, digest)
+                    request.setHeader("content-encoding", encoding)
                 request.setHeader("content-length", str(len(content)))
-                request.setHeader("content-type", 'application/json; charset="UTF-8"')
-                request.setHeader("cache-control", 'no-cache');
                 request.write(content)
                 request.finish()
             return result
@@ -88,12 +172,124 @@ class CardstoriesResource(resource.Resource):
 
         return d
 
-    def preprocess(self, d, request):
-        for plugin in request.site.preprocess:
+    @staticmethod
+    def parse_qualities(header):
+        '''Parses an Accept or Accept-Encoding header into a dict of the
+        quality of each of the values it lists.'''
+
+        qualities = {}
+        for value in (header or '').split(','):
+            params = value.split(';')
+            quality = 1.0
+            for param in params[1:]:
+                name, _, q = param.strip().partition('=')
+                if name == 'q':
+                    try:
+                        quality = float(q)
+                    except ValueError:
+                        quality = 0.0
+            qualities[params[0].strip().lower()] = quality
+        return qualities
+
+    def accepted_format(self, request):
+        '''Returns 'msgpack' if the client asked for MessagePack, with the
+        format argument or else with the Accept header, and if it is
+        available. Returns 'json' otherwise.'''
+
+        if msgpack is None:
+            return 'json'
+        format = request.args and request.args.get('format')
+        if format:
+            return format[0] == 'msgpack' and 'msgpack' or 'json'
+        qualities = self.parse_qualities(request.getHeader('accept'))
+        quality = max([qualities.get(media_type, 0.0) for media_type in self.MSGPACK_TYPES])
+        if quality > 0 and quality >= qualities.get('application/json', 0.0):
+            return 'msgpack'
+        return 'json'
+
+    @staticmethod
+    def pack(result):
+        '''Encodes result with MessagePack. Small integers, such as the
+        cards, the boards and the ids, take a single byte each.'''
+
+        if isinstance(result, Serialized):
+            if result.packed is None:
+                result.packed = msgpack.packb(json.loads(result))
+            return result.packed
+        return msgpack.packb(result)
+
+    def accepted_encoding(self, request):
+        '''Returns the content coding accepted by the client, gzip or deflate,
+        according to the Accept-Encoding header, or None.'''
+
+        qualities = self.parse_qualities(request.getHeader('accept-encoding'))
+        for coding in ('gzip', 'deflate'):
+            if qualities.get(coding, qualities.get('*', 0.0)) > 0:
+                return coding
+        return None
+
+    @staticmethod
+    def encode(content, encoding, level):
+        if encoding == 'gzip':
+            buffer = StringIO()
+            f = gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=level, mtime=0)
+            f.write(content)
+            f.close()
+            return buffer.getvalue()
+        else:
+            return zlib.compress(content, level)
+
+    def compress(self, request, result, content, format, encoding, digest=None):
+        '''Returns content compressed with encoding. The same content is sent
+        to many clients when it is a Serialized result, such as the view of
+        the spectators, or a cacheable response (digest is its md5): its
+        compressed bytes are kept and reused.'''
+
+        level = request.site.compression_level
+        if isinstance(result, Serialized):
+            if result.compressed is None:
+                result.compressed = {}
+            key = (format, encoding)
+            if key not in result.compressed:
+                result.compressed[key] = self.encode(content, encoding, level)
+            return result.compressed[key]
+        elif digest:
+            compressed = request.site.compressed.get((digest, encoding))
+            if compressed is None:
+                compressed = self.encode(content, encoding, level)
+                request.site.compressed.set((digest, encoding), compressed)
+            return compressed
+        else:
+            return self.encode(content, encoding, level)
+
+    def cache_control(self, request, states):
+        '''Returns the cache-control header of a state response. The
+        anonymous view of a completed or canceled game never changes: it
+        can be kept for a long time. Other anonymous views can be shared
+        for a few seconds. The views of a player hold their score, level and
+        earned cards, which change with the other games they play: these
+        must always be revalidated (with the ETag).'''
+
+        finished = True
+        for state in states:
+            if state.get('type') == 'players_info':
+                continue
+            if state.get('type') != 'game' or state.get('state') not in ('complete', 'canceled'):
+                finished = False
+        anonymous = 'player_id' not in request.args and 'owner_id' not in request.args
+        if finished and anonymous:
+            return 'public, max-age=%d' % self.FINISHED_MAX_AGE
+        elif anonymous:
+            return 'public, max-age=%d' % self.ANONYMOUS_MAX_AGE
+        else:
+            return 'no-cache'
+
+    def preprocess(self, d, request, action):
+        for plugin in request.site.preprocess_plugins(action):
             d.addCallback(plugin.preprocess, request)
 
-    def postprocess(self, d, request):
-        for plugin in request.site.postprocess:
+    def postprocess(self, d, request, action):
+        for plugin in request.site.postprocess_plugins(action):
             d.addCallback(plugin.postprocess, request)
 
     def handle(self, result, request):
@@ -108,10 +304,10 @@ class CardstoriesInternalResource(CardstoriesResource):
     request is coming from an internal resource.
 
     """
-    def preprocess(self, d, request):
+    def preprocess(self, d, request, action):
         pass
 
-    def postprocess(self, d, request):
+    def postprocess(self, d, request, action):
         pass
 
     def handle(self, result, request):
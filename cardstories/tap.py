@@ -37,6 +37,7 @@ from cardstories.service import CardstoriesService
 from cardstories.plugins import CardstoriesPlugins
 #from cardstories.service import SSLContextFactory
 from cardstories.site import CardstoriesTree, CardstoriesResource, CardstoriesSite
+from cardstories.rpc import CardstoriesRPCFactory
 
 class Options(usage.Options):
     synopsis = "[-h|--help] [-p|--port=<number>] [-s|--ssl-port=<number>] [-P|--ssl-pem=</etc/cardstories/cert.pem>] [-d|--db=</var/lib/cardstories/cardstories.sqlite>] [-v|--verbose]"
@@ -49,10 +50,18 @@ class Options(usage.Options):
          ["ssl-port", "s", None, "Port on which to listen for SSL", int],
          ["ssl-pem", "P", "/etc/cardstories/cert.pem", "certificate path name", str],
          ["db", "d", "/var/lib/cardstories/cardstories.sqlite", "sqlite3 game database path", str],
+         ["db-retry-deadline", "", 10, "Number of seconds during which a database interaction is retried while the database is locked", float],
          ["poll-timeout", "", 30, "Number of seconds before a long poll timeout - see http://tools.ietf.org/html/draft-loreto-http-bidirectional-07#section-5.5", int],
          ["game-timeout", "", (7 * 24 * 60 * 60), "Number of seconds before a game in progress timesout", int],
+         ["finished-games-cache", "", 1000, "Number of completed or canceled games whose renders are kept in memory", int],
+         ["spectators-per-game", "", 1000, "Maximum number of spectators polling the same game", int],
+         ["spectators-max", "", 10000, "Maximum number of spectators polling games", int],
+         ["spectator-views-cache", "", 1000, "Number of games whose view sent to the spectators is kept in memory", int],
          ["static", "", "/usr/share/cardstories", "directory where /static files will be fetched", str],
          ["internal-secret", "", "MySecret", "internal secret key shared with the django app", str],
+         ["compression-threshold", "", 1024, "Minimum size in bytes of the responses compressed with gzip or deflate", int],
+         ["compression-level", "", 6, "zlib compression level of the responses, from 1 to 9, 0 to disable compression", int],
+         ["rpc-socket", "", None, "unix socket path on which to serve the RPC channel used by the django app", str],
          ["plugins-libdir", "", "/var/lib/cardstories/plugins", "plugins storage directory", str],
          ["plugins-confdir", "", "/etc/cardstories/plugins", "plugins configuration directory", str],
          ["plugins-dir", "", "/usr/share/cardstories/plugins", "plugins directory", str],
@@ -97,6 +106,11 @@ def makeService(settings):
                        interface=settings.get('interface', '127.0.0.1')
                        ).setServiceParent(service_collection)
 
+    if settings.get('rpc-socket', None):
+        internet.UNIXServer(settings['rpc-socket'],
+                            CardstoriesRPCFactory(site)
+                            ).setServiceParent(service_collection)
+
     # if settings.has_key('ssl-port') and settings['ssl-port']:
     #     internet.SSLServer(settings['ssl-port'], site, SSLContextFactory(settings)
     #                        ).setServiceParent(service_collection)
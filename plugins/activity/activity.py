@@ -41,6 +41,7 @@ class Plugin(Pollable, Observable):
     def __init__(self, service, plugins):
         self.service = service
         self.observers = []
+        # The number of active polls of each online player, by player id.
         self.online_players = {}
 
         self.service.listen().addCallback(self.on_service_notification)
@@ -83,11 +84,11 @@ class Plugin(Pollable, Observable):
 
         if player_id not in self.online_players:
             log.msg('Player %d connecting' % player_id)
-            self.online_players[player_id] = { 'active_polls': 1 }
+            self.online_players[player_id] = 1
             self.notify({'type': 'player_connecting',
                          'player_id': player_id})
         else:
-            self.online_players[player_id]['active_polls'] += 1
+            self.online_players[player_id] += 1
 
 
     def on_any_poll_end(self, player_id):
@@ -97,10 +98,10 @@ class Plugin(Pollable, Observable):
         and doesn't start a new one quickly after (need to give time to reconnect)
         """
 
-        self.online_players[player_id]['active_polls'] -= 1
+        self.online_players[player_id] -= 1
 
         def on_poll_resume_timeout():
-            if player_id in self.online_players and self.online_players[player_id]['active_polls'] <= 0:
+            if player_id in self.online_players and self.online_players[player_id] <= 0:
                 del self.online_players[player_id]
 
             if player_id not in self.online_players:
@@ -108,7 +109,7 @@ class Plugin(Pollable, Observable):
                 self.notify({'type': 'player_disconnecting',
                              'player_id': player_id})
 
-        if self.online_players[player_id]['active_polls'] <= 0:
+        if self.online_players[player_id] <= 0:
             # give X seconds to start another poll
             reactor.callLater(15, on_poll_resume_timeout)
 
@@ -117,7 +118,10 @@ class Plugin(Pollable, Observable):
         Shows the players currently online, along with the number of active chat polls
         """
 
-        return defer.succeed([{"online_players": self.online_players}, []])
+        online_players = {}
+        for player_id, active_polls in self.online_players.iteritems():
+            online_players[player_id] = {'active_polls': active_polls}
+        return defer.succeed([{"online_players": online_players}, []])
 
     def is_player_online(self, player_id):
         """
@@ -79,6 +79,26 @@ class Plugin(Auth):
             id = None
         defer.returnValue(id)
 
+    def playersIdsInteraction(self, transaction, emails, create):
+        ids = []
+        for email in emails:
+            transaction.execute("SELECT id FROM players WHERE name = ?", [ email ])
+            row = transaction.fetchone()
+            if row:
+                id = row[0]
+            elif create:
+                id = self.create_player_from_email(transaction, email)
+            else:
+                id = None
+            ids.append(id)
+        return ids
+
+    def get_players_ids(self, emails, create=False):
+        '''Resolves all the emails in a single transaction'''
+
+        emails = [isinstance(email, unicode) and email or email.decode('utf-8') for email in emails]
+        return self.db.runInteraction(self.playersIdsInteraction, emails, create)
+
     def get_player_name(self, id):
         return "Player " + str(id)
 
@@ -58,6 +58,10 @@ class Plugin(Pollable, CardstoriesServiceConnector):
     at the cards, using data from previous games.
     
     """
+
+    # Only the bot settings are pre-processed (see CardstoriesSite.dispatch)
+    preprocess_actions = ('bot',)
+
     def __init__(self, service, plugins):
         # Register a function to listen to the game events. 
         self.service = service
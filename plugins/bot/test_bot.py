@@ -58,6 +58,7 @@ class BotTest(unittest.TestCase):
                                            'static': 'STATIC'
                                            })
         self.service.auth = Mock()
+        self.service.auth.get_players_info.side_effect = lambda ids: [{} for id in ids]
         self.service.startService()
 
     def tearDown(self):
@@ -32,7 +32,7 @@ from twisted.internet import defer, reactor
 from django.utils.html import urlize
 
 from cardstories.poll import Pollable
-from cardstories.helpers import Observable
+from cardstories.helpers import Observable, Fragment
 
 # How long we retain old messages for in milliseconds
 MESSAGE_EXPIRE_TIME = 3600000
@@ -42,6 +42,10 @@ class Plugin(Pollable):
     The chat plugin implements the backend for the in-game chat system.
     
     """
+
+    # Only the messages are pre-processed (see CardstoriesSite.dispatch)
+    preprocess_actions = ('message',)
+
     def __init__(self, service, plugins):
         # Register a function to listen to the game events. 
         self.service = service
@@ -95,7 +99,10 @@ class Plugin(Pollable):
         timestamp = int(runtime.seconds() * 1000)
         message.update({'timestamp': timestamp})
 
-        # Save it in our "database".
+        # Save it in our "database", along with its JSON encoding, as the
+        # message won't change anymore.
+        message = Fragment(message)
+        message.serialize()
         self.messages.append(message)
 
         # Log the message
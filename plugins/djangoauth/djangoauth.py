@@ -24,85 +24,341 @@
 # "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
 #
 from lxml import objectify
-import os
+import os, base64, hashlib, pickle, json, urllib
 
 from twisted.python import log
 from twisted.internet import defer
-from twisted.web import client
+from twisted.enterprise import adbapi
+from twisted.web import client, error
 
 from cardstories.auth import Auth, AuthenticationError
+from cardstories.cache import LRUCache
+from cardstories.helpers import gather
 
 
 
+class NotFound(object):
+    """Cached answer for a player or session that django doesn't know about."""
+
+    def __init__(self, error):
+        self.error = error
+
+
 class Plugin(Auth):
 
+    # Defaults for the settings of djangoauth.xml
+    CACHE_SIZE = 10000
+    CACHE_TTL = 3600
+    CACHE_NEGATIVE_TTL = 60
+    CACHE_SESSION_TTL = 60
+    DATABASE_THREADS = 3
+    AVATARS_URL = '/static/css/images/avatars/cache/'
+
+    # Maximum number of host parameters in a single sqlite statement
+    SQL_MAX_VARIABLES = 500
+    # Maximum number of players asked at once to the django bulk views
+    BULK_SIZE = 100
+
     def __init__(self, service, plugins):
         self.service = service
         self.confdir = os.path.join(self.service.settings['plugins-confdir'], 'djangoauth')
         self.settings = objectify.parse(open(os.path.join(self.confdir, 'djangoauth.xml'))).getroot()
         self.host = self.settings.get('host')
         self.getPage = client.getPage
-        self.id2name = {}
-        self.id2email = {}
-        self.id2avatar_url = {}
-        self.email2id = {}
-        log.msg('plugin djangoauth initialized')
+        # Names, emails, avatar URLs, ids and sessions share the same cache,
+        # keyed by (kind, player id, email or session id). Players unknown
+        # to django are cached too, for a shorter time.
+        self.cache = LRUCache(int(self.settings.get('cache_size', self.CACHE_SIZE)),
+                              ttl=int(self.settings.get('cache_ttl', self.CACHE_TTL)))
+        self.negative_ttl = int(self.settings.get('cache_negative_ttl', self.CACHE_NEGATIVE_TTL))
+        self.session_ttl = int(self.settings.get('cache_session_ttl', self.CACHE_SESSION_TTL))
+        # When the path to the django database is provided, the players are
+        # read directly from it (read only), instead of asking django over
+        # HTTP. Sessions are verified the same way if the django SECRET_KEY
+        # is provided too. Creating a player always goes through django.
+        self.database = self.settings.get('database')
+        self.secret_key = self.settings.get('secret_key')
+        # Avatars can only be served from the database mode when the
+        # directory of the django avatars cache is known, since django
+        # generates missing avatars on the fly.
+        self.avatars_dir = self.settings.get('avatars_dir')
+        self.avatars_url = self.settings.get('avatars_url', self.AVATARS_URL)
+        if self.database:
+            self.db = adbapi.ConnectionPool("sqlite3", database=self.database,
+                                            cp_min=1,
+                                            cp_max=int(self.settings.get('database_threads', self.DATABASE_THREADS)),
+                                            cp_noisy=True, check_same_thread=False,
+                                            cp_openfun=self.open_database)
+            log.msg('plugin djangoauth initialized with ' + self.database)
+        else:
+            self.db = None
+            log.msg('plugin djangoauth initialized')
 
     def name(self):
         return 'djangoauth'
 
+    @staticmethod
+    def open_database(connection):
+        # Never write to the django database.
+        connection.execute("PRAGMA query_only = 1")
+
+    def cache_stats(self):
+        """Returns the size and the hit ratio of the players cache."""
+
+        return self.cache.stats()
+
     @defer.inlineCallbacks
-    def get_player_id(self, email, create=False):
-        # Use cache if available
-        if email in self.email2id:
-            id = self.email2id[email]
-        else:
-            create_query = ''
+    def lookup(self, key, fetch, ttl=None, use_negative=True):
+        """Returns the cached value for key, or gets it by calling fetch()
+        and caches it. A 404 answer is cached as well, and raised again on
+        subsequent lookups until it expires, unless use_negative is False."""
+
+        value = self.cache.get(key)
+        if value is None or (isinstance(value, NotFound) and not use_negative):
+            try:
+                value = yield fetch()
+            except error.Error as e:
+                if e.status != '404':
+                    raise
+                value = NotFound(e)
+                self.cache.set(key, value, ttl=self.negative_ttl)
+            else:
+                self.cache.set(key, value, ttl=ttl)
+        if isinstance(value, NotFound):
+            raise value.error
+        defer.returnValue(value)
+
+    @defer.inlineCallbacks
+    def lookup_many(self, kind, keys, fetch, use_negative=True):
+        """Bulk version of lookup(): returns the list of the cached values
+        for the (kind, key) of each key. The keys missing from the cache are
+        got at once by calling fetch(missing), which returns a dict of the
+        values found. The keys it doesn't find are cached as not found."""
+
+        values = {}
+        missing = []
+        for key in keys:
+            value = self.cache.get((kind, key))
+            if value is None or (isinstance(value, NotFound) and not use_negative):
+                if key not in missing:
+                    missing.append(key)
+            else:
+                values[key] = value
+        if missing:
+            found = yield fetch(missing)
+            for key in missing:
+                if key in found:
+                    values[key] = found[key]
+                    self.cache.set((kind, key), values[key])
+                else:
+                    values[key] = NotFound(error.Error('404', 'Player not found (%s=%s)' % (kind, key)))
+                    self.cache.set((kind, key), values[key], ttl=self.negative_ttl)
+        for key in keys:
+            if isinstance(values[key], NotFound):
+                raise values[key].error
+        defer.returnValue([values[key] for key in keys])
+
+    @defer.inlineCallbacks
+    def fetch_bulk(self, view, param, keys, create=False):
+        """Asks a bulk django view (get_players_names, etc.) for the keys,
+        BULK_SIZE at a time, and returns the merged dict of its answers,
+        using the keys as they were provided."""
+
+        requests = []
+        for i in xrange(0, len(keys), self.BULK_SIZE):
+            chunk = keys[i:i + self.BULK_SIZE]
+            params = {param: [unicode(key).encode('utf-8') for key in chunk]}
             if create:
-                create_query += '?create=yes'
-            id = yield self.getPage("http://%s/get_player_id/%s/%s" % (self.host, email, create_query))
-            id = int(id)
-            self.email2id[email] = id
-        defer.returnValue(id)
+                params['create'] = 'yes'
+            url = "http://%s/%s/?%s" % (self.host, view, urllib.urlencode(params, True))
+            requests.append(defer.maybeDeferred(self.getPage, url))
+        answers = yield gather(requests)
+        found = {}
+        for answer in answers:
+            found.update(json.loads(answer))
+        defer.returnValue(dict((key, found[unicode(key)]) for key in keys if unicode(key) in found))
 
     @defer.inlineCallbacks
-    def get_player_name(self, id):
-        # Use cache if available
-        if id in self.id2name:
-            name = self.id2name[id]
-        else:
-            name = yield self.getPage("http://%s/get_player_name/%s/" % (self.host, str(id)))
-            self.id2name[id] = name
-        defer.returnValue(name)
+    def fetch_players(self, kind, ids):
+        """Reads the players from the django database, and returns a dict of
+        their names ('name') or emails ('email'). The other one is cached too."""
+
+        users = yield self.db.runInteraction(self.playersInteraction, ids)
+        other = kind == 'name' and 'email' or 'name'
+        found = {}
+        for id in ids:
+            if int(id) in users:
+                found[id] = users[int(id)][kind]
+                self.cache.set((other, id), users[int(id)][other])
+        defer.returnValue(found)
+
+    def playersInteraction(self, transaction, ids):
+        users = {}
+        ids = [int(id) for id in ids]
+        for i in xrange(0, len(ids), self.SQL_MAX_VARIABLES):
+            chunk = ids[i:i + self.SQL_MAX_VARIABLES]
+            transaction.execute("SELECT id, username, first_name, email FROM auth_user "
+                                "WHERE id IN (%s)" % ','.join('?' * len(chunk)), chunk)
+            for (id, username, first_name, email) in transaction.fetchall():
+                # Same as website.cardstories.views.get_user_display_name
+                name = first_name and first_name.strip()
+                if not name:
+                    name = email.split('@')[0]
+                users[id] = {'name': name, 'email': username}
+        return users
+
+    def playersIdsInteraction(self, transaction, emails):
+        ids = {}
+        for i in xrange(0, len(emails), self.SQL_MAX_VARIABLES):
+            chunk = emails[i:i + self.SQL_MAX_VARIABLES]
+            transaction.execute("SELECT username, id FROM auth_user "
+                                "WHERE username IN (%s)" % ','.join('?' * len(chunk)), chunk)
+            for (username, id) in transaction.fetchall():
+                ids[username] = id
+        return ids
 
     @defer.inlineCallbacks
+    def get_player_id(self, email, create=False):
+        if self.db and not create:
+            (id,) = yield self.get_players_ids([email])
+            defer.returnValue(id)
+        create_query = ''
+        if create:
+            create_query += '?create=yes'
+        url = "http://%s/get_player_id/%s/%s" % (self.host, email, create_query)
+        id = yield self.lookup(('id', email), lambda: self.getPage(url), use_negative=not create)
+        id = int(id)
+        defer.returnValue(id)
+
+    def get_player_name(self, id):
+        if self.db:
+            return self.get_players_names([id]).addCallback(lambda names: names[0])
+        url = "http://%s/get_player_name/%s/" % (self.host, str(id))
+        return self.lookup(('name', id), lambda: self.getPage(url))
+
     def get_player_email(self, id):
-        # Use cache if available
-        if id in self.id2email:
-            email = self.id2email[id]
+        if self.db:
+            return self.get_players_emails([id]).addCallback(lambda emails: emails[0])
+        url = "http://%s/get_player_email/%s/" % (self.host, str(id))
+        return self.lookup(('email', id), lambda: self.getPage(url))
+
+    def get_players_ids(self, emails, create=False):
+        emails = [isinstance(email, unicode) and email or email.decode('utf-8') for email in emails]
+        if self.db and not create:
+            fetch = lambda missing: self.db.runInteraction(self.playersIdsInteraction, missing)
         else:
-            email = yield self.getPage("http://%s/get_player_email/%s/" % (self.host, str(id)))
-            self.id2email[id] = email
-        defer.returnValue(email)
+            fetch = lambda missing: self.fetch_bulk('get_players_ids', 'username', missing, create=create)
+        d = self.lookup_many('id', emails, fetch, use_negative=not create)
+        d.addCallback(lambda ids: [int(id) for id in ids])
+        return d
+
+    def get_players_names(self, ids):
+        if self.db:
+            fetch = lambda missing: self.fetch_players('name', missing)
+        else:
+            fetch = lambda missing: self.fetch_bulk('get_players_names', 'id', missing)
+        return self.lookup_many('name', ids, fetch)
+
+    def get_players_emails(self, ids):
+        if self.db:
+            fetch = lambda missing: self.fetch_players('email', missing)
+        else:
+            fetch = lambda missing: self.fetch_bulk('get_players_emails', 'id', missing)
+        return self.lookup_many('email', ids, fetch)
+
+    def get_local_avatar_url(self, id):
+        '''Returns the URL of the avatar of the player if django already has it
+        in its avatars cache, None otherwise (see website.cardstories.avatar.Avatar)'''
+
+        id_str = "%09d" % int(id)
+        subdir = os.path.join(id_str[0:3], id_str[3:6])
+        filename = "%d_small.jpg" % int(id)
+        if os.path.exists(os.path.join(self.avatars_dir, subdir, filename)):
+            return os.path.join(self.avatars_url, subdir, filename)
+        return None
 
-    @defer.inlineCallbacks
     def get_player_avatar_url(self, id):
-        # Use cache if available
-        if id in self.id2avatar_url:
-            avatar_url = self.id2avatar_url[id]
+        url = "http://%s/get_player_avatar_url/%s/" % (self.host, str(id))
+        if self.db and self.avatars_dir:
+            def fetch():
+                avatar_url = self.get_local_avatar_url(id)
+                if avatar_url:
+                    return defer.succeed(avatar_url)
+                # Let django create the avatar
+                return self.getPage(url)
+        else:
+            fetch = lambda: self.getPage(url)
+        return self.lookup(('avatar_url', id), fetch)
+
+    @defer.inlineCallbacks
+    def fetch_avatars_urls(self, ids):
+        found = {}
+        if self.db and self.avatars_dir:
+            for id in ids:
+                avatar_url = self.get_local_avatar_url(id)
+                if avatar_url:
+                    found[id] = avatar_url
+        missing = [id for id in ids if id not in found]
+        if missing:
+            # Let django create the avatars
+            created = yield self.fetch_bulk('get_players_avatars_urls', 'id', missing)
+            found.update(created)
+        defer.returnValue(found)
+
+    def get_players_avatars_urls(self, ids):
+        return self.lookup_many('avatar_url', ids, self.fetch_avatars_urls)
+
+    def decode_session(self, session_data):
+        '''Decodes the content of a django session, as stored in the database
+        (see django.contrib.sessions.backends.base.SessionBase.decode)'''
+
+        encoded_data = base64.decodestring(session_data)
+        pickled, tamper_check = encoded_data[:-32], encoded_data[-32:]
+        if hashlib.md5(pickled + self.secret_key).hexdigest() != tamper_check:
+            return {}
+        try:
+            return pickle.loads(pickled)
+        except:
+            return {}
+
+    def sessionInteraction(self, transaction, sessionid):
+        transaction.execute("SELECT session_data FROM django_session "
+                            "WHERE session_key = ? AND expire_date > datetime('now', 'localtime')",
+                            [ sessionid ])
+        row = transaction.fetchone()
+        if row:
+            user_id = self.decode_session(str(row[0])).get('_auth_user_id')
+            if user_id:
+                transaction.execute("SELECT id FROM auth_user WHERE id = ?", [ user_id ])
+                row = transaction.fetchone()
+                if row:
+                    return str(row[0])
+        # Same answer as the django get_loggedin_player_id view.
+        raise error.Error('404', 'Session not found')
+
+    def get_loggedin_player_id(self, sessionid):
+        '''Returns the player_id logged in with the provided django session id'''
+
+        if self.db and self.secret_key:
+            fetch = lambda: self.db.runInteraction(self.sessionInteraction, sessionid)
         else:
-            avatar_url = yield self.getPage("http://%s/get_player_avatar_url/%s/" % (self.host, str(id)))
-            self.id2avatar_url[id] = avatar_url
-        defer.returnValue(avatar_url)
+            url = "http://%s/get_loggedin_player_id/%s/" % (self.host, str(sessionid))
+            fetch = lambda: self.getPage(url)
+        return self.lookup(('session', sessionid), fetch, ttl=self.session_ttl)
 
     @defer.inlineCallbacks
     def authenticate(self, request, requested_player_id):
         '''Ensure that the player_id match the request's session'''
 
         sessionid = request.getCookie('sessionid')
-        cookie_player_id = yield self.getPage("http://%s/get_loggedin_player_id/%s/" % (self.host, str(sessionid)))
+        try:
+            cookie_player_id = yield self.get_loggedin_player_id(sessionid)
+        except error.Error as e:
+            if e.status != '404':
+                raise
+            cookie_player_id = None
 
-        if requested_player_id != cookie_player_id:
+        if cookie_player_id is None or str(requested_player_id) != str(cookie_player_id):
             raise AuthenticationError(requested_player_id, cookie_player_id)
 
         defer.returnValue(True)
@@ -162,6 +162,208 @@ class DjangoAuthTest(unittest.TestCase):
         (resolved_email,) = yield self.auth.get_players_emails((player_id,))
         self.assertEquals(player_email, resolved_email) # the second time around the cached answer is returned
 
+    @defer.inlineCallbacks
+    def test04_cache_not_found(self):
+        from twisted.web import error
+        calls = []
+        def getPage(url):
+            calls.append(url)
+            return defer.fail(error.Error('404', 'NOT FOUND'))
+        self.auth.getPage = getPage
+
+        # Unknown players are cached, and the error is raised again.
+        for i in range(2):
+            raised = False
+            try:
+                yield self.auth.get_player_name(999999)
+            except error.Error as e:
+                raised = True
+                self.assertEquals(e.status, '404')
+            self.assertTrue(raised)
+        self.assertEquals(len(calls), 1)
+        stats = self.auth.cache_stats()
+        self.assertEquals(stats['size'], 1)
+        self.assertEquals(stats['hit_ratio'], 0.5)
+
+        # Creating a player bypasses the cached 404.
+        try:
+            yield self.auth.get_player_id('unknown2@foo.com')
+        except error.Error:
+            pass
+        self.auth.getPage = lambda url: defer.succeed('43')
+        player_id = yield self.auth.get_player_id('unknown2@foo.com', create=True)
+        self.assertEquals(player_id, 43)
+        player_id = yield self.auth.get_player_id('unknown2@foo.com')
+        self.assertEquals(player_id, 43)
+
+    @defer.inlineCallbacks
+    def test05_authenticate_local(self):
+        import sqlite3, pickle, hashlib, base64
+        from twisted.enterprise import adbapi
+
+        # A read only copy of the django tables used to verify sessions.
+        database = 'test_django.sqlite'
+        if os.path.exists(database):
+            os.unlink(database)
+        db = sqlite3.connect(database)
+        db.execute("CREATE TABLE auth_user (id INTEGER PRIMARY KEY)")
+        db.execute("CREATE TABLE django_session (session_key VARCHAR(40), session_data TEXT, expire_date DATETIME)")
+        db.execute("INSERT INTO auth_user (id) VALUES (7)")
+        def encode(session, secret_key):
+            pickled = pickle.dumps(session, pickle.HIGHEST_PROTOCOL)
+            return base64.encodestring(pickled + hashlib.md5(pickled + secret_key).hexdigest())
+        for (sessionid, session, expire_date) in (('valid', encode({'_auth_user_id': 7}, 'SECRET'), '2100-01-01 00:00:00'),
+                                                  ('expired', encode({'_auth_user_id': 7}, 'SECRET'), '2000-01-01 00:00:00'),
+                                                  ('tampered', encode({'_auth_user_id': 7}, 'OTHER'), '2100-01-01 00:00:00'),
+                                                  ('nouser', encode({'_auth_user_id': 8}, 'SECRET'), '2100-01-01 00:00:00')):
+            db.execute("INSERT INTO django_session VALUES (?, ?, ?)", [sessionid, session, expire_date])
+        db.commit()
+        db.close()
+        self.auth.secret_key = 'SECRET'
+        self.auth.db = adbapi.ConnectionPool("sqlite3", database=database, check_same_thread=False,
+                                             cp_openfun=self.auth.open_database)
+        self.auth.getPage = None # django must not be asked
+
+        class request:
+            def __init__(self, sessionid):
+                self.sessionid = sessionid
+            def getCookie(self, key):
+                return self.sessionid
+
+        result = yield self.auth.authenticate(request('valid'), '7')
+        self.assertTrue(result)
+        for sessionid, player_id in (('valid', '8'), ('expired', '7'), ('tampered', '7'), ('nouser', '8'), (None, '7')):
+            error = False
+            try:
+                yield self.auth.authenticate(request(sessionid), player_id)
+            except AuthenticationError:
+                error = True
+            self.assertTrue(error)
+
+        # The session is cached
+        self.auth.db.close()
+        os.unlink(database)
+        result = yield self.auth.authenticate(request('valid'), 7)
+        self.assertTrue(result)
+
+    @defer.inlineCallbacks
+    def test06_database(self):
+        import sqlite3
+        from twisted.enterprise import adbapi
+        from twisted.web import error
+
+        database = 'test_django.sqlite'
+        if os.path.exists(database):
+            os.unlink(database)
+        db = sqlite3.connect(database)
+        db.execute("CREATE TABLE auth_user (id INTEGER PRIMARY KEY, username VARCHAR(30), first_name VARCHAR(30), email VARCHAR(75))")
+        db.execute("INSERT INTO auth_user VALUES (7, 'player7@foo.com', ' Player Seven ', 'player7@foo.com')")
+        db.execute("INSERT INTO auth_user VALUES (8, 'player8@foo.com', '', 'player8@foo.com')")
+        db.commit()
+        db.close()
+        self.auth.db = adbapi.ConnectionPool("sqlite3", database=database, check_same_thread=False,
+                                             cp_openfun=self.auth.open_database)
+        queries = []
+        playersInteraction = self.auth.playersInteraction
+        def interaction(transaction, ids):
+            queries.append(ids)
+            return playersInteraction(transaction, ids)
+        self.auth.playersInteraction = interaction
+        self.auth.getPage = None # django must not be asked
+
+        # Names and emails are read in bulk, and cached together.
+        names = yield self.auth.get_players_names([7, 8, 7])
+        self.assertEquals(names, ['Player Seven', 'player8', 'Player Seven'])
+        self.assertEquals(queries, [[7, 8]])
+        emails = yield self.auth.get_players_emails([8, 7])
+        self.assertEquals(emails, ['player8@foo.com', 'player7@foo.com'])
+        name = yield self.auth.get_player_name(8)
+        self.assertEquals(name, 'player8')
+        self.assertEquals(len(queries), 1)
+
+        # Unknown players
+        raised = False
+        try:
+            yield self.auth.get_players_names([7, 9])
+        except error.Error as e:
+            raised = True
+            self.assertEquals(e.status, '404')
+        self.assertTrue(raised)
+
+        # Player ids
+        player_id = yield self.auth.get_player_id('player7@foo.com')
+        self.assertEquals(player_id, 7)
+        raised = False
+        try:
+            yield self.auth.get_player_id('unknown@foo.com')
+        except error.Error as e:
+            raised = True
+            self.assertEquals(e.status, '404')
+        self.assertTrue(raised)
+        # Creating a player goes through django
+        self.auth.getPage = lambda url: defer.succeed('10')
+        player_id = yield self.auth.get_player_id('unknown@foo.com', create=True)
+        self.assertEquals(player_id, 10)
+
+        # Avatars are served from the django avatars cache when present.
+        import shutil
+        shutil.rmtree('test_avatars', ignore_errors=True)
+        self.auth.avatars_dir = 'test_avatars'
+        os.makedirs(os.path.join('test_avatars', '000', '000'))
+        open(os.path.join('test_avatars', '000', '000', '7_small.jpg'), 'w').close()
+        self.auth.getPage = lambda url: defer.succeed('{"8": "/from/django/8.jpg"}')
+        avatars_urls = yield self.auth.get_players_avatars_urls([7, 8])
+        self.assertEquals(avatars_urls, [self.auth.avatars_url + '000/000/7_small.jpg', '/from/django/8.jpg'])
+
+        shutil.rmtree('test_avatars')
+        self.auth.db.close()
+        os.unlink(database)
+
+    @defer.inlineCallbacks
+    def test07_bulk(self):
+        from mock import patch
+        from twisted.web import error
+        urls = []
+        getPage = self.auth.getPage
+        def counting_getPage(url):
+            urls.append(url)
+            return getPage(url)
+        self.auth.getPage = counting_getPage
+
+        # Players are created in a single request.
+        emails = [u'test07a@foo.com', u'test07b@foo.com', u'test07c@foo.com']
+        ids = yield self.auth.get_players_ids(emails + emails[:1], create=True)
+        self.assertEquals(len(urls), 1)
+        self.assertEquals(len(set(ids)), 3)
+        self.assertEquals(ids[0], ids[3])
+
+        # Names, emails and avatars are each read in a single request, and cached.
+        names = yield self.auth.get_players_names(ids)
+        self.assertEquals(names, ['test07a', 'test07b', 'test07c', 'test07a'])
+        self.assertEquals(len(urls), 2)
+        emails_read = yield self.auth.get_players_emails(ids[:3])
+        self.assertEquals(emails_read, emails)
+        self.assertEquals(len(urls), 3)
+        with patch('website.cardstories.views.get_user_avatar_url') as get_user_avatar_url:
+            get_user_avatar_url.side_effect = lambda user: '/avatar/%d.jpg' % user.id
+            infos = yield self.auth.get_players_info(ids[:2])
+        self.assertEquals(infos, [{'name': 'test07a', 'avatar_url': '/avatar/%d.jpg' % ids[0]},
+                                  {'name': 'test07b', 'avatar_url': '/avatar/%d.jpg' % ids[1]}])
+        self.assertEquals(len(urls), 4)
+        ids_read = yield self.auth.get_players_ids(emails)
+        self.assertEquals(ids_read, ids[:3])
+        self.assertEquals(len(urls), 4)
+
+        # Unknown players
+        raised = False
+        try:
+            yield self.auth.get_players_names([ids[0], 999999])
+        except error.Error as e:
+            raised = True
+            self.assertEquals(e.status, '404')
+        self.assertTrue(raised)
+        self.assertEquals(len(urls), 5)
+
 
 def Run():
     loader = runner.TestLoader()
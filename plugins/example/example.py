@@ -333,6 +333,15 @@ class Plugin(Pollable):
     # the request afterwards, the type of the player_id may be a string instead
     # of a numerical id.
     #
+    #
+    # By default, preprocess is called for every request. A plugin
+    # which only handles some actions should list them, for instance
+    #
+    # preprocess_actions = ('echo',)
+    #
+    # as a class attribute, and it will only be called for these
+    # actions. The same goes for postprocess with postprocess_actions.
+    #
     def preprocess(self, result, request):
         #
         # This is an example of action that is intercepted by a plugin, 
@@ -42,6 +42,9 @@ class Plugin(Pollable, CardstoriesServiceConnector):
     the same players, automatically assigning the game master role to each player in turn.
     """
 
+    # Only the states, which can hold tabs, are post-processed (see CardstoriesSite.dispatch)
+    postprocess_actions = ('state', 'batch')
+
     def __init__(self, service, plugins):
         # Storage for tables
         self.tables = []
@@ -201,8 +204,8 @@ class Plugin(Pollable, CardstoriesServiceConnector):
         self.tables.remove(table)
         for game_id, game_table in self.game2table.items():
             if table == game_table:
-                table.stop_timer(table.next_game_timer)
                 del self.game2table[game_id]
+        table.destroy()
 
     def poll(self, args):
         """
@@ -297,8 +300,12 @@ class Plugin(Pollable, CardstoriesServiceConnector):
         on the table next owner/next game info.
         """
 
-        if type(result) is list:
-            for state in result:
+        states = result
+        if request.args.get('action') == ['batch'] and type(result) is list:
+            # The results of the actions of a batch (see CardstoriesService.batch)
+            states = [state for results in result if type(results) is list for state in results]
+        if type(states) is list:
+            for state in states:
                 if type(state) is dict:
                     if state.get('type') == 'tabs':
                         for game in state['games']:
@@ -310,13 +317,19 @@ class Plugin(Pollable, CardstoriesServiceConnector):
         defer.returnValue(result)
 
 
-class Table(Pollable, CardstoriesServiceConnector):
+class Table(Pollable):
     """
-    Describes a single table
+    Describes a single table. The requests to the service go through the
+    table plugin, which is a CardstoriesServiceConnector.
     """
 
     NEXT_GAME_TIMEOUT = 60
 
+    __slots__ = ('table_plugin', 'activity_plugin', 'service', 'games_ids',
+                 'pending_games', 'chosen_owners_ids', 'next_owner_id',
+                 'next_game_timer', 'next_game_promoted',
+                 '_next_owner_deferred', '_active_players_deferred')
+
     def __init__(self, table_plugin):
         self.table_plugin = table_plugin
         self.activity_plugin = self.table_plugin.activity_plugin
@@ -390,6 +403,14 @@ class Table(Pollable, CardstoriesServiceConnector):
         if timer and timer.active():
             timer.cancel()
 
+    def destroy(self):
+        """
+        Called when the table is deleted: stops its timer and releases its pollers
+        """
+
+        self.stop_timer(self.next_game_timer)
+        return Pollable.destroy(self)
+
     def on_game_sentence_set(self, game_id):
         """
         When one of the games of the table moves into 'invitation' state,
@@ -454,7 +475,7 @@ class Table(Pollable, CardstoriesServiceConnector):
         """
 
         current_game_id = self.get_current_game_id()
-        game_res = yield self.get_game_by_id(current_game_id)
+        game_res = yield self.table_plugin.get_game_by_id(current_game_id)
         game, players_ids = game_res
 
         defer.returnValue(game)
@@ -478,7 +499,7 @@ class Table(Pollable, CardstoriesServiceConnector):
         """
 
         player_id = args['player_id'][0]
-        player_game_id = self.get_game_id_from_args(args)
+        player_game_id = self.table_plugin.get_game_id_from_args(args)
         table_game_id = self.get_current_game_id()
         table_game = yield self.get_current_game()
 
@@ -547,7 +568,7 @@ class Table(Pollable, CardstoriesServiceConnector):
         """
 
         current_game_id = self.get_current_game_id()
-        players_ids = yield self.get_players_by_game_id(current_game_id)
+        players_ids = yield self.table_plugin.get_players_by_game_id(current_game_id)
 
         active_players_ids = []
         inactive_players_ids = []
@@ -74,6 +74,7 @@ class TableTest(unittest.TestCase):
                                            'plugins-libdir': 'LIBDIR',
                                            'static': 'STATIC'})
         self.service.auth = Mock()
+        self.service.auth.get_players_info.side_effect = lambda ids: [{} for id in ids]
         self.service.startService()
 
         # Fake an activity plugin to which the table plugin should listen
@@ -327,6 +328,13 @@ class TableTest(unittest.TestCase):
         self.assertEqual(result[0]['games'][1]['next_owner_id'], 21)
         self.assertEqual(result[0]['games'][1]['next_game_id'], None)
 
+        # The states returned by the actions of a batch are processed too.
+        mock_request.args['action'] = ['batch']
+        response = [{'type': 'participate'},
+                    [{'type': 'tabs', 'games': [{'id': tab2_game_id, 'state': 'complete'}]}]]
+        result = yield self.table_instance.postprocess(response, mock_request)
+        self.assertEqual(result[1][0]['games'][0]['next_owner_id'], 21)
+
         # Make sure things don't fail if response is not of the expected shape.
         yield self.table_instance.postprocess({'type': 'chat'}, mock_request)
         yield self.table_instance.postprocess([[1, 2, {'this': 'test'}]], mock_request)
@@ -348,7 +356,7 @@ class TableTest(unittest.TestCase):
 
         # Change the next game timeout from the default to 0.2 seconds for the test.
         table = self.table_instance.game2table[game_id]
-        table.NEXT_GAME_TIMEOUT = 0.2
+        self.patch(type(table), 'NEXT_GAME_TIMEOUT', 0.2)
 
         # Complete the game
         yield self.complete_game(game_id, owner, player1, player2)
@@ -395,7 +403,7 @@ class TableTest(unittest.TestCase):
 
         # Change the next game timeout from the default to 0.2 seconds for the test.
         table = self.table_instance.game2table[game_id]
-        table.NEXT_GAME_TIMEOUT = 0.2
+        self.patch(type(table), 'NEXT_GAME_TIMEOUT', 0.2)
 
         # Complete the game
         yield self.complete_game(game_id, owner, player1, player2)
@@ -632,6 +640,31 @@ class TableTest(unittest.TestCase):
         # For the same reason cancel the next_game_timer.
         table.stop_timer(table.next_game_timer)
 
+    @defer.inlineCallbacks
+    def test10_delete_table(self):
+        owner = 11
+        player1 = 12
+        player2 = 13
+
+        response = yield self.service.handle([], {'action': ['create'],
+                                                  'owner_id': [owner]})
+        game_id = response['game_id']
+        yield self.add_players_to_game(game_id, [owner, player1, player2])
+        yield self.complete_game(game_id, owner, player1, player2)
+        table = self.table_instance.game2table[game_id]
+        yield table.update_next_owner_id()
+        self.assertTrue(table.next_game_timer.active())
+
+        # Deleting the table destroys it: the pending polls return and
+        # the next game timer is stopped.
+        poll = table.poll({'modified': [table.get_modified()]})
+        self.table_instance.delete_table(table)
+        result = yield poll
+        self.assertEquals(None, result)
+        self.assertFalse(table.next_game_timer.active())
+        self.assertFalse(table in self.table_instance.tables)
+        self.assertFalse(game_id in self.table_instance.game2table)
+
 
 def Run():
     loader = runner.TestLoader()
@@ -51,6 +51,7 @@ for dirpath, dirnames, filenames in os.walk('migrations'):
 data_files.append(['/etc/default', ['etc/default/cardstories']])
 data_files.append(['/etc/cardstories/twisted/plugins', ['etc/cardstories/twisted/plugins/twisted_cardstories.py']])
 data_files.append(['/usr/share/cardstories/conf', [ 'conf/nginx.conf' ]])
+data_files.append(['/usr/share/cardstories/conf', [ 'conf/nginx-cache.conf' ]])
 data_files.append(['/usr/share/cardstories/conf', [ 'conf/apache2.conf' ]])
 data_files.append(['/usr/share/cardstories/website/apache', [ 'website/apache/apache2.conf' ]])
 data_files.append(['/usr/share/cardstories/website/apache', [ 'website/apache/django.wsgi' ]])
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Compares CardstoriesGame.deal with the list based implementation it
+replaced, dealing the hands of full games:
+
+    PYTHONPATH=.. python bench_deck.py [games]
+"""
+
+# Imports #####################################################################
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath("..")) # so that for M-x pdb works
+import random
+import timeit
+
+from cardstories.game import CardstoriesGame
+
+# Functions ###################################################################
+
+def list_deal(earned_cards, dealt_cards):
+    '''CardstoriesGame.deal before it used cardstories.deck.Deck'''
+
+    deck = [chr(x) for x in range(1, CardstoriesGame.NCARDS + 1)]
+    if earned_cards:
+        deck.extend(list(earned_cards))
+    if dealt_cards:
+        dealt_cards = list(dealt_cards)
+    else:
+        dealt_cards = []
+    for dealt_card in dealt_cards:
+        try:
+            deck.remove(dealt_card)
+        except ValueError:
+            pass
+    random.shuffle(deck)
+    player_cards = deck[:CardstoriesGame.CARDS_PER_PLAYER]
+    dealt_cards.extend(player_cards)
+    return (''.join(player_cards), ''.join(dealt_cards))
+
+def play(deal):
+    earned_cards = ''.join([chr(card) for card in range(CardstoriesGame.NCARDS + 1, CardstoriesGame.NCARDS_EARNED + 1)])
+    dealt_cards = None
+    for player in xrange(CardstoriesGame.NPLAYERS):
+        player_cards, dealt_cards = deal(earned_cards, dealt_cards)
+
+class Service:
+    settings = {}
+
+def Run(games=10000):
+    game = CardstoriesGame(Service())
+    for (name, deal) in (('list', list_deal), ('deck', game.deal)):
+        seconds = min(timeit.repeat(lambda: play(deal), number=games, repeat=3))
+        print '%s: %.1f microseconds per hand' % (name, seconds * 1000000 / games / CardstoriesGame.NPLAYERS)
+    game.destroy()
+
+if __name__ == '__main__':
+    Run(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Measures the memory held by the webservice for each game loaded in
+memory and for each connected player:
+
+    PYTHONPATH=.. python bench_memory.py [players]
+
+The size of an object is the sum of the sizes of the objects it refers
+to, the objects shared with the rest of the webservice (service, reactor,
+classes, code) excluded. A connected player has a pending poll on the game
+and an entry in the online players of the activity plugin.
+"""
+
+# Imports #####################################################################
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath("..")) # so that for M-x pdb works
+import gc
+import types
+
+from twisted.internet import reactor
+
+from cardstories.game import CardstoriesGame
+
+# Functions ###################################################################
+
+def sizeof(root, shared):
+    '''Bytes held by root and the objects it refers to, except the
+    shared objects and the objects they refer to'''
+
+    seen = set([id(obj) for obj in shared])
+    size = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ClassType, types.ModuleType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, types.FunctionType):
+            # The code and the globals of the callbacks are shared.
+            stack.extend(obj.func_closure or ())
+        else:
+            stack.extend(gc.get_referents(obj))
+    return size
+
+def resident_game(service, game_id, players_count):
+    '''Game in the vote state, with its timer, and a pending poll for each
+    of the players_count players'''
+
+    game = CardstoriesGame(service, game_id)
+    game.owner_id = 1
+    game.game_state = u'vote'
+    game.players = range(1, players_count + 2)
+    game.update_timer()
+    for player_id in xrange(players_count):
+        game.wait({'modified': [game.get_modified()]})
+    return game
+
+class Service:
+    settings = {}
+
+def Run(players=10000):
+    service = Service()
+    shared = [service, reactor]
+
+    empty = resident_game(service, 1, 0)
+    game_bytes = sizeof(empty, shared)
+    full = resident_game(service, 2, CardstoriesGame.NPLAYERS - 1)
+    poll_bytes = float(sizeof(full, shared) - game_bytes) / (CardstoriesGame.NPLAYERS - 1)
+    # Same layout as the activity plugin: active polls by player id.
+    online_players = dict([(player_id, 1) for player_id in xrange(players)])
+    online_bytes = float(sizeof(online_players, shared)) / players
+
+    print 'game: %d bytes per resident game' % game_bytes
+    print 'player: %.0f bytes per connected player (%.0f for the poll, %.0f for the activity)' % (poll_bytes + online_bytes, poll_bytes, online_bytes)
+    empty.destroy()
+    full.destroy()
+
+if __name__ == '__main__':
+    Run(*[int(arg) for arg in sys.argv[1:]])
@@ -114,7 +114,54 @@ class CardstoriesAuthTest(unittest.TestCase):
         check_call_for_each("get_players_names", "get_player_name")
         check_call_for_each("get_players_emails", "get_player_email")
         check_call_for_each("get_players_avatars_urls", "get_player_avatar_url")
-        
+
+    @defer.inlineCallbacks
+    def test02_get_players_ids_duplicates(self):
+        '''Each distinct email is looked up (and created) once'''
+
+        auth = Auth()
+        created = []
+        def get_player_id(email, create=False):
+            created.append(email)
+            return defer.succeed(len(created))
+        auth.get_player_id = get_player_id
+
+        ids = yield auth.get_players_ids(['a@example.com', 'b@example.com', 'a@example.com'], create=True)
+        self.assertEquals(created, [u'a@example.com', u'b@example.com'])
+        self.assertEquals(ids, [1, 2, 1])
+
+    @defer.inlineCallbacks
+    def test03_get_players_info(self):
+        '''The default bulk player info method resolves all players concurrently'''
+
+        auth = Auth()
+        pending = {}
+        def get_player_name(id):
+            pending[('name', id)] = defer.Deferred()
+            return pending[('name', id)]
+        auth.get_player_name = get_player_name
+        auth.get_player_avatar_url = lambda id: '/avatar/%d.jpg' % id
+
+        d = auth.get_players_info([1, 2])
+        # Both names are requested before any of them is answered.
+        self.assertEquals(sorted(pending.keys()), [('name', 1), ('name', 2)])
+        pending[('name', 2)].callback('Player 2')
+        pending[('name', 1)].callback('Player 1')
+        infos = yield d
+        self.assertEquals(infos, [{'name': 'Player 1', 'avatar_url': '/avatar/1.jpg'},
+                                  {'name': 'Player 2', 'avatar_url': '/avatar/2.jpg'}])
+
+        # Failures are propagated as is.
+        def fail(id):
+            raise KeyError(id)
+        auth.get_player_avatar_url = fail
+        error = None
+        try:
+            yield auth.get_players_info([1])
+        except KeyError as e:
+            error = e
+        self.assertEquals(error.args, (1,))
+
             
 # Main ########################################################################
 
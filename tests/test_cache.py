@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Imports #####################################################################
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath("..")) # so that for M-x pdb works
+
+from twisted.trial import unittest, runner, reporter
+
+from cardstories.cache import LRUCache
+
+# Classes #####################################################################
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def seconds(self):
+        return self.now
+
+class CardstoriesCacheTest(unittest.TestCase):
+
+    def test01_lru(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        # 'b' is now the least recently used entry
+        cache.set('c', 3)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+        self.assertEquals(cache.get('b', 'DEFAULT'), 'DEFAULT')
+        cache.delete('a')
+        self.assertFalse('a' in cache)
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+
+    def test02_ttl(self):
+        clock = Clock()
+        cache = LRUCache(10, ttl=60, seconds=clock.seconds)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=5)
+        cache.set('c', 3, ttl=120)
+        clock.now += 10
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(len(cache), 2)
+        clock.now += 60
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.get('c'), 3)
+
+    def test03_stats(self):
+        cache = LRUCache(10)
+        self.assertEquals(cache.hit_ratio(), 0.0)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        self.assertEquals(cache.stats(), {'size': 1,
+                                          'max_size': 10,
+                                          'hits': 3,
+                                          'misses': 1,
+                                          'hit_ratio': 0.75})
+
+# Main ########################################################################
+
+def Run():
+    loader = runner.TestLoader()
+#    loader.methodPrefix = "test01_"
+    suite = loader.suiteFactory()
+    suite.addTest(loader.loadClass(CardstoriesCacheTest))
+    return runner.TrialRunner(
+        reporter.VerboseTextReporter,
+        tracebackFormat='default',
+        ).run(suite)
+
+if __name__ == '__main__':
+    if Run().wasSuccessful():
+        sys.exit(0)
+    else:
+        sys.exit(1)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Imports #####################################################################
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath("..")) # so that for M-x pdb works
+import imp
+import sqlite3
+from StringIO import StringIO
+
+from twisted.trial import unittest, runner, reporter
+
+from cardstories import levels
+from cardstories.service import CardstoriesService
+
+tool = imp.load_source('cardstories_levels', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          '..', 'bin', 'cardstories_levels.py'))
+
+# Classes #####################################################################
+
+class CardstoriesLevelsToolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.database = 'test_levels.sqlite'
+        if os.path.exists(self.database):
+            os.unlink(self.database)
+        self.db = sqlite3.connect(self.database)
+        c = self.db.cursor()
+        CardstoriesService({}).create_base(c)
+        self.db.commit()
+        c.close()
+
+    def tearDown(self):
+        self.db.close()
+        os.unlink(self.database)
+
+    def insert_player(self, player_id, score, levelups, earned_cards):
+        c = self.db.cursor()
+        c.execute("INSERT INTO players (player_id, score, score_prev, levelups, earned_cards) VALUES (?, ?, ?, ?, ?)",
+                  [player_id, score, 0, levelups, earned_cards])
+        self.db.commit()
+        c.close()
+
+    def test00_compute_levels(self):
+        scores = [0, 1, 10, 4112, 123456]
+        self.assertEquals(list(tool.compute_levels(scores)),
+                          [levels.calculate_level(score)[0] for score in scores])
+        self.assertEquals(len(tool.compute_levels([])), 0)
+
+    def test01_run(self):
+        earnable = tool.earnable_cards()
+        # Consistent: level 1, nothing earned.
+        self.insert_player(1, 0, 0, None)
+        # Consistent: level 3, two cards earned (and some bought cards).
+        score = levels.thresholds(1)[1]
+        self.assertEquals(levels.calculate_level(score)[0], 3)
+        self.insert_player(2, score, 2, earnable[0] + earnable[1] + chr(44))
+        # Inconsistent: level 3, but only one card earned.
+        self.insert_player(3, score, 1, earnable[0])
+        # Inconsistent: levelups doesn't match the earned cards.
+        self.insert_player(4, 0, 3, earnable[0] + earnable[1])
+
+        out = StringIO()
+        count = tool.run(self.database, chunk_size=2, out=out)
+        self.assertEquals(count, 2)
+        self.assertTrue('player_id=3 ' in out.getvalue())
+        self.assertTrue('player_id=4 ' in out.getvalue())
+
+        count = tool.run(self.database, chunk_size=2, write=True, out=StringIO())
+        self.assertEquals(count, 2)
+        c = self.db.cursor()
+        c.execute("SELECT levelups, earned_cards FROM players WHERE player_id = 3")
+        levelups, earned_cards = c.fetchone()
+        self.assertEquals(levelups, 2)
+        self.assertEquals(len(earned_cards), 2)
+        self.assertEquals(earned_cards[0], earnable[0])
+        self.assertTrue(earned_cards[1] in earnable[1:])
+        c.execute("SELECT levelups, earned_cards FROM players WHERE player_id = 4")
+        self.assertEquals(c.fetchone(), (2, earnable[0] + earnable[1]))
+        c.close()
+
+        self.assertEquals(tool.run(self.database, out=StringIO()), 0)
+
+# Main ########################################################################
+
+def Run():
+    loader = runner.TestLoader()
+#    loader.methodPrefix = "test01_"
+    suite = loader.suiteFactory()
+    suite.addTest(loader.loadClass(CardstoriesLevelsToolTest))
+    return runner.TrialRunner(
+        reporter.VerboseTextReporter,
+        tracebackFormat='default',
+        ).run(suite)
+
+if __name__ == '__main__':
+    if Run().wasSuccessful():
+        sys.exit(0)
+    else:
+        sys.exit(1)
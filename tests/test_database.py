@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Imports #####################################################################
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath("..")) # so that for M-x pdb works
+import sqlite3
+
+from twisted.trial import unittest, runner, reporter
+from twisted.internet import defer, reactor
+
+from cardstories.database import ConnectionPool
+
+# Classes #####################################################################
+
+class CardstoriesDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.database = 'test.sqlite'
+        if os.path.exists(self.database):
+            os.unlink(self.database)
+        self.db = sqlite3.connect(self.database, isolation_level=None)
+        self.db.execute("CREATE TABLE counters ( value INTEGER )")
+
+    def tearDown(self):
+        self.pool.close()
+        self.db.close()
+        os.unlink(self.database)
+
+    def lock(self):
+        '''Holds the lock of the database until release() is called'''
+        self.db.execute("BEGIN EXCLUSIVE")
+
+    def release(self):
+        self.db.execute("COMMIT")
+
+    def insertInteraction(self, transaction, value):
+        transaction.execute("INSERT INTO counters (value) VALUES (?)", [ value ])
+
+    @defer.inlineCallbacks
+    def test01_retry(self):
+        # timeout=0: sqlite itself doesn't wait for the lock to be released.
+        self.pool = ConnectionPool(database=self.database, timeout=0, check_same_thread=False,
+                                   retry_delay=0.01, retry_deadline=5)
+        self.lock()
+        reactor.callLater(0.1, self.release)
+        yield self.pool.runInteraction(self.insertInteraction, 1)
+        self.assertTrue(self.pool.retries > 0)
+        self.assertEquals(self.db.execute("SELECT value FROM counters").fetchall(), [(1,)])
+        # runOperation is an interaction too.
+        retries = self.pool.retries
+        self.lock()
+        reactor.callLater(0.1, self.release)
+        yield self.pool.runOperation("INSERT INTO counters (value) VALUES (2)")
+        self.assertTrue(self.pool.retries > retries)
+        self.assertEquals(self.db.execute("SELECT COUNT(*) FROM counters").fetchone()[0], 2)
+
+    @defer.inlineCallbacks
+    def test02_deadline(self):
+        self.pool = ConnectionPool(database=self.database, timeout=0, check_same_thread=False,
+                                   retry_delay=0.01, retry_deadline=0.1)
+        self.lock()
+        try:
+            yield self.pool.runInteraction(self.insertInteraction, 1)
+            raised = False
+        except sqlite3.OperationalError as e:
+            raised = True
+            self.assertSubstring('locked', str(e))
+        self.assertTrue(raised)
+        self.assertTrue(self.pool.retries > 0)
+        self.release()
+        self.assertEquals(self.db.execute("SELECT COUNT(*) FROM counters").fetchone()[0], 0)
+
+    @defer.inlineCallbacks
+    def test03_other_errors(self):
+        self.pool = ConnectionPool(database=self.database, timeout=0, check_same_thread=False)
+        try:
+            yield self.pool.runQuery("SELECT * FROM nosuchtable")
+            raised = False
+        except sqlite3.OperationalError:
+            raised = True
+        self.assertTrue(raised)
+        self.assertEquals(self.pool.retries, 0)
+
+# Main ########################################################################
+
+def Run():
+    loader = runner.TestLoader()
+#    loader.methodPrefix = "test01_"
+    suite = loader.suiteFactory()
+    suite.addTest(loader.loadClass(CardstoriesDatabaseTest))
+    return runner.TrialRunner(
+        reporter.VerboseTextReporter,
+        tracebackFormat='default',
+        ).run(suite)
+
+if __name__ == '__main__':
+    if Run().wasSuccessful():
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+# Interpreted by emacs
+# Local Variables:
+# compile-command: "python-coverage -e ; PYTHONPATH=.. python-coverage -x test_database.py ; python-coverage -m -a -r ../cardstories/database.py"
+# End:
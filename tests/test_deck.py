@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+# Imports #####################################################################
+
+import sys
+import os
+sys.path.insert(0, os.path.abspath("..")) # so that for M-x pdb works
+import random
+
+from twisted.trial import unittest, runner, reporter
+
+from cardstories.deck import Deck
+from cardstories.game import CardstoriesGame
+
+# Classes #####################################################################
+
+class CardstoriesDeckTest(unittest.TestCase):
+
+    def test01_set(self):
+        deck = Deck.range(1, 5)
+        self.assertEquals([1, 2, 3, 4, 5], list(deck))
+        self.assertEquals(5, len(deck))
+        self.assertTrue(1 in deck)
+        self.assertFalse(0 in deck)
+        self.assertFalse(6 in deck)
+        deck.remove(3)
+        deck.add(40)
+        self.assertEquals([1, 2, 4, 5, 40], list(deck))
+        self.assertEquals([1, 40], list(deck - Deck.range(2, 5)))
+        self.assertEquals(Deck.range(1, 5) | Deck.fromstring(chr(6)), Deck.range(1, 6))
+        self.assertEquals(0, len(Deck()))
+
+    def test02_strings(self):
+        cards = ''.join([chr(card) for card in (53, 1, 36, 12)])
+        deck = Deck.fromstring(cards)
+        self.assertEquals([1, 12, 36, 53], list(deck))
+        self.assertEquals(Deck.fromstring(deck.tostring()), deck)
+        self.assertEquals(Deck.fromstring(unicode(cards)), deck)
+        self.assertEquals(Deck.fromstring(None), Deck())
+        self.assertEquals('', Deck().tostring())
+
+    def test03_sample(self):
+        rand = random.Random(1)
+        deck = Deck.range(1, 36)
+        dealt = []
+        while len(deck):
+            cards = deck.sample(6, random=rand)
+            self.assertEquals(6, len(cards))
+            for card in cards:
+                self.assertFalse(card in deck)
+            dealt.extend(cards)
+        # every card was drawn once
+        self.assertEquals(range(1, 37), sorted(dealt))
+        # a sparse deck is sampled as well
+        deck = Deck.fromstring(chr(1) + chr(53))
+        self.assertEquals([1, 53], sorted(deck.sample(6, random=rand)))
+        self.assertEquals([], deck.sample(6, random=rand))
+
+    def test04_deal(self):
+        class Service:
+            settings = {}
+        game = CardstoriesGame(Service())
+        earned = ''.join([chr(card) for card in (40, 41)])
+        dealt = None
+        hands = []
+        for i in xrange(6):
+            hand, dealt = game.deal(earned, dealt)
+            self.assertEquals(CardstoriesGame.CARDS_PER_PLAYER, len(hand))
+            hands.append(hand)
+        # the dealt cards are appended, in the order of the hands
+        self.assertEquals(''.join(hands), dealt)
+        self.assertEquals(len(dealt), len(set(dealt)))
+        self.assertTrue(set(dealt) <= set([chr(card) for card in range(1, CardstoriesGame.NCARDS + 1) + [40, 41]]))
+        game.destroy()
+
+# Main ########################################################################
+
+def Run():
+    loader = runner.TestLoader()
+#    loader.methodPrefix = "test01_"
+    suite = loader.suiteFactory()
+    suite.addTest(loader.loadClass(CardstoriesDeckTest))
+    return runner.TrialRunner(
+        reporter.VerboseTextReporter,
+        tracebackFormat='default',
+        ).run(suite)
+
+if __name__ == '__main__':
+    if Run().wasSuccessful():
+        sys.exit(0)
+    else:
+        sys.exit(1)
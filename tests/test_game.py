@@ -26,8 +26,10 @@ from twisted.trial import unittest, runner, reporter
 from twisted.internet import defer
 
 from cardstories.game import CardstoriesGame
+from cardstories.deck import Deck
 from cardstories.service import CardstoriesService
 from cardstories.exceptions import CardstoriesWarning
+import cardstories.event_log as event_log
 
 from twisted.internet import base
 base.DelayedCall.debug = True
@@ -313,6 +315,16 @@ class CardstoriesGameTest(unittest.TestCase):
         self.assertEquals(cards_length + self.game.CARDS_PER_PLAYER, c.fetchone()[0])
         c.execute("SELECT LENGTH(cards) FROM player2game WHERE game_id = %d AND player_id = %d" % (game_id, player_id))
         self.assertEquals(self.game.CARDS_PER_PLAYER, c.fetchone()[0])
+        # the game keeps the dealt cards instead of reading them for each deal
+        c.execute("SELECT cards FROM games WHERE id = %d" % game_id)
+        cards = c.fetchone()[0]
+        self.assertEquals(cards, self.game.cards)
+        self.assertEquals(Deck.fromstring(cards), self.game.dealt)
+        loaded = CardstoriesGame(self.service, game_id)
+        loaded.load(c)
+        self.assertEquals(cards, loaded.cards)
+        self.assertEquals(self.game.dealt, loaded.dealt)
+        loaded.destroy()
         c.execute("SELECT player_id FROM players WHERE player_id = %s" % player_id)
         self.assertEquals(c.fetchone()[0], player_id)
         c.close()
@@ -1018,6 +1030,10 @@ class CardstoriesGameTest(unittest.TestCase):
         result = yield self.game.invite(invited)
         self.assertEquals(result['type'], 'invite')
         self.assertEquals(result['invited'], [])
+        # the invitations are logged in the same transaction
+        c.execute("SELECT player_id, data FROM event_logs WHERE game_id = %d AND event_type = %d" % (game_id, event_log.PLAYER_INVITED))
+        self.assertEquals(c.fetchall(), [(owner_id, str(invited[0])),
+                                         (owner_id, str(invited[1]))])
         #
         # load an existing game, invitations included
         #
@@ -1032,6 +1048,11 @@ class CardstoriesGameTest(unittest.TestCase):
         yield self.game.voting(owner_id)
         c.execute("SELECT * FROM invitations WHERE game_id = %d" % game_id)
         self.assertEquals(c.fetchall(), [])
+        # a player listed twice is invited once
+        result = yield self.game.invite([22, 22])
+        self.assertEquals(result['invited'], [22])
+        c.execute("SELECT * FROM invitations WHERE game_id = %d" % game_id)
+        self.assertEquals(c.fetchall(), [(22, game_id)])
         c.close()
 
     @defer.inlineCallbacks
@@ -1079,13 +1100,14 @@ class CardstoriesGameTest(unittest.TestCase):
         self.assertEquals(game_info['state'], u'invitation')
         self.assertEquals([ player['id'] for player in game_info['players']], [owner_id] + players)
         d = self.game.poll({'modified':[self.game.get_modified()]})
+        canceled = []
         def check(result):
             self.assertEqual(result['type'], 'cancel')
             self.assertEqual(result['modified'], [self.game.modified])
-            self.game.canceled = True
+            canceled.append(True)
         d.addCallback(check)
         result = yield self.game.cancel()
-        self.assertTrue(self.game.canceled)
+        self.assertTrue(canceled)
         self.assertEquals(result, {})
         self.game.service = self.service
         game_info, players_game_info = yield self.game.game(owner_id)
@@ -1178,15 +1200,16 @@ class CardstoriesGameTest(unittest.TestCase):
         self.game.settings['game-timeout'] = 0.5
         game_id, winner_card = yield self.create_game(owner_id, sentence)
         d = self.game.poll({'modified': [self.game.get_modified()]})
+        timedout = []
         def check(result):
             self.assertEqual(self.game.get_players(), [owner_id])
             self.assertEqual(result['type'], 'cancel')
             self.assertEqual(result['modified'], [self.game.modified])
-            self.game.timedout = True
+            timedout.append(True)
             return result
         d.addCallback(check)
         result = yield d
-        self.assertTrue(self.game.timedout)
+        self.assertTrue(timedout)
 
     @defer.inlineCallbacks
     def test17_nonexistent_game(self):
@@ -1452,15 +1475,16 @@ class CardstoriesGameTest(unittest.TestCase):
 
         # Mock out the game.destroy() method.
         orig_destroy = CardstoriesGame.destroy
+        destroyed = []
         def fake_destroy(self):
-            self.destroy_called = True
+            destroyed.append(self)
             orig_destroy(self)
         CardstoriesGame.destroy = fake_destroy
 
         # Complete the game, which should in turn call game.destroy().
         yield self.game.complete(owner_id)
         CardstoriesGame.destroy = orig_destroy
-        self.assertTrue(self.game.destroy_called)
+        self.assertEquals([self.game], destroyed)
         # Clean up the mock.
 
     @defer.inlineCallbacks
@@ -1489,6 +1513,100 @@ class CardstoriesGameTest(unittest.TestCase):
         # Clean up the mock.
         CardstoriesGame.playerInteraction = orig_playerInteraction
 
+    @defer.inlineCallbacks
+    def test24_actions_queue(self):
+        sentence = 'SENTENCE'
+        owner_id = 12
+        game_id, winner_card = yield self.create_game(owner_id, sentence)
+        player_id = 20
+        while len(self.game.players) < self.game.NPLAYERS - 1:
+            yield self.game.participate(player_id)
+            player_id += 1
+        #
+        # Two players race for the last seat: the second one is rejected
+        # without touching the database.
+        #
+        original_runInteraction = self.service.db.runInteraction
+        interactions = []
+        def runInteraction(interaction, *args, **kwargs):
+            interactions.append(interaction.__name__)
+            return original_runInteraction(interaction, *args, **kwargs)
+        self.service.db.runInteraction = runInteraction
+        first = self.game.participate(player_id)
+        second = self.game.participate(player_id + 1)
+        yield first
+        try:
+            yield second
+            code = None
+        except CardstoriesWarning as e:
+            code = e.code
+        self.assertEquals('GAME_FULL', code)
+        self.assertEquals(1, interactions.count('playerInteraction'))
+        self.assertEquals(1, interactions.count('participateInteraction'))
+        self.assertEquals(self.game.NPLAYERS, len(self.game.players))
+        c = self.db.cursor()
+        c.execute("SELECT players FROM games WHERE id = %d" % game_id)
+        self.assertEquals(self.game.NPLAYERS, c.fetchone()[0])
+        #
+        # A pick queued after the game moved to the vote is rejected.
+        #
+        yield self.game.pick(player_id, 1)
+        yield self.game.pick(player_id - 1, 2)
+        del interactions[:]
+        voting = self.game.voting(owner_id)
+        pick = self.game.pick(player_id - 2, 3)
+        yield voting
+        try:
+            yield pick
+            code = None
+        except CardstoriesWarning as e:
+            code = e.code
+        self.assertEquals('WRONG_STATE_FOR_PICKING', code)
+        self.assertFalse('pickInteraction' in interactions)
+        self.service.db.runInteraction = original_runInteraction
+        c.close()
+
+    @defer.inlineCallbacks
+    def test25_complete_statements(self):
+        owner_id = 12
+        players = [13, 14, 15, 16, 17]
+        game_id, winner_card = yield self.create_game(owner_id, 'SENTENCE')
+        for player_id in players:
+            yield self.game.participate(player_id)
+            player = yield self.game.player2game(player_id)
+            yield self.game.pick(player_id, player['cards'][0])
+        yield self.game.voting(owner_id)
+        for player_id in players:
+            yield self.game.vote(player_id, winner_card)
+        #
+        # Count the statements run to complete the game: it doesn't
+        # depend on the number of players.
+        #
+        statements = []
+        class Transaction:
+            def __init__(self, transaction):
+                self.transaction = transaction
+            def execute(self, *args):
+                statements.append(args[0])
+                return self.transaction.execute(*args)
+            def executemany(self, *args):
+                statements.append(args[0])
+                return self.transaction.executemany(*args)
+            def fetchall(self):
+                return self.transaction.fetchall()
+        completeInteraction = CardstoriesGame.completeInteraction
+        def counted(game, transaction, *args):
+            return completeInteraction(game, Transaction(transaction), *args)
+        self.patch(CardstoriesGame, 'completeInteraction', counted)
+        db = self.service.db
+        yield self.game.complete(owner_id)
+        self.assertEquals(5, len(statements))
+        rows = yield db.runQuery("SELECT COUNT(*) FROM player2game WHERE game_id = ? AND win = 'y'", [ game_id ])
+        self.assertEquals(len(players), rows[0][0])
+        rows = yield db.runQuery("SELECT player_id, score FROM players ORDER BY player_id")
+        self.assertEquals([(owner_id, self.game.POINTS_GM_LOST)] +
+                          [(player_id, self.game.POINTS_P_WON) for player_id in players], rows)
+
 
 def Run():
     loader = runner.TestLoader()
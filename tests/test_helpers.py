@@ -25,11 +25,14 @@
 
 import sys
 import os
+import copy
+import json
 sys.path.insert(0, os.path.abspath("..")) # so that for M-x pdb works
 
 from twisted.trial import unittest, runner, reporter
+from twisted.internet import defer
 
-from cardstories.helpers import Lockable, Observable
+from cardstories.helpers import Lockable, Observable, gather, dumps, Fragment, Serialized
 from cardstories.exceptions import CardstoriesException
 
 # Classes #####################################################################
@@ -71,12 +74,80 @@ class CardstoriesLockTest(unittest.TestCase):
         lock.unlock(lock_type2)
         lock.lock(lock_type2)
 
+class CardstoriesGatherTest(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test01_gather(self):
+        d1 = defer.Deferred()
+        d2 = defer.Deferred()
+        d = gather([d1, d2, defer.succeed(3)])
+        d2.callback(2)
+        d1.callback(1)
+        results = yield d
+        self.assertEquals(results, [1, 2, 3])
+
+        results = yield gather([])
+        self.assertEquals(results, [])
+
+    @defer.inlineCallbacks
+    def test02_gather_error(self):
+        error = None
+        try:
+            yield gather([defer.succeed(1), defer.fail(ValueError('FAIL'))])
+        except ValueError as e:
+            error = e
+        self.assertEquals(error.args, ('FAIL',))
+
+class CardstoriesDumpsTest(unittest.TestCase):
+
+    def test01_fragment(self):
+        fragment = Fragment({'id': 1, 'players': [2, 3]})
+        self.assertEquals(fragment.serialize(), json.dumps({'id': 1, 'players': [2, 3]}))
+        self.assertIdentical(fragment.encoded, fragment.serialize())
+
+        # added keys are encoded on their own
+        fragment['type'] = 'game'
+        self.assertEquals(json.loads(fragment.serialize()), {'id': 1, 'players': [2, 3], 'type': 'game'})
+        self.assertEquals(fragment.added, ['type'])
+
+        # copies keep the encoding
+        for other in (fragment.copy(), copy.deepcopy(fragment)):
+            self.assertTrue(isinstance(other, Fragment))
+            self.assertEquals(other, fragment)
+            self.assertEquals(other.serialize(), fragment.serialize())
+
+        # replacing or removing a key discards it
+        fragment['id'] = 4
+        self.assertEquals(fragment.encoded, None)
+        self.assertEquals(json.loads(fragment.serialize())['id'], 4)
+        fragment.serialize()
+        del fragment['type']
+        self.assertEquals(json.loads(fragment.serialize()), {'id': 4, 'players': [2, 3]})
+        fragment.update({'id': 5})
+        self.assertEquals(json.loads(fragment.serialize())['id'], 5)
+
+    def test02_dumps(self):
+        player = Fragment({'name': u'N\u00e9o'})
+        player.encoded = '{"name": "SPLICED"}'
+        value = [{'type': 'players_info', '1': player},
+                 {'type': 'chat', 'messages': [player, {'sentence': u'\x00 0'}]},
+                 Serialized('{"serialized": true}'),
+                 {'deeper': [[player]]}]
+        self.assertEquals(json.loads(dumps(value)),
+                          [{'type': 'players_info', '1': {'name': 'SPLICED'}},
+                           {'type': 'chat', 'messages': [{'name': 'SPLICED'}, {'sentence': u'\x00 0'}]},
+                           {'serialized': True},
+                           {'deeper': [[{'name': u'N\u00e9o'}]]}])
+        self.assertEquals(dumps({'a': [1, None]}), json.dumps({'a': [1, None]}))
+
 # Main ########################################################################
 
 def Run():
     loader = runner.TestLoader()
     suite = loader.suiteFactory()
     suite.addTest(loader.loadClass(CardstoriesLockTest))
+    suite.addTest(loader.loadClass(CardstoriesGatherTest))
+    suite.addTest(loader.loadClass(CardstoriesDumpsTest))
     return runner.TrialRunner(
         reporter.VerboseTextReporter,
         tracebackFormat='default',
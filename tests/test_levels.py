@@ -44,6 +44,42 @@ class CardstoriesLevelsTest(unittest.TestCase):
         self.assertEquals(level2, level1 + 1)
         self.assertEquals(score_next2, score_left2)
 
+    def test01_calculate_level_reference(self):
+        # Straightforward implementation of the levels formula, walking
+        # one level at a time.
+        def reference(score):
+            if not score or score < 0:
+                return 1, 1, 1
+            level = 2
+            remainder = score - 1
+            score_next = levels.to_next(level)
+            while remainder >= score_next:
+                remainder -= score_next
+                level += 1
+                score_next = levels.to_next(level)
+            return level, score_next, score_next - remainder
+
+        for score in [None, -3, 0, 1, 2, 10, 11, 12, 100] + range(4000, 4200) + [123456]:
+            self.assertEquals(levels.calculate_level(score), reference(score))
+
+    def test02_calculate_levels(self):
+        scores = [0, 4112, 1, 250, None, 4112, -3, 2] + range(4000, 4200) + [123456]
+        self.assertEquals(levels.calculate_levels(scores),
+                          [levels.calculate_level(score) for score in scores])
+        self.assertEquals(levels.calculate_levels([]), [])
+
+    def test03_retune(self):
+        score = 4112
+        level, _, _ = levels.calculate_level(score)
+        orig = levels.LEVEL_A
+        levels.LEVEL_A = orig * 2
+        try:
+            level_retuned, _, _ = levels.calculate_level(score)
+            self.assertTrue(level_retuned < level)
+        finally:
+            levels.LEVEL_A = orig
+        self.assertEquals(levels.calculate_level(score)[0], level)
+
 # Main ########################################################################
 
 def Run():
@@ -132,6 +132,26 @@ class PollableTest(unittest.TestCase):
         p.set_modified(modified)
         self.assertEquals(modified, p.get_modified())
 
+    def test04_leaks(self):
+        class Owner(poll.Pollable):
+            pass
+        name = Owner.__module__ + '.Owner'
+        garbage = poll.leaks()['garbage']
+        self.assertFalse(name in poll.leaks()['pollables'])
+        p = Owner(100)
+        self.assertEquals(1, poll.leaks()['pollables'][name])
+        # Pollables in a reference cycle (e.g. a game and its service) are
+        # collected once dropped: there is no finalizer to stop the
+        # garbage collector.
+        p.owned = Owner(100)
+        p.owned.owner = p
+        self.assertEquals(2, poll.leaks()['pollables'][name])
+        p.destroy()
+        p = None
+        leaks = poll.leaks()
+        self.assertFalse(name in leaks['pollables'])
+        self.assertEquals(garbage, leaks['garbage'])
+
 def Run():
     loader = runner.TestLoader()
 #    loader.methodPrefix = "test_trynow"
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+import sys
+import os
+sys.path.insert(0, os.path.abspath("..")) # so that for M-x pdb works
+
+from twisted.trial import unittest, runner, reporter
+from twisted.internet import defer, reactor, threads
+
+from cardstories.rpc import CardstoriesRPCFactory
+from cardstories.site import CardstoriesTree, CardstoriesSite
+from cardstories.helpers import Serialized
+from website.cardstories import rpc as client
+
+class CardstoriesServiceMockup:
+    def __init__(self):
+        self.settings = {'static': os.getcwd(),
+                         'internal-secret': 'SECRET'}
+
+    def handle(self, result, args, internal_request=False):
+        if args['action'] == ['fail']:
+            raise Exception('failed')
+        if args['action'] == ['serialized']:
+            return Serialized('{"serialized": true}')
+        if args['action'] == ['batch']:
+            return [{'type': 'participate'}, [{'players': [{'id': 1}]}, {'type': 'players_info'}]]
+        return {'args': args, 'internal': internal_request}
+
+class CardstoriesRPCTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = CardstoriesServiceMockup()
+        self.site = CardstoriesSite(CardstoriesTree(self.service), {}, [])
+        self.path = os.path.abspath('rpc.sock')
+        self.port = reactor.listenUNIX(self.path, CardstoriesRPCFactory(self.site))
+        self.client = client.RPCClient(self.path)
+
+    def tearDown(self):
+        self.client.close()
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test00_handle(self):
+        results = yield threads.deferToThread(self.client.handle, [
+                {'path': 'resource', 'args': {'action': 'state', 'game_id': 5}},
+                {'path': 'internal', 'args': {'action': 'grant_cards_to_player', 'card_ids': [1, 2], 'secret': 'SECRET'}},
+                {'path': 'internal', 'args': {'action': 'grant_cards_to_player'}},
+                {'path': 'resource', 'args': {'action': 'serialized'}}])
+        self.assertEquals(results[0], {'args': {'action': ['state'], 'game_id': ['5']}, 'internal': False})
+        self.assertEquals(results[1]['args']['card_ids'], ['1', '2'])
+        self.assertTrue(results[1]['internal'])
+        self.assertEquals(results[2], {'error': {'code': 'UNAUTHORIZED'}})
+        self.assertEquals(results[3], {'serialized': True})
+
+        # The connection is kept open.
+        sock = self.client.sock
+        results = yield threads.deferToThread(self.client.handle, [{'path': 'resource', 'args': {'action': 'state'}}])
+        self.assertEquals(results[0]['args']['action'], ['state'])
+        self.assertEquals(self.client.sock, sock)
+
+    @defer.inlineCallbacks
+    def test01_large_values(self):
+        sentence = u'é' * 100000
+        results = yield threads.deferToThread(self.client.handle, [{'path': 'resource', 'args': {'action': 'state', 'sentence': sentence}}])
+        self.assertEquals(results[0]['args']['sentence'], [sentence])
+
+    @defer.inlineCallbacks
+    def test01_batch(self):
+        results = yield threads.deferToThread(self.client.handle, [{'path': 'resource', 'args': {'action': 'batch'}}])
+        self.assertEquals(results[0], [{'type': 'participate'}, [{'players': [{'id': 1}]}, {'type': 'players_info'}]])
+
+    @defer.inlineCallbacks
+    def test02_errors(self):
+        raised = False
+        try:
+            yield threads.deferToThread(self.client.handle, [{'path': 'resource', 'args': {'action': 'fail'}}])
+        except client.RPCError as e:
+            raised = True
+            self.assertSubstring('failed', str(e))
+        self.assertTrue(raised)
+        self.flushLoggedErrors()
+
+        unavailable = client.RPCClient(os.path.abspath('nosuch.sock'))
+        self.assertRaises(client.RPCUnavailable, unavailable.handle, [{'path': 'resource', 'args': {}}])
+
+def Run():
+    loader = runner.TestLoader()
+#    loader.methodPrefix = "test03"
+    suite = loader.suiteFactory()
+    suite.addTest(loader.loadClass(CardstoriesRPCTest))
+
+    return runner.TrialRunner(
+        reporter.VerboseTextReporter,
+        tracebackFormat='default',
+        ).run(suite)
+
+if __name__ == '__main__':
+    if Run().wasSuccessful():
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+# Interpreted by emacs
+# Local Variables:
+# compile-command: "python-coverage -e ; PYTHONPATH=.. python-coverage -x test_rpc.py ; python-coverage -m -a -r ../cardstories/rpc.py"
+# End:
@@ -20,6 +20,7 @@
 import sys
 import os
 import re
+import json
 sys.path.insert(0, os.path.abspath("..")) # so that for M-x pdb works
 import sqlite3
 
@@ -32,9 +33,10 @@ import twisted.web.error
 import cardstories.levels
 from cardstories.service import CardstoriesService, CardstoriesServiceConnector
 from cardstories.poll import Pollable
+from cardstories.helpers import Serialized, Fragment
 from cardstories.exceptions import CardstoriesWarning, CardstoriesException
 
-from twisted.internet import base, reactor, defer
+from twisted.internet import base, reactor, defer, task
 base.DelayedCall.debug = True
 
 class CardstoriesServiceTestNotify(unittest.TestCase):
@@ -321,6 +323,46 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
                                       'owner_id': [owner_id] })
         self.assertFalse(self.service.games.has_key(game_id))
 
+        # The render of the completed game is cached, for the spectators ...
+        db = self.service.db
+        class NoDatabase:
+            def runQuery(self, *args, **kwargs):
+                raise Exception('the database must not be used')
+        self.service.db = NoDatabase()
+        game_info, players_id_list = yield self.service.game({ 'action': ['game'],
+                                                               'game_id': [game_id],
+                                                               'player_id': [99] })
+        self.assertEquals(game_info['state'], 'complete')
+        self.assertEquals(game_info['winner_card'], winner_card)
+        self.assertEquals(game_info['self'], None)
+        self.assertEquals(sorted(players_id_list), [owner_id, 16, 17])
+        game_info['state'] = 'modified by the caller'
+        spectator_info, players_id_list = yield self.service.game({ 'action': ['game'],
+                                                                    'game_id': [game_id] })
+        self.assertEquals(spectator_info['state'], 'complete')
+        # ... and on the first lookup of each player, whose scores are read again.
+        self.service.db = db
+        game_info, players_id_list = yield self.service.game({ 'action': ['game'],
+                                                               'game_id': [game_id],
+                                                               'player_id': [winner_id] })
+        self.assertEquals(game_info['self'][1], winner_card)
+        queries = []
+        class CountingDatabase:
+            def runQuery(self, *args, **kwargs):
+                queries.append(args)
+                return db.runQuery(*args, **kwargs)
+        self.service.db = CountingDatabase()
+        c.execute("UPDATE players SET score = 1000 WHERE player_id = %d" % winner_id)
+        self.db.commit()
+        cached_info, players_id_list = yield self.service.game({ 'action': ['game'],
+                                                                 'game_id': [game_id],
+                                                                 'player_id': [winner_id] })
+        self.assertEquals(len(queries), 1)
+        winner = [player for player in cached_info['players'] if player['id'] == winner_id][0]
+        self.assertEquals(winner['score'], 1000)
+        self.assertEquals(cached_info['self'], game_info['self'])
+        self.service.db = db
+
     @defer.inlineCallbacks
     def test04_game(self):
         winner_card = 5
@@ -365,23 +407,25 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
         result = yield self.service.create({'owner_id': [owner_id]})
         game = self.service.games[result['game_id']]
 
+        changed = []
         def change(event):
             self.assertTrue(event['type'], 'change')
             self.assertTrue(event['game'].get_id(), game.get_id())
-            game.changed = True
+            changed.append(True)
         self.service.listen().addCallback(change)
         yield game.touch() # calls game_notify indirectly
-        self.assertTrue(game.changed)
+        self.assertTrue(changed)
         #
         # Event notification when a game is destroyed
         #
+        destroyed = []
         def destroy(event):
             self.assertTrue(event['type'], 'delete')
             self.assertTrue(event['game'].get_id(), game.get_id())
-            game.destroyed = True
+            destroyed.append(True)
         self.service.listen().addCallback(destroy)
         game.destroy()
-        self.assertTrue(game.destroyed)
+        self.assertTrue(destroyed)
         #
         # calling game_notify on a non existent game is a noop
         #
@@ -401,20 +445,19 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
         # all been done processing the notification.
         listener_deferreds = []
 
-        game.test_done = False
-        game.slow_listener_count = 0
+        status = {'test_done': False, 'slow_listener_count': 0}
 
         def slow_listener(event):
             d = defer.Deferred()
             listener_deferreds.append(d)
             def increment():
-                game.slow_listener_count += 1
+                status['slow_listener_count'] += 1
                 d.callback(True)
             # Beside the events we invoke intentionally, there is also a destroy
             # event that's dispatched when the test's teardown stage, when the service is stopped.
             # Don't schedule any more callLater calls after our test is done to not dirty
             # the reactor.
-            if not game.test_done:
+            if not status['test_done']:
                 # Reinsert this listener.
                 self.service.listen().addCallback(slow_listener)
                 reactor.callLater(0.1, increment)
@@ -433,9 +476,9 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
 
         # Block on listeners until they are done.
         yield defer.DeferredList(listener_deferreds)
-        game.test_done = True
+        status['test_done'] = True
 
-        self.assertEquals(game.slow_listener_count, 5)
+        self.assertEquals(status['slow_listener_count'], 5)
 
     @defer.inlineCallbacks
     def test08_poll(self):
@@ -462,13 +505,14 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
                                'type': ['game'],
                                'modified': [game.modified],
                                'game_id': [game.id]})
+        ok = []
         def check(result):
             self.assertEquals([game.id], result['game_id'])
-            game.ok = True
+            ok.append(True)
             return result
         d.addCallback(check)
         yield game.touch()
-        self.assertTrue(game.ok)
+        self.assertTrue(ok)
 
 
         #
@@ -517,6 +561,9 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
         # Will be triggered when the test has finished.
         test_finish = defer.Deferred()
 
+        # The games whose poll returned.
+        ok = []
+
         # Touch first game.
         d = self.service.poll({'action': ['poll'],
                                'type': ['tabs'],
@@ -526,12 +573,12 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
 
         def check1(result):
             self.assertEquals(games[0].modified, result['modified'][0])
-            games[0].ok = True
+            ok.append(games[0])
             return result
 
         d.addCallback(check1)
         games[0].touch()
-        self.assertTrue(games[0].ok)
+        self.assertTrue(games[0] in ok)
 
         # Touch third game.
         max_modified = games[0].modified # first game has just been touched, so it's the last one modified.
@@ -543,11 +590,11 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
 
         def check3(result):
             self.assertEquals(games[2].modified, result['modified'][0])
-            games[2].ok = True
+            ok.append(games[2])
             return result
         d.addCallback(check3)
         yield games[2].touch()
-        self.assertTrue(games[2].ok)
+        self.assertTrue(games[2] in ok)
 
         # Canceling a game should also make the poll return.
         max_modified = games[2].modified
@@ -558,11 +605,11 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
                                'game_id': [game_ids[1]]})
         def check4(result):
             self.assertEquals(games[1].modified, result['modified'][0])
-            games[1].ok = True
+            ok.append(games[1])
             return result
         d.addCallback(check4)
         yield games[1].cancel()
-        self.assertTrue(games[1].ok)
+        self.assertTrue(games[1] in ok)
 
         # Destroying a game shouldn't throw errors.
         d = self.service.poll({'action': ['poll'],
@@ -622,6 +669,70 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
         self.assertEquals(self.service.notification['game_id'], game_id)
         self.assertEquals(self.service.notification['player_id'], owner_id)
 
+    @defer.inlineCallbacks
+    def test08_spectate(self):
+        owner_id = 15
+        self.service.auth.get_player_name = Mock(return_value='Player')
+        self.service.auth.get_player_avatar_url = Mock(return_value='/avatar.jpg')
+        result = yield self.service.create({'owner_id': [owner_id]})
+        game = self.service.games[result['game_id']]
+
+        # the game changed since the last poll: the view is returned at once
+        view = yield self.service.spectate({'action': ['spectate'],
+                                            'modified': [0],
+                                            'game_id': [game.id]})
+        self.assertTrue(isinstance(view, Serialized))
+        states = json.loads(view)
+        self.assertEquals('game', states[0]['type'])
+        self.assertEquals(game.id, states[0]['id'])
+        self.assertEquals(game.get_modified(), states[0]['modified'])
+        self.assertEquals(None, states[0]['cards'])
+        self.assertEquals('players_info', states[1]['type'])
+
+        # spectators wait for the next change, and all get the same content
+        args = {'action': ['spectate'],
+                'modified': [game.get_modified()],
+                'game_id': [game.id]}
+        pollers = len(game.pollers)
+        d1 = self.service.spectate(args)
+        d2 = self.service.spectate(args)
+        self.assertEquals(2, len(game.spectators))
+        self.assertEquals(2, self.service.count_spectators())
+        self.assertEquals(pollers, len(game.pollers))
+        yield game.touch()
+        self.assertEquals([], game.spectators)
+        self.assertEquals(0, self.service.count_spectators())
+        view1 = yield d1
+        view2 = yield d2
+        self.assertIdentical(view1, view2)
+        self.assertNotEquals(view, view1)
+        self.assertEquals(game.get_modified(), json.loads(view1)[0]['modified'])
+
+        # spectators who time out are no longer counted
+        timeout = game.timeout
+        game.timeout = 0.01
+        args['modified'] = [game.get_modified()]
+        d = self.service.spectate(args)
+        self.assertEquals(1, self.service.count_spectators())
+        yield d
+        self.assertEquals(0, self.service.count_spectators())
+        game.timeout = timeout
+
+        # spectators are limited
+        self.service.settings['spectators-per-game'] = 1
+        args['modified'] = [game.get_modified()]
+        d = self.service.spectate(args)
+        yield self.assertFailure(self.service.spectate(args), CardstoriesWarning)
+        self.service.settings['spectators-per-game'] = 2
+        self.service.settings['spectators-max'] = 1
+        yield self.assertFailure(self.service.spectate(args), CardstoriesWarning)
+
+        # spectators are released when the game is canceled
+        yield game.cancel()
+        view = yield d
+        self.assertEquals('canceled', json.loads(view)[0]['state'])
+        self.assertEquals(0, self.service.count_spectators())
+
     @defer.inlineCallbacks
     def test09_cancel(self):
         card = 5
@@ -785,6 +896,15 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
                                                             'level': player_level}
                                          }])
 
+        # The encoding of the player info is kept and reused.
+        fragment = players_info[0][str(player_id)]
+        self.assertTrue(isinstance(fragment, Fragment))
+        players_info = yield self.service.player_info({'type': 'player_info', 'player_id': [player_id]})
+        self.assertIdentical(fragment.encoded, players_info[0][str(player_id)].encoded)
+        fake_get_player_name.return_value = u'other'
+        players_info = yield self.service.player_info({'type': 'player_info', 'player_id': [player_id]})
+        self.assertSubstring('"other"', players_info[0][str(player_id)].serialize())
+
         self.service.auth.get_player_name = default_get_player_name
         self.service.auth.get_player_avatar_url = default_get_player_avatar_url
 
@@ -1212,6 +1332,166 @@ class CardstoriesServiceTest(CardstoriesServiceTestBase):
         result = yield self.service.handle(defer.succeed(True), args, internal_request=True)
         self.assertEquals(result['status'], 'success')
 
+    @defer.inlineCallbacks
+    def test20_batch(self):
+        owner_id = 15
+        player_id = 16
+        self.service.auth.get_player_name = Mock(return_value='Player')
+        self.service.auth.get_player_avatar_url = Mock(return_value='/avatar.jpg')
+        game = yield self.service.create({'owner_id': [owner_id]})
+        game_id = game['game_id']
+        yield self.service.set_card({'action': ['set_card'],
+                                     'card': [1],
+                                     'game_id': [game_id],
+                                     'player_id': [owner_id]})
+        yield self.service.set_sentence({'action': ['set_sentence'],
+                                         'sentence': ['SENTENCE'],
+                                         'game_id': [game_id],
+                                         'player_id': [owner_id]})
+
+        # the actions run in order, with the arguments of the request
+        results = yield self.service.handle(None, {'action': ['batch'],
+                                                   'game_id': [str(game_id)],
+                                                   'player_id': [str(player_id)],
+                                                   'batch': [json.dumps([{'action': 'participate'},
+                                                                         {'action': 'state', 'type': 'game', 'modified': 0},
+                                                                         {'action': 'state', 'type': ['game'], 'modified': 0}])]})
+        self.assertEquals(3, len(results))
+        self.assertEquals('participate', results[0]['type'])
+        state = results[1][0]
+        self.assertEquals([owner_id, player_id], [player['id'] for player in state['players']])
+        self.assertNotEquals(None, state['self'])
+        # players_info is resolved once for all
+        self.assertIdentical(results[1][1], results[2][1])
+        self.assertEquals(2, self.service.auth.get_player_name.call_count)
+
+        # the batch stops at the first error
+        results = yield self.service.handle(None, {'action': ['batch'],
+                                                   'game_id': [str(game_id)],
+                                                   'player_id': [str(player_id)],
+                                                   'batch': [json.dumps([{'action': 'nosuch'},
+                                                                         {'action': 'state', 'type': 'game', 'modified': 0}])]})
+        self.assertEquals(1, len(results))
+        self.assertEquals('PANIC', results[0]['error']['code'])
+
+        # only the player_id of the request can be used
+        result = yield self.service.handle(None, {'action': ['batch'],
+                                                  'game_id': [str(game_id)],
+                                                  'player_id': [str(player_id)],
+                                                  'batch': [json.dumps([{'action': 'participate', 'player_id': 17}])]})
+        self.assertEquals('PANIC', result['error']['code'])
+        self.assertSubstring("can't use player_id 17", result['error']['data'])
+        game = yield self.service.games[game_id].game(None)
+        self.assertEquals([owner_id, player_id], [player['id'] for player in game[0]['players']])
+
+        result = yield self.service.handle(None, {'action': ['batch'], 'batch': ['{']})
+        self.assertEquals('PANIC', result['error']['code'])
+
+        # the actions waiting for a change of the game are not batched
+        for action in ('poll', 'spectate'):
+            result = yield self.service.handle(None, {'action': ['batch'],
+                                                      'game_id': [str(game_id)],
+                                                      'player_id': [str(player_id)],
+                                                      'batch': [json.dumps([{'action': 'state', 'type': 'game', 'modified': 0},
+                                                                            {'action': action, 'type': 'game', 'modified': 0}])]})
+            self.assertEquals('PANIC', result['error']['code'])
+            self.assertSubstring("can't hold %s" % action, result['error']['data'])
+        self.assertEquals(5, len(self.flushLoggedErrors()))
+
+    @defer.inlineCallbacks
+    def test21_request_id(self):
+        owner_id = 15
+        player_id = 16
+        game = yield self.service.create({'owner_id': [owner_id]})
+        game_id = game['game_id']
+        yield self.service.set_card({'action': ['set_card'],
+                                     'card': [1],
+                                     'game_id': [game_id],
+                                     'player_id': [owner_id]})
+        yield self.service.set_sentence({'action': ['set_sentence'],
+                                         'sentence': ['SENTENCE'],
+                                         'game_id': [game_id],
+                                         'player_id': [owner_id]})
+        game = self.service.games[game_id]
+        participate = {'action': ['participate'],
+                       'game_id': [str(game_id)],
+                       'player_id': [str(player_id)],
+                       'request_id': ['R1']}
+        # a retry sent while the first request is in flight waits for its result
+        first = self.service.handle(None, dict(participate))
+        retry = self.service.handle(None, dict(participate))
+        result = yield first
+        self.assertEquals('participate', result['type'])
+        retried = yield retry
+        self.assertEquals(result, retried)
+        # a retry sent later gets the same result, without touching the game
+        modified = game.get_modified()
+        retried = yield self.service.handle(None, dict(participate))
+        self.assertEquals(result, retried)
+        self.assertEquals(modified, game.get_modified())
+        self.assertEquals([owner_id, player_id], game.players)
+        # pick and vote are game actions too, the request_id is only
+        # shared by requests of the same action
+        result = yield self.service.handle(None, {'action': ['pick'],
+                                                  'card': [3],
+                                                  'game_id': [str(game_id)],
+                                                  'player_id': [str(player_id)],
+                                                  'request_id': ['R1']})
+        self.assertEquals('pick', result['type'])
+        self.assertTrue(game.get_modified() > modified)
+        # errors are not kept: the request can be retried
+        result = yield self.service.handle(None, {'action': ['vote'],
+                                                  'card': [3],
+                                                  'game_id': [str(game_id)],
+                                                  'player_id': [str(player_id)],
+                                                  'request_id': ['R2']})
+        self.assertEquals('WRONG_STATE_FOR_VOTING', result['error']['code'])
+        self.assertEquals(None, self.service.recent_requests.get((str(player_id), game_id, 'vote', 'R2')))
+        self.flushLoggedErrors()
+        # the same request_id sent for another game is another request
+        other = yield self.service.create({'owner_id': [owner_id]})
+        other_id = other['game_id']
+        yield self.service.set_card({'action': ['set_card'],
+                                     'card': [1],
+                                     'game_id': [other_id],
+                                     'player_id': [owner_id]})
+        yield self.service.set_sentence({'action': ['set_sentence'],
+                                         'sentence': ['SENTENCE'],
+                                         'game_id': [other_id],
+                                         'player_id': [owner_id]})
+        participate['game_id'] = [str(other_id)]
+        result = yield self.service.handle(None, dict(participate))
+        self.assertEquals('participate', result['type'])
+        self.assertEquals([other_id], result['game_id'])
+        self.assertEquals([owner_id, player_id], self.service.games[other_id].players)
+
+    @defer.inlineCallbacks
+    def test22_leaks(self):
+        # Should not get in through the public handler.
+        result = yield self.service.handle(None, {'action': ['leaks']})
+        self.assertEquals('PANIC', result['error']['code'])
+        self.assertSubstring('Unknown action: leaks', result['error']['data'])
+        self.flushLoggedErrors()
+
+        name = 'cardstories.game.CardstoriesGame'
+        before = yield self.service.handle(None, {'action': ['leaks']}, internal_request=True)
+        game = yield self.service.create({'owner_id': [15]})
+        game = self.service.games[game['game_id']]
+        result = yield self.service.handle(None, {'action': ['leaks']}, internal_request=True)
+        self.assertEquals(before['games'] + 1, result['games'])
+        self.assertEquals(before['pollables'].get(name, 0) + 1, result['pollables'][name])
+        # Once canceled and dropped by the service, nothing keeps the game
+        # alive, and it leaves no garbage behind.
+        yield game.cancel()
+        del game
+        # Resume from the reactor: until then, the call stack that resumed
+        # this test holds the frames of the game methods (and the game).
+        yield task.deferLater(reactor, 0, lambda: None)
+        result = yield self.service.handle(None, {'action': ['leaks']}, internal_request=True)
+        self.assertEquals(before['games'], result['games'])
+        self.assertEquals(before['pollables'].get(name, 0), result['pollables'].get(name, 0))
+        self.assertEquals(before['garbage'], result['garbage'])
+
 
 class CardstoriesConnectorTest(CardstoriesServiceTestBase):
 
@@ -1219,6 +1499,7 @@ class CardstoriesConnectorTest(CardstoriesServiceTestBase):
     def create_game(self):
         # Fake auth module
         self.service.auth = Mock()
+        self.service.auth.get_players_info.side_effect = lambda ids: [{} for id in ids]
 
         self.card = 5
         self.sentence = u'SENTENCE'
@@ -18,6 +18,14 @@
 #
 import sys
 import os
+import json
+import gzip
+import zlib
+from cStringIO import StringIO
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 sys.path.insert(0, os.path.abspath("..")) # so that for M-x pdb works
 
 from twisted.trial import unittest, runner, reporter
@@ -31,6 +39,7 @@ from twisted.web.test._util import _render
 from cardstories.site import CardstoriesResource, CardstoriesInternalResource
 from cardstories.site import CardstoriesTree, AGPLResource, CardstoriesSite
 from cardstories.plugins import CardstoriesPlugins
+from cardstories.helpers import Serialized
 
 class CardstoriesServiceMockup:
     def __init__(self):
@@ -54,6 +63,28 @@ class CardstoriesSiteTest(unittest.TestCase):
         self.assertEqual(site.preprocess[0], site.postprocess[1])
         self.assertEqual(site.preprocess[1], site.postprocess[0])
 
+    def test01_dispatch(self):
+        class Plugin:
+            def __init__(self, name, **kwargs):
+                self.plugin_name = name
+                self.__dict__.update(kwargs)
+            def name(self):
+                return self.plugin_name
+        everything = Plugin('everything')
+        message = Plugin('message', preprocess_actions=('message',))
+        state = Plugin('state', preprocess_actions=('state', 'batch'), postprocess_actions=('state',))
+        never = Plugin('never', preprocess_actions=(), postprocess_actions=())
+        site = CardstoriesSite(resource.Resource(), { 'plugins-pre-process': 'state message everything never',
+                                                      'plugins-post-process': 'never everything state' },
+                               [everything, message, state, never])
+        self.assertEqual(site.preprocess_plugins('message'), [message, everything])
+        self.assertEqual(site.preprocess_plugins('state'), [state, everything])
+        self.assertEqual(site.preprocess_plugins('batch'), [state, everything])
+        self.assertEqual(site.preprocess_plugins('poll'), [everything])
+        self.assertEqual(site.preprocess_plugins(None), [everything])
+        self.assertEqual(site.postprocess_plugins('state'), [everything, state])
+        self.assertEqual(site.postprocess_plugins('message'), [everything])
+
 class CardstoriesResourceTest(unittest.TestCase):
 
     class Transport:
@@ -123,6 +154,19 @@ class CardstoriesResourceTest(unittest.TestCase):
         d.addCallback(finish)
         return d
 
+    def test01_wrap_http_serialized(self):
+        self.service.handle = lambda result, args, internal_request=False: Serialized('{"a":  1}')
+        resource = CardstoriesResource(self.service)
+        self.site = CardstoriesSite(resource, {}, [])
+        request = server.Request(self.Channel(self.site), True)
+        request.site = self.site
+        request.method = 'GET'
+        d = resource.wrap_http(request)
+        def finish(result):
+            self.assertSubstring('\r\n\r\n{"a":  1}', request.transport.getvalue())
+        d.addCallback(finish)
+        return d
+
     def test01_wrap_http_disconnected(self):
         resource = CardstoriesResource(self.service)
         self.site = CardstoriesSite(resource, {}, [])
@@ -221,6 +265,191 @@ class CardstoriesResourceTest(unittest.TestCase):
         d.addCallback(finish)
         return d
 
+    @defer.inlineCallbacks
+    def test03_wrap_http_state_etag(self):
+        states = [{'type': 'game', 'state': 'complete'}, {'type': 'players_info'}]
+        self.service.handle = lambda result, args, internal_request=False: states
+        resource = CardstoriesResource(self.service)
+        self.site = CardstoriesSite(resource, {}, [])
+
+        def state_request(args, headers={}):
+            request = server.Request(self.Channel(self.site), True)
+            request.site = self.site
+            request.method = 'GET'
+            request.args = args
+            for (name, value) in headers.iteritems():
+                request.requestHeaders.setRawHeaders(name, [value])
+            return request
+
+        # anonymous view of a completed game
+        request = state_request({'action': ['state'], 'type': ['game'], 'game_id': ['1']})
+        yield resource.wrap_http(request)
+        etag = request.responseHeaders.getRawHeaders('etag')[0]
+        self.assertEquals(200, request.code)
+        self.assertEquals(['public, max-age=%d' % resource.FINISHED_MAX_AGE], request.responseHeaders.getRawHeaders('cache-control'))
+        self.assertSubstring('"players_info"', request.transport.getvalue())
+
+        # the same content is not sent again
+        request = state_request({'action': ['state'], 'type': ['game'], 'game_id': ['1']},
+                                {'if-none-match': etag})
+        yield resource.wrap_http(request)
+        self.assertEquals(304, request.code)
+        self.assertNotSubstring('"players_info"', request.transport.getvalue())
+
+        # the view of a player holds their score and level: it is always
+        # revalidated, even when the game is finished
+        request = state_request({'action': ['state'], 'type': ['game'], 'game_id': ['1'], 'player_id': ['2']})
+        yield resource.wrap_http(request)
+        self.assertEquals(['no-cache'], request.responseHeaders.getRawHeaders('cache-control'))
+        player_etag = request.responseHeaders.getRawHeaders('etag')[0]
+        request = state_request({'action': ['state'], 'type': ['game'], 'game_id': ['1'], 'player_id': ['2']},
+                                {'if-none-match': player_etag})
+        yield resource.wrap_http(request)
+        self.assertEquals(304, request.code)
+
+        # a game in progress changes
+        states[0]['state'] = 'vote'
+        request = state_request({'action': ['state'], 'type': ['game'], 'game_id': ['1']},
+                                {'if-none-match': etag})
+        yield resource.wrap_http(request)
+        self.assertEquals(200, request.code)
+        self.assertNotEquals(etag, request.responseHeaders.getRawHeaders('etag')[0])
+        self.assertEquals(['public, max-age=%d' % resource.ANONYMOUS_MAX_AGE], request.responseHeaders.getRawHeaders('cache-control'))
+        request = state_request({'action': ['state'], 'type': ['game'], 'game_id': ['1'], 'player_id': ['2']})
+        yield resource.wrap_http(request)
+        self.assertEquals(['no-cache'], request.responseHeaders.getRawHeaders('cache-control'))
+
+        # other actions are not cached
+        request = state_request({'action': ['game'], 'game_id': ['1']})
+        yield resource.wrap_http(request)
+        self.assertEquals(['no-cache'], request.responseHeaders.getRawHeaders('cache-control'))
+        self.assertEquals(None, request.responseHeaders.getRawHeaders('etag'))
+
+    @defer.inlineCallbacks
+    def test03_wrap_http_compression(self):
+        results = {'big': {'text': 'X' * 2000},
+                   'small': {'text': 'X'},
+                   'serialized': Serialized('{"text": "%s"}' % ('Y' * 2000)),
+                   'state': [{'type': 'game', 'state': 'complete', 'text': 'Z' * 2000}]}
+        self.service.handle = lambda result, args, internal_request=False: results[args['action'][0]]
+        resource = CardstoriesResource(self.service)
+        self.site = CardstoriesSite(resource, {}, [])
+
+        def get(action, accept_encoding):
+            request = server.Request(self.Channel(self.site), True)
+            request.site = self.site
+            request.method = 'GET'
+            request.args = {'action': [action]}
+            if accept_encoding:
+                request.requestHeaders.setRawHeaders('accept-encoding', [accept_encoding])
+            d = resource.wrap_http(request)
+            d.addCallback(lambda result: request)
+            return d
+
+        def body(request):
+            return request.transport.getvalue().split('\r\n\r\n', 1)[1]
+
+        def encoding(request):
+            return request.responseHeaders.getRawHeaders('content-encoding')
+
+        # gzip is preferred
+        request = yield get('big', 'deflate, gzip;q=0.8')
+        self.assertEquals(['gzip'], encoding(request))
+        self.assertEquals(['Accept, Accept-Encoding'], request.responseHeaders.getRawHeaders('vary'))
+        self.assertEquals(json.dumps(results['big']), gzip.GzipFile(fileobj=StringIO(body(request))).read())
+        request = yield get('big', 'deflate, gzip;q=0')
+        self.assertEquals(['deflate'], encoding(request))
+        self.assertEquals(json.dumps(results['big']), zlib.decompress(body(request)))
+        request = yield get('big', 'identity')
+        self.assertEquals(None, encoding(request))
+        request = yield get('big', None)
+        self.assertEquals(None, encoding(request))
+
+        # below the threshold
+        request = yield get('small', 'gzip')
+        self.assertEquals(None, encoding(request))
+
+        # compressed once for the serialized results
+        request = yield get('serialized', '*')
+        compressed = body(request)
+        self.assertEquals(compressed, results['serialized'].compressed[('json', 'gzip')])
+        results['serialized'].compressed[('json', 'gzip')] = 'REUSED'
+        request = yield get('serialized', 'gzip')
+        self.assertEquals('REUSED', body(request))
+
+        # and for the cacheable responses
+        request = yield get('state', 'gzip')
+        etag = request.responseHeaders.getRawHeaders('etag')[0]
+        self.assertTrue(etag.endswith('-gzip"'))
+        self.assertEquals(1, len(self.site.compressed))
+        request = yield get('state', 'gzip')
+        self.assertEquals(1, self.site.compressed.hits)
+
+        # disabled
+        self.site.compression_level = 0
+        request = yield get('big', 'gzip')
+        self.assertEquals(None, encoding(request))
+
+    def format_request(self, args, accept=None):
+        request = server.Request(self.Channel(self.site), True)
+        request.site = self.site
+        request.method = 'GET'
+        request.args = args
+        if accept:
+            request.requestHeaders.setRawHeaders('accept', [accept])
+        return request
+
+    @defer.inlineCallbacks
+    def test03_wrap_http_msgpack(self):
+        result = {'cards': [1, 2, 3], 'board': [4, 5], 'sentence': u'\u00e9'}
+        self.service.handle = lambda result_in, args, internal_request=False: result
+        resource = CardstoriesResource(self.service)
+        self.site = CardstoriesSite(resource, {}, [])
+
+        for (args, accept) in (({'format': ['msgpack']}, None),
+                               ({}, 'application/x-msgpack'),
+                               ({}, 'application/json;q=0.5, application/msgpack')):
+            request = self.format_request(args, accept)
+            yield resource.wrap_http(request)
+            self.assertEquals(['application/x-msgpack'], request.responseHeaders.getRawHeaders('content-type'))
+            self.assertEquals(result, msgpack.unpackb(request.transport.getvalue().split('\r\n\r\n', 1)[1], encoding='utf-8'))
+
+        for (args, accept) in (({'format': ['json']}, 'application/x-msgpack'),
+                               ({}, '*/*'),
+                               ({}, 'application/json, application/x-msgpack;q=0.5')):
+            request = self.format_request(args, accept)
+            yield resource.wrap_http(request)
+            self.assertSubstring('application/json', request.responseHeaders.getRawHeaders('content-type')[0])
+
+        # serialized results are packed once
+        serialized = Serialized('{"a": [1]}')
+        self.service.handle = lambda result_in, args, internal_request=False: serialized
+        request = self.format_request({'format': ['msgpack']})
+        yield resource.wrap_http(request)
+        self.assertEquals({'a': [1]}, msgpack.unpackb(serialized.packed))
+
+        # the results of a batch are packed as a list of maps
+        batch = [{'type': 'participate'}, [{'players': [{'id': 1}]}, {'type': 'players_info'}]]
+        self.service.handle = lambda result_in, args, internal_request=False: batch
+        request = self.format_request({'format': ['msgpack'], 'action': ['batch']})
+        yield resource.wrap_http(request)
+        self.assertEquals(batch, msgpack.unpackb(request.transport.getvalue().split('\r\n\r\n', 1)[1], encoding='utf-8'))
+    if msgpack is None:
+        test03_wrap_http_msgpack.skip = 'msgpack is not installed'
+
+    @defer.inlineCallbacks
+    def test03_wrap_http_msgpack_unavailable(self):
+        import cardstories.site
+        default_msgpack = cardstories.site.msgpack
+        cardstories.site.msgpack = None
+        resource = CardstoriesResource(self.service)
+        self.site = CardstoriesSite(resource, {}, [])
+        request = self.format_request({'format': ['msgpack']}, 'application/x-msgpack')
+        yield resource.wrap_http(request)
+        cardstories.site.msgpack = default_msgpack
+        self.assertSubstring('application/json', request.responseHeaders.getRawHeaders('content-type')[0])
+        self.assertSubstring('\r\n\r\n"handle"', request.transport.getvalue())
+
     def test04_handle(self):
         resource = CardstoriesResource(self.service)
         self.site = CardstoriesSite(resource, {}, [])
@@ -43,6 +43,8 @@ sys.path.append(root_dir)
 
 import mailing.message
 
+import rpc
+
 
 class UserProfile(models.Model):
     """
@@ -115,11 +117,15 @@ def grant_user_bought_cards(ipn_obj):
                   'card_ids': settings.CS_EXTRA_CARD_PACK_CARD_IDS,
                   'secret': settings.WEBSERVICE_INTERNAL_SECRET}
 
-        url = 'http://%s/internal?%s' % (settings.CARDSTORIES_HOST,
-                                         urlencode(params, True))
-        data = urlopen(url).read()
-        logger.info("The webservice responded with: %r" % data)
-        response = simplejson.loads(data)
+        try:
+            response = rpc.call('internal', params)
+            logger.info("The webservice responded with: %r" % response)
+        except rpc.RPCUnavailable:
+            url = 'http://%s/internal?%s' % (settings.CARDSTORIES_HOST,
+                                             urlencode(params, True))
+            data = urlopen(url).read()
+            logger.info("The webservice responded with: %r" % data)
+            response = simplejson.loads(data)
 
         if response.get('status') == 'success':
             Purchase.objects.create(user_id=player_id, item_code=settings.CS_EXTRA_CARD_PACK_ITEM_ID)
@@ -0,0 +1,164 @@
+#
+# Copyright (C) 2012 Farsides <contact@farsides.com>
+#
+# This software's license gives you freedom; you can copy, convey,
+# propagate, redistribute and/or modify this program under the terms of
+# the GNU Affero General Public License (AGPL) as published by the Free
+# Software Foundation (FSF), either version 3 of the License, or (at your
+# option) any later version of the AGPL published by the FSF.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program in a file in the toplevel directory called
+# "AGPLv3".  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Client side of the RPC channel served by the webservice over a unix socket
+(see cardstories.rpc). It speaks just enough AMP to send Handle commands,
+over a connection kept open between requests.
+"""
+
+# Imports #####################################################################
+
+import socket, struct, threading
+from simplejson import loads, dumps
+
+# Constants ###################################################################
+
+MAX_VALUE_LENGTH = 0xffff
+
+# Exceptions ##################################################################
+
+class RPCUnavailable(Exception):
+    """The RPC channel isn't configured or can't be reached: the caller
+    should fall back to HTTP."""
+
+class RPCError(Exception):
+    """The webservice failed to handle a call."""
+
+# Functions ###################################################################
+
+def serialize_box(box):
+    data = []
+    for key, value in box.iteritems():
+        data.append(struct.pack('!H', len(key)) + key)
+        data.append(struct.pack('!H', len(value)) + value)
+    data.append(struct.pack('!H', 0))
+    return ''.join(data)
+
+def json_to_box(name, value, box):
+    '''Encodes value like the cardstories.rpc.JSON AMP argument'''
+
+    value = dumps(value)
+    chunks = [value[i:i + MAX_VALUE_LENGTH] for i in xrange(0, len(value), MAX_VALUE_LENGTH)]
+    box[name] = str(len(chunks))
+    for i, chunk in enumerate(chunks):
+        box['%s.%d' % (name, i)] = chunk
+
+def json_from_box(name, box):
+    count = int(box[name])
+    return loads(''.join([box['%s.%d' % (name, i)] for i in xrange(count)]))
+
+# Classes #####################################################################
+
+class RPCClient(object):
+
+    def __init__(self, path, timeout=10):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = ''
+        self.tag = 0
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.buffer = ''
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+    def read(self, length):
+        while len(self.buffer) < length:
+            data = self.sock.recv(65536)
+            if not data:
+                raise socket.error('connection closed by the webservice')
+            self.buffer += data
+        data, self.buffer = self.buffer[:length], self.buffer[length:]
+        return data
+
+    def read_box(self):
+        box = {}
+        while True:
+            (length,) = struct.unpack('!H', self.read(2))
+            if length == 0:
+                return box
+            key = self.read(length)
+            (length,) = struct.unpack('!H', self.read(2))
+            box[key] = self.read(length)
+
+    def handle(self, calls):
+        '''Sends a batch of calls (see cardstories.rpc.Handle) and returns
+        the list of their results'''
+
+        self.tag += 1
+        tag = str(self.tag)
+        box = {'_command': 'Handle', '_ask': tag}
+        json_to_box('calls', calls, box)
+        try:
+            if not self.sock:
+                self.connect()
+            self.sock.sendall(serialize_box(box))
+        except socket.error, e:
+            self.close()
+            raise RPCUnavailable(str(e))
+        # Once sent, the calls may have been handled: it isn't safe to
+        # fall back to HTTP anymore.
+        try:
+            while True:
+                answer = self.read_box()
+                if answer.get('_answer') == tag or answer.get('_error') == tag:
+                    break
+        except (socket.error, struct.error), e:
+            self.close()
+            raise RPCError(str(e))
+        if '_error' in answer:
+            raise RPCError(answer.get('_error_description'))
+        results = []
+        for result in json_from_box('results', answer):
+            if 'error' in result:
+                raise RPCError(result['error'])
+            results.append(result['result'])
+        return results
+
+# One connection per thread, kept open between requests.
+_local = threading.local()
+
+def get_client():
+    from django.conf import settings
+
+    path = getattr(settings, 'CARDSTORIES_RPC_SOCKET', None)
+    if not path:
+        raise RPCUnavailable('CARDSTORIES_RPC_SOCKET is not set')
+    client = getattr(_local, 'client', None)
+    if client is None or client.path != path:
+        client = RPCClient(path, getattr(settings, 'CARDSTORIES_RPC_TIMEOUT', 10))
+        _local.client = client
+    return client
+
+def batch(calls):
+    '''Sends the (path, params) calls to the webservice at once, path being
+    'resource' or 'internal'. Returns the list of their results.
+    Raises RPCUnavailable if the RPC channel can't be used.'''
+
+    return get_client().handle([{'path': path, 'args': params} for (path, params) in calls])
+
+def call(path, params):
+    return batch([(path, params)])[0]
@@ -1213,3 +1213,124 @@ class CardstoriesTest(TestCase):
         # Reload user from the db.
         user = User.objects.get(username='testuser1@email.com')
         self.assertTrue(user.userprofile.activity_notifications_disabled)
+
+    @patch('website.cardstories.views.Avatar')
+    def test_24get_players_bulk(self, MockAvatar):
+        """
+        Test the bulk versions of get_player_id, get_player_name,
+        get_player_email and get_player_avatar_url. Requires 'users' fixture.
+
+        """
+        from simplejson import loads
+        c = self.client
+
+        # Ids, optionally creating the players.
+        response = c.get('/get_players_ids/', {'username': ['testuser1@email.com', 'testuser2@email.com', 'new@email.com']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(loads(response.content), {'testuser1@email.com': 1, 'testuser2@email.com': 2})
+        response = c.get('/get_players_ids/', {'username': ['testuser1@email.com', 'new@email.com', 'not_a_valid_email'],
+                                               'create': 'yes'})
+        self.assertEqual(response.status_code, 400)
+        response = c.get('/get_players_ids/', {'username': ['testuser1@email.com', 'new@email.com', 'new2@email.com'],
+                                               'create': 'yes'})
+        self.assertEqual(response.status_code, 200)
+        ids = loads(response.content)
+        self.assertEqual(ids['testuser1@email.com'], 1)
+        self.assertEqual(len(set(ids.values())), 3)
+
+        # Names
+        response = c.get('/get_players_names/', {'id': ['1', '3', '999', 'bogus']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(loads(response.content), {'1': 'Test User 1', '3': 'testuser3'})
+
+        # Emails, only for the WS.
+        default_webservice_ip = settings.WEBSERVICE_IP
+        settings.WEBSERVICE_IP = '127.0.0.2'
+        response = c.get('/get_players_emails/', {'id': ['1']})
+        self.assertEqual(response.status_code, 403)
+        settings.WEBSERVICE_IP = default_webservice_ip
+        response = c.get('/get_players_emails/', {'id': ['1', '2', '999']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(loads(response.content), {'1': 'testuser1@email.com', '2': 'testuser2@email.com'})
+
+        # Avatars
+        mock_avatar = MockAvatar.return_value
+        mock_avatar.in_cache.return_value = True
+        mock_avatar.get_url.return_value = 'http://example.com/avatar.jpg'
+        response = c.get('/get_players_avatars_urls/', {'id': ['1', '999']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(loads(response.content), {'1': 'http://example.com/avatar.jpg'})
+
+    def test_25get_game_info_cache(self):
+        """
+        Test the caching of get_game_info.
+
+        """
+        import threading, time
+        from website.cardstories import views
+
+        class Request(object):
+            def __init__(self, game_id):
+                self.GET = {'game_id': game_id}
+
+        fetched = []
+        release = threading.Event()
+        release.set()
+        class MockCardstoriesService(object):
+            def __init__(self, url):
+                fetched.append(url)
+                release.wait()
+            def read(self):
+                return '[{"sentence": "Sentence %d."}]' % len(fetched)
+        orig_urlopen = views.urlopen
+        views.urlopen = MockCardstoriesService
+        # The refresh threads, as started by get_game_info: they remove
+        # themselves from views.game_info_refreshes once done.
+        started = []
+        orig_refresh_game_info = views.refresh_game_info
+        def refresh_game_info(game_id):
+            thread = orig_refresh_game_info(game_id)
+            started.append(thread)
+            return thread
+        views.refresh_game_info = refresh_game_info
+        try:
+            # Not a game id.
+            self.assertEqual(views.get_game_info(Request('')), {})
+            self.assertEqual(views.get_game_info(Request('../123')), {})
+            self.assertEqual(len(fetched), 0)
+
+            # Fetched once, then cached.
+            self.assertEqual(views.get_game_info(Request('2501')), {'sentence': 'Sentence 1.'})
+            self.assertEqual(views.get_game_info(Request('2501')), {'sentence': 'Sentence 1.'})
+            self.assertEqual(len(fetched), 1)
+
+            # Once expired, the stale info is returned while it is refreshed.
+            entry = views.cache.get('game_info_2501')
+            entry['fetched'] -= settings.CS_GAME_INFO_TTL
+            views.cache.set('game_info_2501', entry)
+            self.assertEqual(views.get_game_info(Request('2501')), {'sentence': 'Sentence 1.'})
+            started[-1].join()
+            self.assertEqual(len(fetched), 2)
+            self.assertEqual(views.get_game_info(Request('2501')), {'sentence': 'Sentence 2.'})
+
+            # The page doesn't wait for a slow webservice.
+            release.clear()
+            start = time.time()
+            self.assertEqual(views.get_game_info(Request('2502')), {})
+            self.assertTrue(time.time() - start < settings.CS_GAME_INFO_TIMEOUT + 0.5)
+            self.assertEqual(views.get_game_info(Request('2502')), {})
+            self.assertEqual(len(fetched), 3) # the refresh in progress is shared
+            release.set()
+            started[-1].join()
+            self.assertEqual(views.get_game_info(Request('2502')), {'sentence': 'Sentence 3.'})
+
+            # The template variable is only computed when used, and only once.
+            calls = []
+            game_info = views.LazyDict(lambda request: calls.append(request) or {'sentence': 'S'}, 'request')
+            self.assertEqual(len(calls), 0)
+            self.assertEqual(game_info['sentence'], 'S')
+            self.assertEqual(game_info, {'sentence': 'S'})
+            self.assertEqual(calls, ['request'])
+        finally:
+            views.urlopen = orig_urlopen
+            views.refresh_game_info = orig_refresh_game_info
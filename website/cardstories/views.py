@@ -20,6 +20,7 @@
 #
 from urllib import quote, urlencode, urlopen
 from urlparse import parse_qs
+import time, threading, logging
 from simplejson import loads, dumps
 
 from django.shortcuts import render_to_response
@@ -36,6 +37,7 @@ from django.template import RequestContext
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.shortcuts import redirect
+from django.core.cache import cache
 
 import paypal.standard.pdt.views
 from paypal.standard.forms import PayPalPaymentsForm
@@ -43,30 +45,102 @@ from paypal.standard.forms import PayPalPaymentsForm
 from forms import RegistrationForm, LoginForm
 from models import Purchase
 from avatar import Avatar, GravatarAvatar, FacebookAvatar
+from website.util.helpers import LazyDict
+import rpc
 
 def get_base_url(request):
     domain = Site.objects.get_current().domain
     return 'http://%s' % domain
 
-def get_game_info(request):
+def fetch_game_info(game_id):
+    """
+    Asks the webservice for the state of a game.
+
+    """
     game_info = {}
-    game_id = request.GET.get('game_id', '')
-    if game_id != '':
-        params = {'action': 'state',
-                  'type': 'game',
-                  'modified': 0,
-                  'game_id': game_id}
+    params = {'action': 'state',
+              'type': 'game',
+              'modified': 0,
+              'game_id': game_id}
+    try:
+        response = rpc.call('resource', params)
+    except rpc.RPCUnavailable:
         url = 'http://%s/resource?%s' % (settings.CARDSTORIES_HOST,
                                          urlencode(params))
         data = urlopen(url).read()
         response = loads(data)
-        try:
-            game_info = response[0]
-        except KeyError:
-            pass
+    try:
+        game_info = response[0]
+    except KeyError:
+        pass
 
     return game_info
 
+# Refreshes of the game info cache in progress, by game id.
+game_info_refreshes = {}
+game_info_refreshes_lock = threading.Lock()
+
+def refresh_game_info(game_id):
+    """
+    Fetches the game info in a background thread and stores it in the
+    cache. Returns the thread, which is shared with any refresh of the same
+    game already in progress.
+
+    """
+    def refresh():
+        try:
+            game_info = fetch_game_info(game_id)
+        except Exception:
+            # Don't hammer a failing webservice: cache the failure too.
+            logging.getLogger('cardstories').exception('Failed fetching the info of game %s' % game_id)
+            game_info = {}
+        cache.set('game_info_%s' % game_id,
+                  {'game_info': game_info, 'fetched': time.time()},
+                  settings.CS_GAME_INFO_STALE)
+        game_info_refreshes_lock.acquire()
+        try:
+            del game_info_refreshes[game_id]
+        finally:
+            game_info_refreshes_lock.release()
+
+    game_info_refreshes_lock.acquire()
+    try:
+        thread = game_info_refreshes.get(game_id)
+        if thread is None:
+            thread = threading.Thread(target=refresh)
+            thread.daemon = True
+            game_info_refreshes[game_id] = thread
+            thread.start()
+    finally:
+        game_info_refreshes_lock.release()
+    return thread
+
+def get_game_info(request):
+    """
+    Returns the state of the game referred to by the game_id GET parameter,
+    from the cache. If the cached state is older than CS_GAME_INFO_TTL, it
+    is refreshed in the background and the stale state is returned. If
+    there is none, waits for it at most CS_GAME_INFO_TIMEOUT seconds.
+
+    """
+    game_id = request.GET.get('game_id', '')
+    if not game_id.isdigit():
+        return {}
+
+    key = 'game_info_%s' % game_id
+    entry = cache.get(key)
+    if entry and time.time() - entry['fetched'] < settings.CS_GAME_INFO_TTL:
+        return entry['game_info']
+
+    thread = refresh_game_info(game_id)
+    if not entry:
+        thread.join(settings.CS_GAME_INFO_TIMEOUT)
+        entry = cache.get(key)
+    if entry:
+        return entry['game_info']
+    else:
+        return {}
+
 def get_gameid_query(request):
     query = ''
     if request.GET.get('game_id', '') != '':
@@ -108,7 +182,7 @@ def common_variables(request):
     """
     return {'base_url': get_base_url(request),
             'gameid_query': get_gameid_query(request),
-            'game_info': get_game_info(request),
+            'game_info': LazyDict(get_game_info, request),
             'game_url': get_game_url(request),
             'fb_redirect_uri': get_facebook_redirect_uri(request),
             'fb_app_id': settings.FACEBOOK_APP_ID,
@@ -279,27 +353,36 @@ def get_player_id(request, username):
         user = User.objects.get(username=username)
     except User.DoesNotExist:
         if request.GET.get('create', '') == 'yes':
-            # Validates the username according to the registration form.
-            name = "Cardstories Player"
-            password = "mockpassword"
-            data = {"name": name,
-                    "username": username,
-                    "password1": password,
-                    "password2": password}
-            form = RegistrationForm(data)
-            if not form.is_valid():
+            if not is_valid_player_username(username):
                 return HttpResponseBadRequest()
-
-            # Create the user with an unusable password. The user will need
-            # to click on "forgot password" to obtain a new one.
-            user = User.objects.create_user(username, username)
-            user.save()
+            user = create_player(username)
         else:
             return HttpResponseNotFound()
 
     response = HttpResponse(user.id, mimetype="text/plain")
     return response
 
+def is_valid_player_username(username):
+    """
+    Validates the username according to the registration form.
+
+    """
+    name = "Cardstories Player"
+    password = "mockpassword"
+    data = {"name": name,
+            "username": username,
+            "password1": password,
+            "password2": password}
+    form = RegistrationForm(data)
+    return form.is_valid()
+
+def create_player(username):
+    # Create the user with an unusable password. The user will need
+    # to click on "forgot password" to obtain a new one.
+    user = User.objects.create_user(username, username)
+    user.save()
+    return user
+
 def get_player_name(request, userid):
     """
     Returns a user's name based on supplied id, if found.
@@ -334,16 +417,81 @@ def get_player_avatar_url(request, userid):
     """
     try:
         user = User.objects.get(id=userid)
-
-        avatar = Avatar(user)
-        if not avatar.in_cache():
-            avatar = GravatarAvatar(user)
-            avatar.update()
-
-        return HttpResponse(avatar.get_url(), mimetype="text/plain")
+        return HttpResponse(get_user_avatar_url(user), mimetype="text/plain")
     except User.DoesNotExist:
         return HttpResponseNotFound()
 
+def get_user_avatar_url(user):
+    avatar = Avatar(user)
+    if not avatar.in_cache():
+        avatar = GravatarAvatar(user)
+        avatar.update()
+    return avatar.get_url()
+
+def get_players_ids(request):
+    """
+    Bulk version of get_player_id: returns a JSON map of the supplied
+    usernames (the 'username' GET parameter, repeated) to their user ids,
+    optionally creating the users that don't exist.
+
+    Users that are not found are missing from the map. If creation is
+    requested but any of the usernames is invalid, a status of 400 will be
+    returned and no user is created.
+
+    """
+    usernames = request.GET.getlist('username')
+    ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+    if request.GET.get('create', '') == 'yes':
+        missing = [username for username in set(usernames) if username not in ids]
+        for username in missing:
+            if not is_valid_player_username(username):
+                return HttpResponseBadRequest()
+        for username in missing:
+            ids[username] = create_player(username).id
+    return HttpResponse(dumps(ids), mimetype="application/json")
+
+def get_players_names(request):
+    """
+    Bulk version of get_player_name: returns a JSON map of the supplied
+    user ids (the 'id' GET parameter, repeated) to their names.
+    Users that are not found are missing from the map.
+
+    """
+    ids = [id for id in request.GET.getlist('id') if id.isdigit()]
+    names = {}
+    for user in User.objects.filter(id__in=ids):
+        names[user.id] = get_user_display_name(user)
+    return HttpResponse(dumps(names), mimetype="application/json")
+
+def get_players_emails(request):
+    """
+    Bulk version of get_player_email: returns a JSON map of the supplied
+    user ids (the 'id' GET parameter, repeated) to their emails.
+    Users that are not found are missing from the map.
+
+    """
+
+    # Only the webservice should be able to retreive players emails
+    if request.META['REMOTE_ADDR'] != settings.WEBSERVICE_IP:
+        return HttpResponseForbidden()
+
+    ids = [id for id in request.GET.getlist('id') if id.isdigit()]
+    emails = dict(User.objects.filter(id__in=ids).values_list('id', 'username'))
+    return HttpResponse(dumps(emails), mimetype="application/json")
+
+def get_players_avatars_urls(request):
+    """
+    Bulk version of get_player_avatar_url: returns a JSON map of the
+    supplied user ids (the 'id' GET parameter, repeated) to their avatar
+    URLs. Users that are not found are missing from the map.
+
+    """
+    ids = [id for id in request.GET.getlist('id') if id.isdigit()]
+    avatars_urls = {}
+    for user in User.objects.filter(id__in=ids):
+        avatars_urls[user.id] = get_user_avatar_url(user)
+    return HttpResponse(dumps(avatars_urls), mimetype="application/json")
+
 def get_loggedin_player_id(request, session_key):
     """
     Returns a user's id based on a logged in session id. If user is not found,
@@ -140,6 +140,10 @@ AUTH_PROFILE_MODULE = 'cardstories.UserProfile'
 CARDSTORIES_HOST = 'localhost:5000'
 WEBSERVICE_IP = '127.0.0.1'
 WEBSERVICE_INTERNAL_SECRET = 'TheSecret'
+# Unix socket of the webservice RPC channel (--rpc-socket), used instead of
+# HTTP requests to CARDSTORIES_HOST when set.
+CARDSTORIES_RPC_SOCKET = None
+CARDSTORIES_RPC_TIMEOUT = 10 # seconds
 
 # Facebook settings.
 FACEBOOK_APP_ID = ''
@@ -168,6 +172,13 @@ CS_EXTRA_CARD_PACK_CURRENCY = 'EUR'
 CS_EXTRA_CARD_PACK_ITEM_ID = 'CardPack1'
 # Keep this in sync with the settings on the service (inside game.py).
 CS_EXTRA_CARD_PACK_CARD_IDS = [44, 45, 46, 47, 48, 49, 50, 51, 52, 53]
+# Game previews (game_info template variable) are cached for GAME_INFO_TTL
+# seconds, then served stale for up to GAME_INFO_STALE seconds while being
+# refreshed in the background. A page never waits more than
+# GAME_INFO_TIMEOUT seconds for the webservice.
+CS_GAME_INFO_TTL = 30
+CS_GAME_INFO_STALE = 600
+CS_GAME_INFO_TIMEOUT = 0.5
 
 # Enables code coverage
 TEST_RUNNER = 'tests.run_tests_with_coverage'
@@ -51,6 +51,10 @@ urlpatterns += patterns('website.cardstories.views',
     (r'^get_player_email/(\d+)/', 'get_player_email'),
     (r'^get_player_avatar_url/(\d+)/', 'get_player_avatar_url'),
     (r'^get_loggedin_player_id/(.+)/', 'get_loggedin_player_id'),
+    (r'^get_players_ids/$', 'get_players_ids'),
+    (r'^get_players_names/$', 'get_players_names'),
+    (r'^get_players_emails/$', 'get_players_emails'),
+    (r'^get_players_avatars_urls/$', 'get_players_avatars_urls'),
 )
 
 # Development urls
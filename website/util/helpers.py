@@ -33,3 +33,46 @@ def mkdir_p(path):
             pass
         else: raise
 
+# Classes #####################################################################
+
+class LazyDict(object):
+    '''Read only dict whose content is computed by function(*args), when
+    it is first accessed. Used for template variables that may not be used
+    by the template.'''
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+        self.result = None
+
+    def evaluate(self):
+        if self.result is None:
+            self.result = self.function(*self.args)
+        return self.result
+
+    def __getitem__(self, key):
+        return self.evaluate()[key]
+
+    def __contains__(self, key):
+        return key in self.evaluate()
+
+    def __iter__(self):
+        return iter(self.evaluate())
+
+    def __len__(self):
+        return len(self.evaluate())
+
+    def __eq__(self, other):
+        return self.evaluate() == other
+
+    def __ne__(self, other):
+        return self.evaluate() != other
+
+    def get(self, key, default=None):
+        return self.evaluate().get(key, default)
+
+    def keys(self):
+        return self.evaluate().keys()
+
+    def items(self):
+        return self.evaluate().items()